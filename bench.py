@@ -0,0 +1,184 @@
+# bench.py — micro-benchmarks لمسارات الرسم والقراءة في qr.py
+#   python bench.py                       # كامل، يطبع جدول
+#   python bench.py --quick --out r.json  # أسرع + يحفظ النتائج
+#   python bench.py --baseline r.json     # يقارن بنتيجة محفوظة (ويرجع 1 لو فيه تراجع مع --fail-on-regression)
+#
+# الـ corpus يتولد بشكل ثابت (seed) من صور المشروع نفسها: QR وباج، ثم تشويهات
+# (دوران، perspective، blur، JPEG، contrast منخفض، inversion) وأحجام من 320px لـ 12MP.
+
+import os, sys, json, time, argparse, platform, resource, tempfile
+import numpy as np
+import cv2
+
+os.environ.setdefault("QR_DB", os.path.join(tempfile.gettempdir(), "qr_bench.db"))  # البنشمارك ما يحتاج داتا حقيقية
+os.environ.setdefault("METRICS", "0")  # نقيس المسار نفسه بدون instrumentation (METRICS=1 لقياس كلفتها)
+import qr
+
+RESOLUTIONS = [("320", (320, 240)), ("vga", (640, 480)), ("hd", (1280, 720)),
+               ("fhd", (1920, 1080)), ("8mp", (3264, 2448)), ("12mp", (4000, 3000))]
+
+def pct(xs, p):
+    return float(np.percentile(xs, p)) if xs else 0.0
+
+def summarize(lat_s):
+    ms = [x*1000 for x in lat_s]
+    total = sum(lat_s)
+    return dict(n=len(ms), ops_per_s=round(len(ms)/total, 2) if total else 0.0,
+                p50_ms=round(pct(ms, 50), 3), p95_ms=round(pct(ms, 95), 3), p99_ms=round(pct(ms, 99), 3))
+
+def peak_rss_mb():
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(kb / (1024.0 if sys.platform != "darwin" else 1024.0*1024.0), 1)
+
+def timed(fn, args_iter):
+    lat = []
+    for args in args_iter:
+        t = time.perf_counter(); fn(*args); lat.append(time.perf_counter() - t)
+    return lat
+
+# ---------- Corpus ----------
+def to_bgr(png_bytes):
+    return cv2.imdecode(np.frombuffer(png_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+def place(src, size, rng, scale=None):
+    # يحط الصورة على خلفية ملوّنة بالحجم المطلوب بمكان عشوائي ثابت
+    W, H = size
+    bg = np.empty((H, W, 3), np.uint8); bg[:] = rng.integers(60, 200, 3)
+    s = scale or min(0.6*W/src.shape[1], 0.6*H/src.shape[0])
+    im = cv2.resize(src, None, fx=s, fy=s, interpolation=cv2.INTER_AREA if s < 1 else cv2.INTER_CUBIC)
+    h, w = im.shape[:2]
+    x, y = int(rng.integers(0, max(1, W-w))), int(rng.integers(0, max(1, H-h)))
+    bg[y:y+h, x:x+w] = im
+    return bg
+
+def rotate(img, deg):
+    h, w = img.shape[:2]
+    M = cv2.getRotationMatrix2D((w/2, h/2), deg, 1.0)
+    return cv2.warpAffine(img, M, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+def perspective(img, rng, k=0.12):
+    h, w = img.shape[:2]
+    src = np.float32([[0,0],[w,0],[w,h],[0,h]])
+    jit = rng.uniform(0, k, (4,2)) * [w, h]
+    dst = np.float32([[jit[0][0], jit[0][1]], [w-jit[1][0], jit[1][1]], [w-jit[2][0], h-jit[2][1]], [jit[3][0], h-jit[3][1]]])
+    return cv2.warpPerspective(img, cv2.getPerspectiveTransform(src, dst), (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+def jpeg(img, q):
+    return cv2.imdecode(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, q])[1], cv2.IMREAD_COLOR)
+
+def corpus(seed=0, per_class=6, quick=False):
+    # يرجع (class, expected_id, image) lazily عشان صور الـ 12MP ما تتكدس بالذاكرة
+    rng = np.random.default_rng(seed)
+    ids = [f"ajz_bench{seed:02d}{i:03d}"[:14] for i in range(per_class)]
+    badges = [to_bgr(qr.make_badge_png(f"Bench Visitor {i}", "Bench Co", "Tester", vid).getvalue()) for i, vid in enumerate(ids)]
+    qrs    = [to_bgr(qr.make_qr_png(vid, label_name=f"Bench {i}").getvalue()) for i, vid in enumerate(ids)]
+    res = RESOLUTIONS[:4] if quick else RESOLUTIONS
+    for i, vid in enumerate(ids):
+        b, q = badges[i], qrs[i]
+        yield "clean_qr", vid, q
+        yield "clean_badge", vid, b
+        yield "rotate", vid, rotate(place(b, (1600, 1600), rng), float(rng.choice([-35, -15, 10, 25, 90, 180])))
+        yield "perspective", vid, perspective(place(b, (1600, 1200), rng), rng)
+        yield "blur", vid, cv2.GaussianBlur(place(b, (1280, 960), rng), (0, 0), float(rng.uniform(1.0, 2.5)))
+        yield "jpeg", vid, jpeg(place(b, (1280, 960), rng), int(rng.choice([15, 25, 40])))
+        yield "low_contrast", vid, cv2.convertScaleAbs(place(b, (1280, 960), rng), alpha=0.25, beta=float(rng.uniform(90, 150)))
+        yield "inverted", vid, cv2.bitwise_not(place(q, (1024, 1024), rng))
+        for name, size in res:
+            # الباج بحجم ثابت نسبياً لحجم الصورة: بالـ 12MP الـ QR صغير
+            yield f"res_{name}", vid, place(b, size, rng, scale=min(0.35*size[0]/b.shape[1], 0.6*size[1]/b.shape[0]))
+
+# ---------- Benchmarks ----------
+def bench_render(iters):
+    out = {}
+    uniq = (f"ajz_r{n:09d}" for n in range(10**9))
+    out["build_qr_image"]         = summarize(timed(qr.build_qr_image, ((next(uniq), 1024) for _ in range(iters))))
+    out["build_qr_image_warm"]    = summarize(timed(qr.build_qr_image, (("ajz_warm000001", 1024) for _ in range(iters))))
+    out["compose_badge_portrait"] = summarize(timed(qr.compose_badge_portrait,
+                                       ((f"Visitor {i}", "Company", "Position", next(uniq)) for i in range(iters))))
+    out["make_qr_png"]            = summarize(timed(qr.make_qr_png, ((next(uniq), f"Visitor {i}") for i in range(iters))))
+    out["make_badge_png"]         = summarize(timed(qr.make_badge_png,
+                                       ((f"Visitor {i}", "Company", "Position", next(uniq)) for i in range(max(1, iters//2)))))
+    return out
+
+def bench_decode(seed, per_class, quick):
+    by, lat_all = {}, []
+    for cls, vid, img in corpus(seed, per_class, quick):
+        t = time.perf_counter(); text, _, stage = qr.robust_decode_ex(img); dt = time.perf_counter() - t
+        c = by.setdefault(cls, dict(lat=[], ok=0, stages={}))
+        c["lat"].append(dt); lat_all.append(dt)
+        if text == vid:
+            c["ok"] += 1; c["stages"][stage] = c["stages"].get(stage, 0) + 1
+    classes = {cls: dict(summarize(c["lat"]), success_rate=round(c["ok"]/len(c["lat"]), 3), stages=c["stages"])
+               for cls, c in by.items()}
+    ok = sum(c["ok"] for c in by.values())
+    return dict(by_class=classes, overall=dict(summarize(lat_all), success_rate=round(ok/max(1, len(lat_all)), 3)))
+
+# ---------- Compare ----------
+def compare(cur, base, tolerance, sections=("render", "decode")):
+    # أرقام الزمن (p50/p95/p99) أعلى من الأساس بأكثر من tolerance، أو نسبة نجاح أقل = تراجع
+    rows, regressions = [], 0
+    def walk(path, a, b):
+        nonlocal regressions
+        for k, v in a.items():
+            if k not in b: continue
+            if isinstance(v, dict): walk(path + [k], v, b[k]); continue
+            if not isinstance(v, (int, float)) or isinstance(v, bool): continue
+            if k.endswith("_ms") or k == "success_rate":
+                old = b[k]
+                if not old: continue
+                delta = (v - old) / old
+                bad = delta > tolerance if k.endswith("_ms") else v < old - 1e-9
+                regressions += bad
+                rows.append((".".join(path + [k]), old, v, delta, bad))
+    walk([], {k: cur[k] for k in sections if k in cur}, base)
+    return rows, regressions
+
+def print_table(res):
+    print(f"{'render':34} {'n':>5} {'ops/s':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for k, v in res.get("render", {}).items():
+        print(f"{k:34} {v['n']:5d} {v['ops_per_s']:9.1f} {v['p50_ms']:9.2f} {v['p95_ms']:9.2f} {v['p99_ms']:9.2f}")
+    dec = res.get("decode")
+    if dec:
+        print(f"\n{'decode class':34} {'n':>5} {'ok%':>6} {'p50':>9} {'p95':>9} {'p99':>9}  stages")
+        for k, v in sorted(dec["by_class"].items()) + [("overall", dec["overall"])]:
+            st = ",".join(f"{s}:{n}" for s, n in sorted(v.get("stages", {}).items()))
+            print(f"{k:34} {v['n']:5d} {v['success_rate']*100:6.1f} {v['p50_ms']:9.2f} {v['p95_ms']:9.2f} {v['p99_ms']:9.2f}  {st}")
+    print(f"\npeak RSS: {res['peak_rss_mb']} MB")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="qr.py render/decode micro-benchmarks")
+    ap.add_argument("--quick", action="store_true", help="fewer iterations, no 8/12MP inputs")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--iters", type=int, default=0, help="render iterations (default 200, quick 40)")
+    ap.add_argument("--per-class", type=int, default=0, help="decode samples per class (default 6, quick 2)")
+    ap.add_argument("--only", choices=("render", "decode"))
+    ap.add_argument("--out", help="write results JSON here")
+    ap.add_argument("--baseline", help="compare against a saved results JSON")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed latency regression (fraction)")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    args = ap.parse_args(argv)
+
+    iters = args.iters or (40 if args.quick else 200)
+    per_class = args.per_class or (2 if args.quick else 6)
+    res = dict(meta=dict(python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                         opencv=cv2.__version__, numpy=np.__version__, seed=args.seed, quick=args.quick,
+                         iters=iters, per_class=per_class, ts=time.strftime("%Y-%m-%dT%H:%M:%S")))
+    if args.only != "decode": res["render"] = bench_render(iters)
+    res["peak_rss_mb_render"] = peak_rss_mb()
+    if args.only != "render": res["decode"] = bench_decode(args.seed, per_class, args.quick)
+    res["peak_rss_mb"] = peak_rss_mb()
+    print_table(res)
+
+    if args.out:
+        with open(args.out, "w") as fh: json.dump(res, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh: base = json.load(fh)
+        rows, bad = compare(res, base, args.tolerance)
+        print(f"\nvs {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for name, old, new, delta, flag in rows:
+            print(f"  {'REGRESSION' if flag else 'ok':10} {name:60} {old:10.3f} -> {new:10.3f} ({delta:+.1%})")
+        if bad and args.fail_on_regression: return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
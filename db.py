@@ -0,0 +1,245 @@
+# db.py — طبقة SQLite لـ qr.py
+# - السكيمة تنعمل مرة وحدة لكل process (وقت إقلاع الـ worker) مو مع كل request
+# - اتصال واحد لكل thread يعاد استخدامه: WAL + synchronous=NORMAL + busy_timeout
+# - الاستعلامات المتكررة نصوص ثابتة هنا، فـ sqlite3 يحتفظ بالـ statement مجهّز (cached_statements)
+
+import os, sqlite3, threading, time
+import metrics
+from contextlib import contextmanager
+
+DB_PATH         = os.environ.get("QR_DB", "data/visitors.db").strip()
+BUSY_TIMEOUT_MS = int(os.environ.get("QR_DB_BUSY_TIMEOUT_MS", "5000"))
+CACHED_STMTS    = 256
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS visitors(
+         id TEXT PRIMARY KEY,
+         name TEXT NOT NULL,
+         company TEXT NOT NULL,
+         position TEXT NOT NULL,
+         email TEXT NOT NULL UNIQUE,
+         phone TEXT NOT NULL UNIQUE,
+         pin TEXT NOT NULL,
+         created_at TEXT NOT NULL,
+         wa_sent INTEGER DEFAULT 0,
+         wa_ts TEXT
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_visitors_created ON visitors(created_at, id)",
+    # عدّادات الداشبورد: total / day:YYYY-MM-DD / wa — تتحدث مع كل INSERT وتحديث wa_sent
+    "CREATE TABLE IF NOT EXISTS kpis(key TEXT PRIMARY KEY, n INTEGER NOT NULL DEFAULT 0)",
+    """CREATE TRIGGER IF NOT EXISTS trg_visitors_kpi_ins AFTER INSERT ON visitors BEGIN
+         INSERT INTO kpis(key,n) VALUES('total',1) ON CONFLICT(key) DO UPDATE SET n=n+1;
+         INSERT INTO kpis(key,n) VALUES('day:'||substr(NEW.created_at,1,10),1) ON CONFLICT(key) DO UPDATE SET n=n+1;
+         INSERT INTO kpis(key,n) VALUES('wa',NEW.wa_sent=1) ON CONFLICT(key) DO UPDATE SET n=n+excluded.n;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_visitors_kpi_wa AFTER UPDATE OF wa_sent ON visitors
+       WHEN (NEW.wa_sent=1) <> (OLD.wa_sent=1) BEGIN
+         INSERT INTO kpis(key,n) VALUES('wa',CASE WHEN NEW.wa_sent=1 THEN 1 ELSE -1 END)
+           ON CONFLICT(key) DO UPDATE SET n=n+excluded.n;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_visitors_kpi_del AFTER DELETE ON visitors BEGIN
+         UPDATE kpis SET n=n-1 WHERE key IN ('total','day:'||substr(OLD.created_at,1,10));
+         UPDATE kpis SET n=n-1 WHERE key='wa' AND OLD.wa_sent=1;
+       END""",
+    # طابور إرسال واتساب: pending -> sending (مع lease بـ next_at) -> sent / failed
+    """CREATE TABLE IF NOT EXISTS wa_jobs(
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         visitor_id TEXT NOT NULL,
+         dest TEXT NOT NULL,
+         name TEXT NOT NULL,
+         status TEXT NOT NULL DEFAULT 'pending',
+         attempts INTEGER NOT NULL DEFAULT 0,
+         next_at REAL NOT NULL,
+         last_error TEXT,
+         created_at TEXT NOT NULL,
+         updated_at TEXT NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_wa_jobs_due ON wa_jobs(status, next_at)",
+    "CREATE INDEX IF NOT EXISTS idx_wa_jobs_visitor ON wa_jobs(visitor_id, status)",
+    # مفاتيح idempotency للتسجيل (response ID من الفورم أو hash البيانات): الرد الأول يتخزن ويرجع نفسه مع الـ retry
+    """CREATE TABLE IF NOT EXISTS idempotency(
+         key TEXT PRIMARY KEY,
+         visitor_id TEXT NOT NULL,
+         result TEXT NOT NULL,
+         created_at TEXT NOT NULL
+       ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency(created_at)",
+    # سجل الدخول من البوابات (يوصل دفعات من الـ write-behind buffer بـ qr.py)
+    """CREATE TABLE IF NOT EXISTS checkins(
+         id INTEGER PRIMARY KEY,
+         visitor_id TEXT NOT NULL,
+         gate TEXT NOT NULL,
+         stage TEXT NOT NULL,
+         ts TEXT NOT NULL,
+         first INTEGER NOT NULL DEFAULT 0
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_checkins_visitor ON checkins(visitor_id)",
+    # عدّادات لكل (ساعة UTC بصيغة YYYY-MM-DDTHH، بوابة) تتحدث مع كل INSERT
+    """CREATE TABLE IF NOT EXISTS checkin_counts(
+         hour TEXT NOT NULL,
+         gate TEXT NOT NULL,
+         n INTEGER NOT NULL DEFAULT 0,
+         first_n INTEGER NOT NULL DEFAULT 0,
+         PRIMARY KEY(hour, gate)
+       ) WITHOUT ROWID""",
+    """CREATE TRIGGER IF NOT EXISTS trg_checkins_count AFTER INSERT ON checkins BEGIN
+         INSERT INTO checkin_counts(hour,gate,n,first_n) VALUES(substr(NEW.ts,1,13), NEW.gate, 1, NEW.first)
+           ON CONFLICT(hour,gate) DO UPDATE SET n=n+1, first_n=first_n+excluded.first_n;
+       END""",
+]
+
+def _backfill_kpis(con):
+    # قاعدة قديمة قبل جدول kpis: نحسب العدّادات مرة وحدة من visitors
+    if con.execute("SELECT 1 FROM kpis WHERE key='total'").fetchone(): return
+    con.execute("DELETE FROM kpis")
+    con.execute("INSERT INTO kpis(key,n) SELECT 'total', COUNT(*) FROM visitors")
+    con.execute("INSERT INTO kpis(key,n) SELECT 'wa', COUNT(*) FROM visitors WHERE wa_sent=1")
+    con.execute("""INSERT INTO kpis(key,n) SELECT 'day:'||substr(created_at,1,10), COUNT(*)
+                   FROM visitors GROUP BY substr(created_at,1,10)""")
+
+# ---------- Statements ----------
+SQL_VISITOR_LOOKUP  = "SELECT id,name,company,position FROM visitors WHERE id=?"
+SQL_VISITOR_CONTACT = "SELECT * FROM visitors WHERE email=? OR phone=?"
+SQL_VISITOR_INSERT  = """INSERT INTO visitors(id,name,company,position,email,phone,pin,created_at)
+                         VALUES(?,?,?,?,?,?,?,?)"""
+SQL_VISITOR_INSERT_IGNORE = SQL_VISITOR_INSERT.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+SQL_VISITOR_UPSERT  = SQL_VISITOR_INSERT + " ON CONFLICT DO NOTHING"
+SQL_VISITOR_IDS_AFTER = "SELECT rowid,id FROM visitors WHERE rowid>? ORDER BY rowid"
+SQL_VISITOR_SNAPSHOT_AFTER = "SELECT rowid,id,name,company,position FROM visitors WHERE rowid>? ORDER BY rowid"
+SQL_VISITOR_WA_SENT = "UPDATE visitors SET wa_sent=1, wa_ts=? WHERE id=?"
+SQL_WA_ENQUEUE      = """INSERT INTO wa_jobs(visitor_id,dest,name,status,next_at,created_at,updated_at)
+                         SELECT ?,?,?,'pending',?,?,? WHERE NOT EXISTS(
+                           SELECT 1 FROM wa_jobs WHERE visitor_id=? AND status IN ('pending','sending'))"""
+SQL_WA_DUE          = """SELECT id,visitor_id,dest,name,attempts FROM wa_jobs
+                         WHERE status IN ('pending','sending') AND next_at<=? ORDER BY next_at LIMIT 1"""
+SQL_WA_CLAIM        = """UPDATE wa_jobs SET status='sending', attempts=attempts+1, next_at=?, updated_at=?
+                         WHERE id=? AND status IN ('pending','sending') AND next_at<=?"""
+SQL_WA_DONE         = "UPDATE wa_jobs SET status='sent', last_error=NULL, updated_at=? WHERE id=?"
+SQL_WA_RETRY        = "UPDATE wa_jobs SET status=?, next_at=?, last_error=?, updated_at=? WHERE id=?"
+SQL_WA_STATS        = """SELECT status, COUNT(*) AS n, MIN(next_at) AS next_at, SUM(attempts>0) AS retrying
+                         FROM wa_jobs GROUP BY status"""
+SQL_WA_ERRORS       = """SELECT id,visitor_id,attempts,last_error,updated_at FROM wa_jobs
+                         WHERE last_error IS NOT NULL ORDER BY updated_at DESC LIMIT 10"""
+SQL_IDEM_GET        = "SELECT result FROM idempotency WHERE key=? AND created_at>=?"
+SQL_IDEM_PUT        = "INSERT OR REPLACE INTO idempotency(key,visitor_id,result,created_at) VALUES(?,?,?,?)"
+SQL_IDEM_PURGE      = "DELETE FROM idempotency WHERE created_at<?"
+SQL_CHECKIN_INSERT  = "INSERT INTO checkins(visitor_id,gate,stage,ts,first) VALUES(?,?,?,?,?)"
+SQL_CHECKIN_SEEN    = "SELECT 1 FROM checkins WHERE visitor_id=? LIMIT 1"
+SQL_CHECKIN_COUNTS  = """SELECT gate,hour,n,first_n FROM checkin_counts
+                         WHERE hour >= ? AND hour <= ? ORDER BY hour, gate"""
+SQL_KPIS            = "SELECT key,n FROM kpis WHERE key IN ('total','wa',?)"
+SQL_VISITORS_FIRST  = """SELECT id,name,company,position,created_at FROM visitors
+                         ORDER BY created_at DESC, id DESC LIMIT ?"""
+SQL_VISITORS_AFTER  = """SELECT id,name,company,position,created_at FROM visitors
+                         WHERE (created_at,id) < (?,?) ORDER BY created_at DESC, id DESC LIMIT ?"""
+
+# ---------- Connections ----------
+_local      = threading.local()
+_init_lock  = threading.Lock()
+_schema_pid = None
+
+def connect(path=None):
+    con = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT_MS/1000.0, isolation_level=None,
+                          check_same_thread=False, cached_statements=CACHED_STMTS)
+    con.row_factory = sqlite3.Row
+    con.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+def init(path=None):
+    # makedirs + WAL + CREATE TABLE مرة وحدة لكل process
+    global _schema_pid
+    if _schema_pid == os.getpid(): return
+    with _init_lock:
+        if _schema_pid == os.getpid(): return
+        p = path or DB_PATH
+        d = os.path.dirname(p)
+        if d: os.makedirs(d, exist_ok=True)
+        con = connect(p)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            with transaction(con):
+                for stmt in SCHEMA: con.execute(stmt)
+                _backfill_kpis(con)
+        finally:
+            con.close()
+        _schema_pid = os.getpid()
+
+def conn():
+    # اتصال الـ thread الحالي (يتجدد بعد fork)
+    con = getattr(_local, "con", None)
+    if con is None or getattr(_local, "pid", None) != os.getpid():
+        init()
+        con = _local.con = connect(); _local.pid = os.getpid()
+    return con
+
+@contextmanager
+def transaction(con=None):
+    # BEGIN IMMEDIATE: ناخذ قفل الكتابة من البداية بدل ما نترقى من قراءة (SQLITE_BUSY بدون انتظار)
+    con = con or conn()
+    t0 = time.perf_counter()
+    try: con.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        metrics.inc("qr_db_busy_total"); raise
+    metrics.observe("qr_db_lock_wait_seconds", time.perf_counter() - t0)   # انتظار قفل الكتابة (busy_timeout)
+    try:
+        yield con
+        con.execute("COMMIT")
+    except BaseException:
+        # COMMIT نفسه ممكن يفشل (busy): بدون ROLLBACK يبقى الاتصال داخل transaction ويفشل الـ BEGIN الجاي
+        if con.in_transaction: con.execute("ROLLBACK")
+        raise
+
+def row(sql, args=()):
+    return conn().execute(sql, args).fetchone()
+
+def rows(sql, args=()):
+    return conn().execute(sql, args).fetchall()
+
+def kpis(day):
+    got = {r["key"]: r["n"] for r in rows(SQL_KPIS, ("day:"+day,))}
+    return dict(total=got.get("total",0), today=got.get("day:"+day,0), wa=got.get("wa",0))
+
+def visitors_page(limit, after=None):
+    # keyset pagination على (created_at, id) — after = آخر (created_at, id) بالصفحة السابقة
+    if after: return [dict(r) for r in rows(SQL_VISITORS_AFTER, (after[0], after[1], limit))]
+    return [dict(r) for r in rows(SQL_VISITORS_FIRST, (limit,))]
+
+def iter_visitors(start="", end="", company="", ids=None, page=500):
+    # الزوار حسب الفلاتر بترتيب التسجيل، صفحة صفحة (keyset) بدل ما نحمّلهم كلهم بالذاكرة.
+    # end بصيغة تاريخ بس (YYYY-MM-DD) يشمل اليوم كامل.
+    where, args = [], []
+    if start:   where.append("created_at >= ?"); args.append(start)
+    if end:     where.append("created_at <= ?"); args.append(end + "\uffff")
+    if company: where.append("company = ? COLLATE NOCASE"); args.append(company)
+    cols = "SELECT id,name,company,position,created_at FROM visitors"
+    if ids:
+        ids = list(dict.fromkeys(ids))
+        for i in range(0, len(ids), page):
+            chunk = ids[i:i+page]
+            w = where + [f"id IN ({','.join('?'*len(chunk))})"]
+            yield from (dict(r) for r in rows(f"{cols} WHERE {' AND '.join(w)} ORDER BY created_at, id", args + chunk))
+        return
+    after = None
+    while True:
+        w = where + (["(created_at,id) > (?,?)"] if after else [])
+        q = f"{cols} {'WHERE ' + ' AND '.join(w) if w else ''} ORDER BY created_at, id LIMIT ?"
+        batch = rows(q, args + (list(after) if after else []) + [page])
+        yield from (dict(r) for r in batch)
+        if len(batch) < page: return
+        after = (batch[-1]["created_at"], batch[-1]["id"])
+
+def visitors_by_ids(ids):
+    # استعلام واحد (IN) لكل الـ IDs؛ SQLite يسمح بـ 32766 متغيّر من 3.32
+    ids = list(ids)
+    if not ids: return []
+    return rows(f"SELECT id,name,company,position FROM visitors WHERE id IN ({','.join('?'*len(ids))})", ids)
+
+def checkin_counts(day):
+    # يوم واحد (UTC): الدخول الكلي وأول دخول، لكل بوابة ولكل ساعة
+    gates, hours = {}, {}
+    for r in rows(SQL_CHECKIN_COUNTS, (day + "T00", day + "T23")):
+        for bucket, k in ((gates, r["gate"]), (hours, r["hour"][11:13])):
+            c = bucket.setdefault(k, dict(n=0, first=0)); c["n"] += r["n"]; c["first"] += r["first_n"]
+    return dict(day=day, total=sum(c["n"] for c in gates.values()),
+                first=sum(c["first"] for c in gates.values()), gates=gates, hours=hours)
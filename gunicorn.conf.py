@@ -0,0 +1,28 @@
+# gunicorn.conf.py — التطبيق يتحمّل ويتسخن بالـ master قبل الـ fork (preload_app)، فالـ workers
+# يشاركون الخط واللوغو وقالب الباج ومكتبات القراءة copy-on-write بدل ما كل واحد يبنيها.
+#   QR_ROLE=all|web|decode  gunicorn -c gunicorn.conf.py "qr:create_app()"
+# pool منفصل لكل دور (كل واحد بحجمه): شغّل نسختين بـ QR_ROLE و WEB_CONCURRENCY و PORT مختلفين.
+import os
+
+bind         = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+workers      = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads      = int(os.environ.get("GUNICORN_THREADS", "4"))   # واحد منها على الأقل للمسارات الخفيفة (ADMIT_RESERVED)
+preload_app  = True
+
+def when_ready(server):
+    import qr
+    t = qr.warm()
+    server.log.info("qr ready: role=%s import=%.3fs warm=%.3fs memory=%s",
+                    qr.APP_ROLE, t["import"], t["warm"], qr.process_memory())
+
+def post_worker_init(worker):
+    import qr
+    worker.log.info("qr worker %s: memory=%s", worker.pid, qr.process_memory())
+
+def worker_exit(server, worker):
+    # سجل الدخول write-behind: نكتب الباقي قبل ما يطلع الـ worker، وآخر أرقام الـ metrics لملفه
+    # (ينطوي بـ dead.json أول ما /metrics يشوفه ميت)
+    import qr
+    qr.checkin_log.close()
+    qr.metrics.flush()
@@ -0,0 +1,330 @@
+# loadtest.py — حمل على مستوى الـ routes ضد نسخة محلية من التطبيق (gunicorn بنفس gunicorn.conf.py)
+#   python loadtest.py                                 # يشغّل gunicorn (2 workers، gthread) + واتساب وهمي، 30 ثانية
+#   python loadtest.py --rate 60 --concurrency 32      # open loop: وصول Poisson بمعدل 60 طلب/ثانية
+#   python loadtest.py --rate 0 --concurrency 16       # closed loop: كل عميل يرسل ورا الثاني
+#   python loadtest.py --mix forms=5,qr=3,decode=1 --out r.json
+#   python loadtest.py --baseline r.json --fail-on-regression
+#   python loadtest.py --url http://127.0.0.1:10000    # ضد نسخة شغّالة (الواتساب والـ env عليك)
+#
+# الخليط: تسجيلات /forms/google (جزء منها retry بنفس responseId)، الداشبورد /، صور /qr و /card،
+# /lookup، ورفع صور باجات مولّدة (دوران، perspective، JPEG) لـ /decode و /decode_badge.
+# الزمن بالـ open loop من الموعد المجدول مو من بداية الإرسال (ما نخفي الطابور). انتظار قفل SQLite
+# من /metrics (qr_db_lock_wait_seconds) قبل وبعد التشغيل.
+
+import os, sys, json, time, random, argparse, tempfile, threading, subprocess, socket, re, shutil, platform
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import bench
+import qr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MIX = "forms=3,index=1,qr=4,card=2,lookup=2,decode=2,decode_badge=1"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+# ---------- WhatsApp stand-in ----------
+class WaStub:
+    # يستقبل نفس POST اللي يرسله _wa_send ويعد الرسائل لكل رقم (التكرار = رسالة مكررة لنفس الشخص)
+    def __init__(self, delay_s=0.05, fail_rate=0.0):
+        self.delay_s, self.fail_rate = delay_s, fail_rate
+        self.lock, self.by_dest, self.failed = threading.Lock(), {}, 0
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                m = re.search(rb'name="to"\r\n\r\n(.*?)\r\n', body)
+                time.sleep(stub.delay_s)
+                if random.random() < stub.fail_rate:
+                    with stub.lock: stub.failed += 1
+                    self.send_response(503); self.end_headers(); return
+                with stub.lock:
+                    k = m.group(1).decode() if m else ""
+                    stub.by_dest[k] = stub.by_dest.get(k, 0) + 1
+                self.send_response(200); self.send_header("Content-Type", "application/json"); self.end_headers()
+                self.wfile.write(b'{"ok":true}')
+            def log_message(self, *a): pass
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/send"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            sent = sum(self.by_dest.values())
+            return dict(sent=sent, recipients=len(self.by_dest), duplicates=sent - len(self.by_dest), failed=self.failed)
+
+    def close(self): self.httpd.shutdown()
+
+# ---------- App under test ----------
+class Server:
+    def __init__(self, workdir, port, env):
+        self.port, self.log = port, open(os.path.join(workdir, "gunicorn.log"), "wb")
+        self.proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "qr:create_app()"],
+                                     cwd=HERE, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=90):
+        t_end = time.time() + timeout
+        while time.time() < t_end:
+            if self.proc.poll() is not None: raise RuntimeError(f"gunicorn exited ({self.proc.returncode}), see {self.log.name}")
+            try:
+                c = http.client.HTTPConnection("127.0.0.1", self.port, timeout=2)
+                c.request("GET", "/admission/stats"); c.getresponse().read(); c.close(); return
+            except OSError: time.sleep(0.3)
+        raise RuntimeError("gunicorn did not become ready")
+
+    def stop(self):
+        self.proc.terminate()
+        try: self.proc.wait(30)
+        except subprocess.TimeoutExpired: self.proc.kill()
+        self.log.close()
+
+# ---------- Client ----------
+class Client:
+    # اتصال keep-alive لكل thread
+    def __init__(self, base):
+        u = urlsplit(base); self.host, self.port = u.hostname, u.port or 80
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in (0, 1):
+            c = getattr(self.local, "c", None)
+            if c is None: c = self.local.c = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                c.request(method, path, body=body, headers=headers or {})
+                r = c.getresponse(); data = r.read()
+                if r.getheader("Connection", "").lower() == "close": c.close(); self.local.c = None
+                return r.status, data
+            except (http.client.HTTPException, OSError):
+                c.close(); self.local.c = None
+                if attempt: raise
+
+# ---------- Workload ----------
+def forms_payload(i, tag):
+    nv = {"Name": [f"Load Visitor {i}"], "Company": ["Load Co"], "Position": ["Tester"],
+          "Email": [f"load{tag}_{i}@example.com"], "Phone": [f"+9665{tag % 100:02d}{i:07d}"]}
+    return {"namedValues": nv, "responseId": f"lt-{tag}-{i}"}
+
+def badge_photos(ids, n, seed):
+    # صور JPEG لباجات زوار حقيقيين (من التسجيلات) بتشويهات bench.py
+    rng, out = np.random.default_rng(seed), []
+    for k in range(n):
+        vid = ids[k % len(ids)]
+        b = bench.to_bgr(qr.make_badge_png(f"Load Visitor {k}", "Load Co", "Tester", vid).getvalue())
+        img = bench.place(b, (1280, 960), rng)
+        if k % 3 == 1: img = bench.rotate(img, float(rng.choice([-20, 15, 90])))
+        if k % 3 == 2: img = bench.perspective(img, rng)
+        out.append(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+    return out
+
+class Workload:
+    def __init__(self, ids, photos, tag, retry_frac, seed):
+        self.ids, self.photos, self.tag, self.retry_frac = ids, photos, tag, retry_frac
+        self.rng, self.lock, self.n = random.Random(seed), threading.Lock(), 1_000_000
+
+    def make(self, route):
+        # (method, path, body, headers)
+        with self.lock:
+            rng = self.rng
+            vid = rng.choice(self.ids)
+            if route == "forms":
+                retry = self.n > 1_000_000 and rng.random() < self.retry_frac
+                i = rng.randrange(1_000_000, self.n) if retry else self.n
+                if not retry: self.n += 1
+            photo = rng.choice(self.photos) if self.photos else b""
+        if route == "forms":
+            return "POST", "/forms/google", json.dumps(forms_payload(i, self.tag)), {"Content-Type": "application/json"}
+        if route == "index":  return "GET", "/", None, {}
+        if route == "qr":     return "GET", f"/qr/{vid}.png", None, {}
+        if route == "card":   return "GET", f"/card/{vid}.png", None, {}
+        if route == "lookup": return "GET", f"/lookup/{vid}.json?checkin=0", None, {}
+        if route == "decode": return "POST", "/decode", photo, {"Content-Type": "image/jpeg"}
+        if route == "decode_badge": return "POST", "/decode_badge?checkin=0", photo, {"Content-Type": "image/jpeg"}
+        raise ValueError(route)
+
+ROUTES = ("forms", "index", "qr", "card", "lookup", "decode", "decode_badge")
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        k, _, v = part.partition("=")
+        k = k.strip()
+        if k not in ROUTES: raise SystemExit(f"unknown route {k!r} (expected {', '.join(ROUTES)})")
+        mix[k] = float(v or 1)
+    return {k: v for k, v in mix.items() if v > 0}
+
+def register_visitors(client, n, tag, concurrency):
+    # تسجيلات أولية عشان الصور والـ lookups يكون لها زوار حقيقيين
+    def one(i):
+        st, data = client.request("POST", "/forms/google", json.dumps(forms_payload(i, tag)), {"Content-Type": "application/json"})
+        return json.loads(data)["id"] if st == 200 else None
+    with ThreadPoolExecutor(concurrency) as ex: ids = [v for v in ex.map(one, range(n)) if v]
+    if not ids: raise SystemExit("registration failed — is the app up?")
+    return ids
+
+def run(client, workload, mix, duration, rate, concurrency, seed):
+    # [(route, status, latency_s, t_end)]
+    routes, weights = list(mix), list(mix.values())
+    rng, results, lock = random.Random(seed), [], threading.Lock()
+    def fire(route, t_sched):
+        method, path, body, headers = workload.make(route)
+        try: status, _ = client.request(method, path, body, headers)
+        except Exception: status = 0
+        t = time.perf_counter()
+        with lock: results.append((route, status, t - t_sched, t))
+    t0 = time.perf_counter(); t_end = t0 + duration
+    if rate > 0:
+        # open loop: المواعيد ثابتة مهما تأخر السيرفر؛ الـ pool هو سقف الاتصالات المفتوحة
+        with ThreadPoolExecutor(concurrency) as ex:
+            t = t0
+            while True:
+                t += rng.expovariate(rate)
+                if t >= t_end: break
+                delay = t - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+                ex.submit(fire, rng.choices(routes, weights)[0], t)
+    else:
+        def loop(k):
+            r = random.Random(seed + k)
+            while time.perf_counter() < t_end: fire(r.choices(routes, weights)[0], time.perf_counter())
+        ts = [threading.Thread(target=loop, args=(k,)) for k in range(concurrency)]
+        for th in ts: th.start()
+        for th in ts: th.join()
+    return results, time.perf_counter() - t0
+
+# ---------- Server-side metrics ----------
+def scrape(client):
+    st, data = client.request("GET", "/metrics")
+    return data.decode() if st == 200 else ""
+
+def histogram(text, name):
+    # {le: count} + sum/count مجموعة على كل الـ labels
+    buckets, total, n = {}, 0.0, 0
+    for ln in text.splitlines():
+        if ln.startswith(name + "_bucket"):
+            le = re.search(r'le="([^"]+)"', ln).group(1)
+            buckets[le] = buckets.get(le, 0) + float(ln.rsplit(" ", 1)[1])
+        elif ln.startswith(name + "_sum"): total += float(ln.rsplit(" ", 1)[1])
+        elif ln.startswith(name + "_count"): n += int(float(ln.rsplit(" ", 1)[1]))
+    return buckets, total, n
+
+def counter(text, name):
+    return sum(float(ln.rsplit(" ", 1)[1]) for ln in text.splitlines() if ln.startswith(name + "{") or ln.startswith(name + " "))
+
+def lock_waits(before, after):
+    b0, s0, n0 = histogram(before, "qr_db_lock_wait_seconds")
+    b1, s1, n1 = histogram(after, "qr_db_lock_wait_seconds")
+    n = n1 - n0
+    cum = sorted(((float("inf") if le == "+Inf" else float(le), c - b0.get(le, 0)) for le, c in b1.items()))
+    def q(p):
+        # الحد الأعلى للـ bucket اللي فيه الـ percentile
+        for le, c in cum:
+            if c >= p * n: return round(le * 1000, 3) if le != float("inf") else None
+        return None
+    return dict(transactions=n, mean_ms=round(1000 * (s1 - s0) / n, 3) if n else 0.0,
+                p95_le_ms=q(0.95) if n else 0.0, p99_le_ms=q(0.99) if n else 0.0,
+                busy_errors=int(counter(after, "qr_db_busy_total") - counter(before, "qr_db_busy_total")),
+                shed=int(counter(after, "qr_admission_shed_total") - counter(before, "qr_admission_shed_total")))
+
+# ---------- Report ----------
+def summarize(results, elapsed):
+    by = {}
+    for route, status, lat, _ in results: by.setdefault(route, []).append((status, lat))
+    def one(items):
+        ms = [lat * 1000 for _, lat in items]
+        ok = sum(1 for st, _ in items if 200 <= st < 400 or st == 404)   # 404 = ما انقرا / مو موجود: رد طبيعي
+        shed = sum(1 for st, _ in items if st == 503)
+        return dict(n=len(items), rps=round(len(items) / elapsed, 2), p50_ms=round(bench.pct(ms, 50), 2),
+                    p95_ms=round(bench.pct(ms, 95), 2), p99_ms=round(bench.pct(ms, 99), 2),
+                    errors=len(items) - ok - shed, shed=shed, success_rate=round(ok / len(items), 4) if items else 0.0)
+    routes = {r: one(v) for r, v in sorted(by.items())}
+    return routes, one([(st, lat) for _, st, lat, _ in results])
+
+def print_table(res):
+    print(f"{'route':14} {'n':>7} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'err':>6} {'503':>6}")
+    for k, v in list(res["routes"].items()) + [("overall", res["overall"])]:
+        print(f"{k:14} {v['n']:7d} {v['rps']:8.1f} {v['p50_ms']:9.1f} {v['p95_ms']:9.1f} {v['p99_ms']:9.1f} {v['errors']:6d} {v['shed']:6d}")
+    lw = res.get("sqlite")
+    if lw: print(f"\nsqlite write lock: {lw['transactions']} tx, mean {lw['mean_ms']} ms, p95 <= {lw['p95_le_ms']} ms, "
+                 f"p99 <= {lw['p99_le_ms']} ms, busy errors {lw['busy_errors']}; admission shed {lw['shed']}")
+    if res.get("whatsapp"): print(f"whatsapp stub: {res['whatsapp']}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="qr.py route-level load test")
+    ap.add_argument("--url", help="test a running instance instead of starting gunicorn")
+    ap.add_argument("--duration", type=float, default=30.0, help="seconds")
+    ap.add_argument("--rate", type=float, default=40.0, help="arrivals per second (0 = closed loop)")
+    ap.add_argument("--concurrency", type=int, default=16, help="max in-flight requests / closed-loop clients")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help=f"route=weight,... from {', '.join(ROUTES)}")
+    ap.add_argument("--visitors", type=int, default=200, help="registrations before the run")
+    ap.add_argument("--photos", type=int, default=24, help="generated badge photos for the decode routes")
+    ap.add_argument("--retry-frac", type=float, default=0.1, help="share of webhook posts that replay an earlier responseId")
+    ap.add_argument("--workers", type=int, default=2, help="gunicorn workers (WEB_CONCURRENCY)")
+    ap.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker (GUNICORN_THREADS)")
+    ap.add_argument("--role", default="all", choices=("all", "web", "decode"))
+    ap.add_argument("--wa-delay-ms", type=float, default=50.0)
+    ap.add_argument("--wa-fail-rate", type=float, default=0.0)
+    ap.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the server (repeatable)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--keep", action="store_true", help="keep the temp dir (db, gunicorn.log)")
+    ap.add_argument("--out", help="write results JSON here")
+    ap.add_argument("--baseline", help="compare against a saved results JSON")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="allowed latency regression (fraction)")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    args = ap.parse_args(argv)
+
+    mix, tag = parse_mix(args.mix), int(time.time()) % 100000
+    workdir = tempfile.mkdtemp(prefix="qr_load_")
+    server = stub = None
+    try:
+        if args.url:
+            base = args.url.rstrip("/")
+        else:
+            stub, port = WaStub(args.wa_delay_ms / 1000.0, args.wa_fail_rate), free_port()
+            env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads),
+                       QR_ROLE=args.role, QR_DB=os.path.join(workdir, "visitors.db"), METRICS="1",
+                       METRICS_DIR=os.path.join(workdir, "metrics"), WA_PROXY_URL=stub.url, WA_BACKOFF_S="1")
+            env.update(kv.split("=", 1) for kv in args.env)
+            server = Server(workdir, port, env); server.wait_ready()
+            base = f"http://127.0.0.1:{port}"
+        client = Client(base)
+        ids = register_visitors(client, args.visitors, tag, args.concurrency)
+        photos = badge_photos(ids, args.photos, args.seed) if {"decode", "decode_badge"} & set(mix) else []
+        before = scrape(client)
+        results, elapsed = run(client, Workload(ids, photos, tag, args.retry_frac, args.seed), mix,
+                               args.duration, args.rate, args.concurrency, args.seed)
+        time.sleep(1.0)   # الـ workers يكتبون الـ metrics كل METRICS_FLUSH_S
+        after = scrape(client)
+        routes, overall = summarize(results, elapsed)
+        res = dict(meta=dict(python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                             url=args.url or "", workers=args.workers, threads=args.threads, role=args.role,
+                             duration=args.duration, rate=args.rate, concurrency=args.concurrency, mix=mix,
+                             visitors=len(ids), seed=args.seed, ts=time.strftime("%Y-%m-%dT%H:%M:%S")),
+                   routes=routes, overall=overall, sqlite=lock_waits(before, after) if after else None)
+        if stub:
+            time.sleep(args.wa_delay_ms / 1000.0 + 1.0)   # آخر رسائل الطابور
+            res["whatsapp"] = stub.stats()
+    finally:
+        if server: server.stop()
+        if stub: stub.close()
+        if args.keep: print(f"kept {workdir}")
+        else: shutil.rmtree(workdir, ignore_errors=True)
+    print_table(res)
+
+    if args.out:
+        with open(args.out, "w") as fh: json.dump(res, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh: base_res = json.load(fh)
+        rows, bad = bench.compare(res, base_res, args.tolerance, sections=("routes", "overall"))
+        print(f"\nvs {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for name, old, new, delta, flag in rows:
+            print(f"  {'REGRESSION' if flag else 'ok':10} {name:40} {old:10.3f} -> {new:10.3f} ({delta:+.1%})")
+        if bad and args.fail_on_regression: return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+# metrics.py — عدّادات و histograms خفيفة بصيغة Prometheus لـ qr.py
+# - كل process يجمع بالذاكرة، وthread بالخلفية يكتب نسخة JSON كل METRICS_FLUSH_S في METRICS_DIR/<pid>.json
+# - /metrics يجمع ملفات كل الـ workers الحيّة + dead.json: عدّادات و histograms الـ workers الميتة تنضاف له
+#   قبل ما ينحذف ملفهم (مثل multiprocess mode بـ prometheus_client)، فالعدّاد ما يرجع لورا مع كل restart.
+#   الـ gauges حقت الميت تنرمى
+# - المجلد الافتراضي لكل نسخة (QR_ROLE + PORT): نسخة web ونسخة decode على نفس الجهاز ما يختلطون
+# - METRICS=0: كل الدوال ترجع فوراً و timer() يرجع context manager فاضي مشترك
+
+import os, json, time, threading, tempfile, atexit
+try: import fcntl
+except ImportError: fcntl = None
+
+ENABLED  = os.environ.get("METRICS", "1").lower() not in ("0","false","no")
+DIR      = (os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "qr_metrics_{}_{}".format(
+            (os.environ.get("QR_ROLE") or "all").strip().lower(), os.environ.get("PORT") or "10000"))).strip()
+DEAD     = "dead.json"
+FLUSH_S  = float(os.environ.get("METRICS_FLUSH_S", "2"))
+BUCKETS  = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock   = threading.Lock()
+_data   = {"counter": {}, "gauge": {}, "histogram": {}}
+_help   = {}
+_dirty  = False
+_pid    = None
+_owned  = None   # الـ process اللي ملف <pid>.json حقه (بعد ما نطوي أي ملف قديم بنفس الرقم)
+_collectors = []
+
+def collector(fn):
+    # fn() تنادى قبل كل flush (مثلاً gauges الذاكرة)
+    _collectors.append(fn); return fn
+
+def describe(name, kind, text):
+    _help[name] = (kind, text)
+
+def _key(name, labels):
+    return name + "|" + ",".join(f"{k}={v}" for k,v in sorted(labels.items())) if labels else name + "|"
+
+def inc(name, v=1, **labels):
+    global _dirty
+    if not ENABLED: return
+    k = _key(name, labels)
+    with _lock:
+        c = _data["counter"]; c[k] = c.get(k, 0) + v; _dirty = True
+    _ensure_flusher()
+
+def set_gauge(name, v, **labels):
+    # gauges لكل process (label pid) — ما تنجمع
+    global _dirty
+    if not ENABLED: return
+    labels["pid"] = os.getpid()
+    with _lock:
+        _data["gauge"][_key(name, labels)] = v; _dirty = True
+    _ensure_flusher()
+
+def observe(name, seconds, **labels):
+    global _dirty
+    if not ENABLED: return
+    k = _key(name, labels)
+    with _lock:
+        h = _data["histogram"].get(k)
+        if h is None: h = _data["histogram"][k] = [0]*(len(BUCKETS)+1) + [0.0]   # buckets..., +Inf, sum
+        for i,b in enumerate(BUCKETS):
+            if seconds <= b: h[i] += 1; break
+        else: h[len(BUCKETS)] += 1
+        h[-1] += seconds; _dirty = True
+    _ensure_flusher()
+
+class _Noop:
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+_NOOP = _Noop()
+
+class _Timer:
+    __slots__ = ("name", "labels", "t0")
+    def __init__(self, name, labels): self.name, self.labels = name, labels
+    def __enter__(self): self.t0 = time.perf_counter(); return self
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.t0, **self.labels); return False
+
+def timer(name, **labels):
+    return _Timer(name, labels) if ENABLED else _NOOP
+
+# ---------- Per-process snapshot ----------
+def _path(pid): return os.path.join(DIR, f"{pid}.json")
+
+def flush():
+    global _dirty, _owned
+    if not ENABLED: return
+    if _owned != os.getpid():
+        # ملف بنفس الـ pid من process ميت قبلنا (pid انعاد استخدامه): نحفظ أرقامه قبل ما نكتب فوقه
+        _owned = os.getpid()
+        if os.path.exists(_path(_owned)): _fold([_path(_owned)])
+    for fn in _collectors:
+        try: fn()
+        except Exception: pass
+    with _lock:
+        if not _dirty: return
+        snap = json.dumps({"help": _help, **_data}); _dirty = False
+    os.makedirs(DIR, exist_ok=True)
+    tmp = _path(os.getpid()) + ".tmp"
+    with open(tmp, "w") as fh: fh.write(snap)
+    os.replace(tmp, _path(os.getpid()))
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_S)
+        try: flush()
+        except OSError: pass
+
+def _ensure_flusher():
+    # thread واحد لكل process
+    global _pid, _dirty
+    if _pid == os.getpid(): return
+    with _lock:
+        if _pid == os.getpid(): return
+        _pid = os.getpid(); _dirty = True
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+def _after_fork():
+    # الـ worker ما يرث أرقام الـ master ولا قفل ممكن يكون ماسكه thread الـ flush وقت الـ fork
+    global _lock, _pid, _dirty
+    _lock, _pid, _dirty = threading.Lock(), None, False
+    for v in _data.values(): v.clear()
+
+if hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=_after_fork)
+
+def _exit_flush():
+    # آخر الزيادات (بعد آخر flush دوري) تنكتب قبل ما يطلع الـ process، عشان تنطوي بـ dead.json
+    try: flush()
+    except OSError: pass
+atexit.register(_exit_flush)
+
+def _alive(pid):
+    try: os.kill(pid, 0); return True
+    except ProcessLookupError: return False
+    except PermissionError: return True
+
+# ---------- Exposition ----------
+def _labels(k, extra=None):
+    name, _, raw = k.partition("|")
+    pairs = [p.split("=", 1) for p in raw.split(",") if p] + (extra or [])
+    if not pairs: return name, ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return name, "{" + ",".join(f'{a}="{esc(b)}"' for a,b in pairs) + "}"
+
+def _load(path):
+    try:
+        with open(path) as fh: return json.load(fh)
+    except (OSError, ValueError): return None
+
+def _merge(into, d, gauges=True):
+    for k,v in d.get("counter", {}).items(): into["counter"][k] = into["counter"].get(k, 0) + v
+    if gauges: into["gauge"].update(d.get("gauge", {}))
+    for k,v in d.get("histogram", {}).items():
+        h = into["histogram"].get(k)
+        into["histogram"][k] = v[:] if h is None else [a+b for a,b in zip(h, v)]
+
+def _fold(paths):
+    # ملفات processes ميتة -> dead.json (بدون gauges)، وبعدين تنحذف. قفل على المجلد عشان worker ثاني
+    # يجمع بنفس اللحظة ما يطويها مرتين؛ اللي ما قدر ياخذ القفل يتجاهلها هالمرة
+    os.makedirs(DIR, exist_ok=True)
+    with open(os.path.join(DIR, ".lock"), "a") as lk:
+        if fcntl: fcntl.flock(lk, fcntl.LOCK_EX)
+        dead = _load(os.path.join(DIR, DEAD)) or {"help": {}, "counter": {}, "gauge": {}, "histogram": {}}
+        done = []
+        for p in paths:
+            d = _load(p)
+            if d is None:
+                if os.path.exists(p): continue   # ملف ما نقدر نقراه الحين: نحاول المرة الجاية
+            else:
+                dead["help"].update(d.get("help", {})); _merge(dead, d, gauges=False)
+            done.append(p)
+        if not done: return
+        tmp = os.path.join(DIR, f"{DEAD}.{os.getpid()}.tmp")
+        with open(tmp, "w") as fh: json.dump(dead, fh)
+        os.replace(tmp, os.path.join(DIR, DEAD))
+        for p in done:
+            try: os.remove(p)
+            except OSError: pass
+
+def collect():
+    # يجمع ملفات الـ workers الحيّة + dead.json (بعد ما يطوي فيه ملفات الميتين)
+    flush()
+    merged, help_ = {"counter": {}, "gauge": {}, "histogram": {}}, dict(_help)
+    try: files = os.listdir(DIR)
+    except OSError: files = []
+    live, dead = [], []
+    for fn in files:
+        if not fn.endswith(".json") or fn == DEAD: continue
+        try: pid = int(fn[:-5])
+        except ValueError: continue
+        (live if _alive(pid) else dead).append(os.path.join(DIR, fn))
+    if dead: _fold(dead)
+    for path in live + [os.path.join(DIR, DEAD)]:
+        d = _load(path)
+        if d is None: continue
+        help_.update({k: tuple(v) for k,v in d.get("help", {}).items()})
+        _merge(merged, d)
+    return merged, help_
+
+def render():
+    merged, help_ = collect()
+    out, seen = [], set()
+    def head(name, kind):
+        if name in seen: return
+        seen.add(name)
+        if name in help_: out.append(f"# HELP {name} {help_[name][1]}")
+        out.append(f"# TYPE {name} {kind}")
+    for k in sorted(merged["counter"]):
+        name, lab = _labels(k); head(name, "counter"); out.append(f"{name}{lab} {merged['counter'][k]}")
+    for k in sorted(merged["gauge"]):
+        name, lab = _labels(k); head(name, "gauge"); out.append(f"{name}{lab} {merged['gauge'][k]}")
+    for k in sorted(merged["histogram"]):
+        h = merged["histogram"][k]; name, _ = _labels(k); head(name, "histogram")
+        acc = 0
+        for b, n in zip(list(BUCKETS) + ["+Inf"], h[:-1]):
+            acc += n; out.append(f"{name}_bucket{_labels(k, [('le', b)])[1]} {acc}")
+        out.append(f"{name}_sum{_labels(k)[1]} {h[-1]:.6f}")
+        out.append(f"{name}_count{_labels(k)[1]} {acc}")
+    return "\n".join(out) + "\n"
@@ -4,14 +4,40 @@
 # - زيادة حجم الخط إلى 64 وتفعيل استخدام خط مخصص عبر BADGE_FONT_PATH
 # - صفحات رفع للّوغو والخط إلى الديسك (Render)
 
-import os, io, sqlite3, string, secrets, base64, mimetypes, json
+import os, io, sys, csv, argparse, tempfile, zlib, string, secrets, base64, mimetypes, json, hashlib, shutil, threading, html, zipfile, multiprocessing, struct, time, random, importlib, binascii, mmap, atexit, re, math, sqlite3
+BOOT_T0 = time.perf_counter()
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
+from functools import lru_cache, wraps
+from contextlib import contextmanager
 from datetime import datetime, date
-from flask import Flask, request, jsonify, send_file, render_template_string, make_response, redirect, url_for
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, current_app, request, jsonify, send_file, render_template_string, make_response, redirect, url_for, stream_with_context
+from werkzeug.formparser import parse_form_data
+from werkzeug.wsgi import get_input_stream
+from PIL import Image, ImageDraw, ImageFont, features
 import qrcode
-import cv2
 import numpy as np
-from pyzbar import pyzbar
+import db
+import metrics
+import snapshot
+
+# مكتبات القراءة (OpenCV + zbar) تتحمّل أول ما نحتاجها: worker الويب/الفورمز ما يدفع
+# وقتها ولا ذاكرتها، والـ master يحمّلها قبل الـ fork بـ warm() لما الدور يحتاجها.
+class _LazyModule:
+    def __init__(self, name, alias): self._name, self._alias = name, alias
+    def _load(self):
+        mod = importlib.import_module(self._name)
+        globals()[self._alias] = mod   # بعدها الوصول مباشر للموديول بدون الـ proxy
+        return mod
+    def __getattr__(self, attr): return getattr(self._load(), attr)
+
+cv2    = _LazyModule("cv2", "cv2")
+pyzbar = _LazyModule("pyzbar.pyzbar", "pyzbar")
+
+def load_decoders():
+    for alias in ("cv2", "pyzbar"):
+        m = globals()[alias]
+        if isinstance(m, _LazyModule): m._load()
 
 # اختياري: requests للبروكسي
 try:
@@ -20,7 +46,7 @@ except Exception:
     requests = None
 
 APP_TITLE = "Visitor QR"
-DB_PATH   = os.environ.get("QR_DB", "data/visitors.db").strip()
+DB_PATH   = db.DB_PATH
 GF_SHARED_SECRET = os.environ.get("GF_SHARED_SECRET", "").strip()
 
 # ---------- Badge & font config ----------
@@ -43,46 +69,222 @@ QR_BORDER     = int(os.environ.get("BADGE_QR_BORDER", "1"))
 
 # واتساب بروكسي (يرسل صورة)
 WA_PROXY_URL      = (os.environ.get("WA_PROXY_URL") or "").strip()
+# طابور الإرسال: workers بالخلفية + retries بـ backoff + حد معدل لكل رقم مستلم.
+# الحد لكل process (token bucket بالذاكرة): رقم تتوزع رسايله على N workers يوصله لحد WA_RATE_PER_S × N
+WA_WORKERS        = int(os.environ.get("WA_WORKERS", "2"))
+WA_TIMEOUT_S      = float(os.environ.get("WA_TIMEOUT_S", "60"))
+WA_MAX_ATTEMPTS   = int(os.environ.get("WA_MAX_ATTEMPTS", "8"))
+WA_BACKOFF_S      = float(os.environ.get("WA_BACKOFF_S", "5"))
+WA_BACKOFF_MAX_S  = float(os.environ.get("WA_BACKOFF_MAX_S", "900"))
+WA_RATE_PER_S     = float(os.environ.get("WA_RATE_PER_S", "5"))
+WA_RATE_BURST     = int(os.environ.get("WA_RATE_BURST", "10"))
+WA_POLL_S         = float(os.environ.get("WA_POLL_S", "2"))
+WA_RATE_DESTS     = int(os.environ.get("WA_RATE_DESTS", "10000"))   # buckets محفوظة (الأقدم استخدام ينشال)
+WA_LEASE_S        = WA_TIMEOUT_S * 2
+
+# سجل الدخول: الـ request يضيف للذاكرة ويرجع، وthread يكتب دفعات (حجم أو وقت) بـ transaction وحدة
+CHECKIN_BATCH       = int(os.environ.get("CHECKIN_BATCH", "200"))
+CHECKIN_FLUSH_S     = float(os.environ.get("CHECKIN_FLUSH_MS", "500")) / 1000.0
+CHECKIN_MAX_BUFFER  = int(os.environ.get("CHECKIN_MAX_BUFFER", "100000"))
+CHECKIN_SEEN_MAX    = int(os.environ.get("CHECKIN_SEEN_MAX", "50000"))   # IDs دخلت قبل، بذاكرة كل worker
+CHECKIN_GATE_HEADER = os.environ.get("CHECKIN_GATE_HEADER", "X-Gate-Id").strip()
+
+# كاش الزوار لمسارات السكان (id -> name/company/position) + Bloom filter للـ IDs اللي مستحيل تكون موجودة
+REGISTRY_CACHE_SIZE = int(os.environ.get("REGISTRY_CACHE_SIZE", "20000"))
+REGISTRY_BLOOM_FP   = float(os.environ.get("REGISTRY_BLOOM_FP", "0.01"))
+REGISTRY_ID_PATTERN = os.environ.get("REGISTRY_ID_PATTERN", r"^ajz_[a-z0-9]{10}$").strip()   # شكل rand_token؛ فاضي = بدون فحص
+REGISTRY_SYNC_S     = float(os.environ.get("REGISTRY_SYNC_MS", "1000")) / 1000.0   # أقصى تأخير لتسجيل من worker ثاني
+# عقدة قراءة فقط (QR_ROLE=decode عند البوابات): الزوار من ملفات snapshot.py بهذا المجلد بدل SQLite.
+# الدخول (check-ins) يبقى بقاعدة QR_DB المحلية للعقدة
+REGISTRY_SNAPSHOT   = (os.environ.get("REGISTRY_SNAPSHOT") or "").strip()
+
+# حد التزامن للمسارات الثقيلة (قراءة QR، رسم صور مش بالكاش) لكل worker: طابور قصير وبعده 503 + Retry-After.
+# ADMIT_RESERVED من threads الـ worker ما تاخذها المسارات الثقيلة أبداً (lookup/forms/الداشبورد تبقى تمشي).
+# المنتظر ماسك thread من الـ lane، فطابور الـ gate ما يقدر يكون أكبر من الـ lane − حد الـ gate: بدون ADMIT_QUEUE
+# هذا هو الطابور (4 threads − 1 محجوز، حد 2 = طابور 1)، و ADMIT_QUEUE أكبر منه يوقف الإقلاع بدل ما ينقص بصمت
+ADMIT_ENABLED  = os.environ.get("ADMIT", "1").lower() not in ("0","false","no")
+ADMIT_DECODE   = int(os.environ.get("ADMIT_DECODE", "2"))
+ADMIT_RENDER   = int(os.environ.get("ADMIT_RENDER", "2"))
+ADMIT_STREAM   = int(os.environ.get("ADMIT_STREAM", "2"))   # ردود streaming (scan/stream، decode/batch، export) ماسكة thread لآخرها
+ADMIT_QUEUE    = int(os.environ["ADMIT_QUEUE"]) if os.environ.get("ADMIT_QUEUE", "").strip() else None
+ADMIT_WAIT_S   = float(os.environ.get("ADMIT_WAIT_MS", "3000")) / 1000.0
+ADMIT_RESERVED = int(os.environ.get("ADMIT_RESERVED", "1"))
+ADMIT_HEAVY_THREADS = max(1, int(os.environ.get("GUNICORN_THREADS", "4")) - ADMIT_RESERVED)
 
 # مفاتيح آمنة مبسطة للرفع
 LOGO_UPLOAD_KEY   = (os.environ.get("LOGO_UPLOAD_KEY") or "").strip()
 FONT_UPLOAD_KEY   = (os.environ.get("FONT_UPLOAD_KEY") or LOGO_UPLOAD_KEY).strip()
 
+# قراءة QR: تحديد المكان أولاً ثم الـ cascade على القصاصة (DECODE_LOCALIZE=0 يرجع للطريقة القديمة)،
+# و DECODE_FULLFRAME_FALLBACK يكمّل على الصورة كاملة لما المحدد ما يلقى أي مكان
+DECODE_LOCALIZE           = os.environ.get("DECODE_LOCALIZE", "1").lower() not in ("0","false","no")
+DECODE_FULLFRAME_FALLBACK = os.environ.get("DECODE_FULLFRAME_FALLBACK", "1").lower() not in ("0","false","no")
+LOCALIZE_MAX_SIDE         = int(os.environ.get("DECODE_LOCALIZE_MAX_SIDE", "800"))
+ROI_MIN_SIDE, ROI_MAX_SIDE, ROI_MARGIN = 240, 1000, 0.2
+# ترتيب مراحل الـ cascade تكيّفي حسب نسبة النجاح/الكلفة لكل مرحلة (ولكل جهاز من الهيدر)،
+# و deadline_ms (أو DECODE_DEADLINE_MS) يوقف المحاولات أول ما يخلص الوقت
+DECODE_ADAPTIVE           = os.environ.get("DECODE_ADAPTIVE", "1").lower() not in ("0","false","no")
+DECODE_DEVICE_HEADER      = os.environ.get("DECODE_DEVICE_HEADER", "X-Device-Model").strip()
+DECODE_DEADLINE_MS        = float(os.environ.get("DECODE_DEADLINE_MS", "0"))
+DECODE_STATS_DEVICES      = int(os.environ.get("DECODE_STATS_DEVICES", "256"))
+DECODE_STATS_PRIOR        = float(os.environ.get("DECODE_STATS_PRIOR", "10"))   # وزن الإحصائية العامة مقابل الجهاز
+# JPEG كبير ينفك مصغّر (1/2، 1/4، 1/8) بشرط ما ينزل ضلعه الأطول عن هذا (نفس سقف robust_decode)
+DECODE_INGEST_MIN_SIDE    = int(os.environ.get("DECODE_INGEST_MIN_SIDE", "2000"))
+# وضع الـ pyramid (?pyramid=1 أو DECODE_PYRAMID=1) للصور الكبيرة: QR صغير يضيع بالتصغير لـ 2000px، فندوّر
+# على علامات الزوايا بالدقة الكاملة ونقرا tiles حولها بـ threads. الصورة تنفك لحد DECODE_PYRAMID_MAX_SIDE
+DECODE_PYRAMID            = os.environ.get("DECODE_PYRAMID", "0").lower() in ("1","true","yes")
+DECODE_PYRAMID_MAX_SIDE   = int(os.environ.get("DECODE_PYRAMID_MAX_SIDE", "4096"))
+DECODE_PYRAMID_TILE       = int(os.environ.get("DECODE_PYRAMID_TILE", "1024"))
+DECODE_PYRAMID_MAX_TILES  = int(os.environ.get("DECODE_PYRAMID_MAX_TILES", "16"))
+DECODE_PYRAMID_THREADS    = int(os.environ.get("DECODE_PYRAMID_THREADS", str(min(4, os.cpu_count() or 1))))
+
+# Batch decode: process pool منفصل عن خيوط gunicorn (spawn عشان ما نورّث خيوط/أقفال)
+DECODE_POOL_WORKERS   = int(os.environ.get("DECODE_POOL_WORKERS", "2"))
+DECODE_BATCH_INFLIGHT = int(os.environ.get("DECODE_BATCH_INFLIGHT", "8"))
+# /decode/batch برّا MAX_CONTENT_LENGTH العام (zip صور جوال يتعدّى 20MB بسهولة): حد للطلب كامل وحد لكل صورة
+DECODE_BATCH_MAX_BYTES       = int(os.environ.get("DECODE_BATCH_MAX_BYTES", str(1024*1024*1024)))
+DECODE_BATCH_MAX_IMAGE_BYTES = int(os.environ.get("DECODE_BATCH_MAX_IMAGE_BYTES", str(20*1024*1024)))
+SPOOL_MEMORY_BYTES           = int(os.environ.get("SPOOL_MEMORY_BYTES", str(8*1024*1024)))   # بعده الـ body ينكتب للقرص
+
+# جلسات الماسح (stream فريمات متتالية): تخطي الفريمات المتشابهة + تكرار نفس الـ ID
+SCAN_SIMILAR_THRESH  = float(os.environ.get("SCAN_SIMILAR_THRESH", "4.0"))   # متوسط فرق بكسل 32x32
+SCAN_DEDUPE_S        = float(os.environ.get("SCAN_DEDUPE_S", "10"))
+SCAN_MAX_FRAME_BYTES = int(os.environ.get("SCAN_MAX_FRAME_BYTES", str(8*1024*1024)))
+
+# التسجيل (/create و /forms/google): التسجيلات المتزامنة تنكتب بـ transaction وحدة (group commit)،
+# و REGISTER_BATCH_MS انتظار إضافي اختياري يجمع أكثر. مفاتيح idempotency تنحفظ IDEMPOTENCY_TTL_H ساعة
+REGISTER_BATCH     = int(os.environ.get("REGISTER_BATCH", "64"))
+REGISTER_BATCH_S   = float(os.environ.get("REGISTER_BATCH_MS", "0")) / 1000.0
+IDEMPOTENCY_TTL_S  = float(os.environ.get("IDEMPOTENCY_TTL_H", "48")) * 3600
+IDEMPOTENCY_HEADER = os.environ.get("IDEMPOTENCY_HEADER", "Idempotency-Key").strip()
+# القاعدة مقفولة بعد busy_timeout (BEGIN IMMEDIATE أو COMMIT): الدفعة تعاد REGISTER_RETRIES مرة (كل مرة تنتظر
+# busy_timeout كامل)، وبعدها 503 + Retry-After بدل 500 فـ Apps Script يعيد الإرسال بنفس المفتاح
+REGISTER_RETRIES   = int(os.environ.get("REGISTER_RETRIES", "0"))
+REGISTER_RETRY_S   = float(os.environ.get("REGISTER_RETRY_AFTER_S", "2"))
+
+# استيراد جماعي (CSV/JSONL): حجم الدفعة بكل transaction
+IMPORT_BATCH      = int(os.environ.get("IMPORT_BATCH", "5000"))
+IMPORT_KEY        = (os.environ.get("IMPORT_KEY") or LOGO_UPLOAD_KEY).strip()
+IMPORT_MAX_BYTES  = int(os.environ.get("IMPORT_MAX_BYTES", str(2*1024*1024*1024)))   # بدل MAX_CONTENT_LENGTH العام
+
+# تصدير الباجات للطباعة (ZIP أو PDF عدة باجات بالصفحة)
+EXPORT_POOL_WORKERS = int(os.environ.get("EXPORT_POOL_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+EXPORT_INFLIGHT     = int(os.environ.get("EXPORT_INFLIGHT", "16"))
+EXPORT_PAGE         = (os.environ.get("EXPORT_PAGE") or "A4").upper()
+EXPORT_MARGIN_CM    = float(os.environ.get("EXPORT_MARGIN_CM", "1.0"))
+EXPORT_KEY          = (os.environ.get("EXPORT_KEY") or IMPORT_KEY).strip()
+
 # مسار الخط المخصص (ينصح: /app/data/timesbd.ttf على Render)
 BADGE_FONT_PATH   = (os.environ.get("BADGE_FONT_PATH") or "").strip()
 
+# كاش صور QR/الباج: ذاكرة (LRU بحد بايتات) + ديسك اختياري تحت مجلد الداتا
+RENDER_CACHE_VERSION = "2"
+RENDER_CACHE_MB      = int(os.environ.get("RENDER_CACHE_MB", "64"))
+RENDER_CACHE_MAX_AGE = int(os.environ.get("RENDER_CACHE_MAX_AGE", "300"))
+RENDER_CACHE_DIR     = (os.environ.get("RENDER_CACHE_DIR") or
+                        (os.path.join(os.path.dirname(DB_PATH) or ".", "render_cache")
+                         if os.environ.get("RENDER_CACHE_DISK", "0").lower() in ("1","true","yes") else "")).strip()
+# حد الديسك (كل الـ workers يتشاركون المجلد): لما يتعدّاه ننظّف الأقدم mtime (الـ hit يحدّث الـ mtime) لين 90%
+RENDER_CACHE_DISK_MB = int(os.environ.get("RENDER_CACHE_DISK_MB", "512"))
+
+# web = الداشبورد والتسجيل والرسم، decode = القراءة والسكانر، all = الكل بنفس الـ pool
+APP_ROLE = (os.environ.get("QR_ROLE") or "all").strip().lower()
+APP_ROLES = ("all", "web", "decode")
+
+# صيغ الخرج: png (1-bit / رمادي / palette بدون فقد لما تنفع)، webp lossless، svg للـ QR من مصفوفة
+# الموديولات. الترتيب = الأصغر أول بالمقاس اللي ينرسم فعلاً، والـ Accept يختار أول صيغة يذكرها بالاسم (وإلا png).
+# /qr دايماً مع اسم الزائر، وهناك svg ~1.9KB < webp ~2.3KB < png ~6.8KB (بدون الاسم webp أصغر من svg).
+# الباج: webp ~8.5KB < png ~20KB
+FORMAT_MIME        = {"svg": "image/svg+xml", "webp": "image/webp", "png": "image/png"}
+QR_FORMATS         = tuple(f for f in ("svg", "webp", "png") if f != "webp" or features.check("webp"))
+CARD_FORMATS       = tuple(f for f in ("webp", "png") if f != "webp" or features.check("webp"))
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "6"))   # الـ 1-bit دايماً 9 (رخيص)
+# الصيغ اللي بروكسي واتساب يقبلها؛ نرسل الأصغر منها
+WA_IMAGE_FORMATS   = [f for f in (x.strip() for x in (os.environ.get("WA_IMAGE_FORMATS") or "png").lower().split(","))
+                      if f in QR_FORMATS] or ["png"]
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20MB
+app.config['QR_ROLE'] = "all"
+
+_ROUTES = []
+def route(rule, role="web", **opts):
+    # مثل app.route بس نسجّل الدور عشان create_app(role) يبني تطبيق بالـ routes حقته بس
+    def deco(fn):
+        _ROUTES.append((rule, fn, opts, role))
+        return app.route(rule, **opts)(fn)
+    return deco
+
+# ---------- Metrics ----------
+# التفاصيل في metrics.py؛ METRICS=0 يطفّيها، و/metrics يجمع كل الـ workers من METRICS_DIR
+metrics.describe("qr_http_request_seconds", "histogram", "Request latency by route, method and status")
+metrics.describe("qr_ingest_seconds", "histogram", "Upload ingest time by step (b64 / imdecode)")
+metrics.describe("qr_ingest_total", "counter", "Decoded uploads by JPEG reduction factor (1 = full size)")
+metrics.describe("qr_decode_seconds", "histogram", "robust_decode wall time by result")
+metrics.describe("qr_decode_total", "counter", "Decodes by the stage that succeeded (none = failed)")
+metrics.describe("qr_decode_stage_seconds", "histogram", "Time per cascade stage (preprocessing + pyzbar)")
+metrics.describe("qr_decode_stage_total", "counter", "Cascade stage attempts by result")
+metrics.describe("qr_decode_multi_codes_total", "counter", "Codes returned by multi-code decodes")
+metrics.describe("qr_decode_deadline_total", "counter", "Decodes stopped by deadline_ms")
+metrics.describe("qr_decode_step_seconds", "histogram", "Non-stage decode steps (resize / localize / warp)")
+metrics.describe("qr_pyzbar_seconds", "histogram", "Time inside pyzbar.decode")
+metrics.describe("qr_render_seconds", "histogram", "Image composition time by kind")
+metrics.describe("qr_image_encode_seconds", "histogram", "Image encode time by kind and format")
+metrics.describe("qr_render_cache_total", "counter", "Render cache lookups by result")
+metrics.describe("qr_db_lock_wait_seconds", "histogram", "Wait for the SQLite write lock (BEGIN IMMEDIATE)")
+metrics.describe("qr_db_busy_total", "counter", "Write transactions that gave up after busy_timeout")
+metrics.describe("qr_checkins_total", "counter", "Check-ins recorded by entry type")
+metrics.describe("qr_checkin_flush_seconds", "histogram", "Check-in batch commit time")
+metrics.describe("qr_checkin_dropped_total", "counter", "Check-ins dropped because the buffer was full")
+metrics.describe("qr_checkin_flush_errors_total", "counter", "Failed check-in batch commits (rows kept for retry)")
+metrics.describe("qr_registry_total", "counter", "Visitor lookups by outcome (hit / miss / snapshot_hit / unknown / shape_reject / bloom_reject)")
+metrics.describe("qr_register_total", "counter", "Registrations by result (created / existing / replayed / error)")
+metrics.describe("qr_register_batches_total", "counter", "Registration group commits (qr_register_total / this = mean batch size)")
+metrics.describe("qr_register_commit_seconds", "histogram", "Registration group commit time")
+metrics.describe("qr_admission_wait_seconds", "histogram", "Time heavy requests waited for a slot by gate")
+metrics.describe("qr_admission_shed_total", "counter", "Heavy requests rejected with 503 by gate and reason (queue_full / timeout / lane)")
+metrics.describe("qr_admission_active", "gauge", "Heavy requests running by gate")
+metrics.describe("qr_admission_waiting", "gauge", "Heavy requests queued by gate")
+metrics.describe("qr_process_memory_mb", "gauge", "Process memory from /proc/self/smaps_rollup (rss / pss / shared)")
+metrics.describe("qr_startup_seconds", "gauge", "Module import and warm-up time")
 
 # ---------- DB ----------
-def ensure_db():
-    d = os.path.dirname(DB_PATH)
-    if d: os.makedirs(d, exist_ok=True)
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("""
-            CREATE TABLE IF NOT EXISTS visitors(
-              id TEXT PRIMARY KEY,
-              name TEXT NOT NULL,
-              company TEXT NOT NULL,
-              position TEXT NOT NULL,
-              email TEXT NOT NULL UNIQUE,
-              phone TEXT NOT NULL UNIQUE,
-              pin TEXT NOT NULL,
-              created_at TEXT NOT NULL,
-              wa_sent INTEGER DEFAULT 0,
-              wa_ts TEXT
-            )
-        """)
-        con.commit()
-
-def rand_token(prefix="ajz_", n=10):
-    a = string.ascii_lowercase + string.digits
-    return prefix + "".join(secrets.choice(a) for _ in range(n))
+# السكيمة والاتصالات في db.py؛ تنعمل مرة وحدة وقت إقلاع الـ worker
+db.init()
+
+def rand_token(prefix="ajz_", n=10, a=string.ascii_lowercase + string.digits):
+    # بايتات عشوائية وحدة لكل توكن؛ نرفض البايتات فوق آخر مضاعف لطول الأبجدية عشان التوزيع يبقى منتظم
+    lim, out = 256 - 256 % len(a), []
+    while len(out) < n:
+        out.extend(a[b % len(a)] for b in secrets.token_bytes(n + 4) if b < lim)
+    return prefix + "".join(out[:n])
 
 def rand_pin(): return f"{secrets.randbelow(10000):04d}"
 
+# ---------- Config stamps ----------
+def _file_stamp(path):
+    try:
+        st = os.stat(path); return f"{st.st_mtime_ns}:{st.st_size}"
+    except OSError: return ""
+
+_CONFIG_FP = None
+def config_fingerprint():
+    global _CONFIG_FP
+    if _CONFIG_FP is None:
+        env = sorted((k,v) for k,v in os.environ.items() if k.startswith("BADGE_"))
+        _CONFIG_FP = hashlib.sha256(json.dumps([env, FONT_SIZE, LINE_SPACING, BADGE_W, BADGE_H, QR_CM, QR_BORDER]).encode()).hexdigest()[:16]
+    return _CONFIG_FP
+
 # ---------- Fonts ----------
+_FONT_CACHE = {}
 def load_times_bold(size=FONT_SIZE):
+    # الخط ينحمل مرة وحدة لكل (حجم، نسخة ملف الخط)
+    key = (size, _file_stamp(BADGE_FONT_PATH) if BADGE_FONT_PATH else "")
+    f = _FONT_CACHE.get(key)
+    if f is None: f = _FONT_CACHE[key] = _load_times_bold(size)
+    return f
+
+def _load_times_bold(size):
     # يفضّل الملف المخصص إذا موجود
     if BADGE_FONT_PATH and os.path.exists(BADGE_FONT_PATH):
         try: return ImageFont.truetype(BADGE_FONT_PATH, size=size)
@@ -123,134 +325,986 @@ def wrap_lines(draw, text, font, max_w):
     return lines
 
 # ---------- QR ----------
-def build_qr_image(visitor_id, size_px):
+@lru_cache(maxsize=4096)
+def qr_matrix(visitor_id, border=QR_BORDER):
+    # مصفوفة الموديولات (True = أسود) شاملة الهامش
     qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M,
-                       box_size=10, border=QR_BORDER)
+                       box_size=10, border=border)
     qr.add_data(visitor_id); qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-    return img.resize((size_px, size_px), Image.NEAREST)
+    m = np.array(qr.get_matrix(), dtype=bool); m.setflags(write=False)
+    return m
+
+def build_qr_image(visitor_id, size_px):
+    # رسم مباشر بالحجم المطلوب (L: 0/255)، بنفس نتيجة box_size=10 ثم NEAREST resize:
+    # بكسل الخرج x ياخذ الموديول floor((x+0.5)*S/size_px)//10 حيث S = عدد الموديولات*10،
+    # فكل موديول يتكرر bincount مرة على كل محور
+    with metrics.timer("qr_render_seconds", kind="qr_matrix"):
+        m = qr_matrix(visitor_id)
+    idx = ((np.arange(size_px) + 0.5) * (len(m)*10.0/size_px)).astype(np.intp) // 10
+    rep = np.bincount(idx, minlength=len(m))
+    mod = np.where(m, 0, 255).astype(np.uint8)
+    return Image.fromarray(np.repeat(np.repeat(mod, rep, 0), rep, 1), "L")
+
+def compact_image(img):
+    # أصغر mode بنفس البكسلات بالضبط: أبيض/أسود -> 1-bit، رمادي -> L، <=256 لون -> palette بألوانها
+    if img.mode not in ("L", "RGB"): return img
+    colors = img.getcolors(256)
+    if colors is None:
+        if img.mode == "RGB":
+            a = np.asarray(img)
+            if (a[...,0] == a[...,1]).all() and (a[...,1] == a[...,2]).all(): return Image.fromarray(a[...,0], "L")
+        return img
+    if img.mode == "L" or all(c[0] == c[1] == c[2] for _, c in colors):
+        g = img if img.mode == "L" else img.getchannel(0)
+        vals = {c if img.mode == "L" else c[0] for _, c in colors}
+        return g.convert("1", dither=Image.Dither.NONE) if vals <= {0, 255} else g
+    pal = Image.new("P", (1, 1)); pal.putpalette([v for _, c in colors for v in c])
+    return img.quantize(palette=pal, dither=Image.Dither.NONE)
 
-def make_qr_png(visitor_id, label_name=None, size=1024):
-    qr_img = build_qr_image(visitor_id, size)
-    if not label_name:
-        b = io.BytesIO(); qr_img.save(b, "PNG"); b.seek(0); return b
+def encode_image(img, fmt, kind):
+    with metrics.timer("qr_image_encode_seconds", kind=kind, fmt=fmt):
+        b = io.BytesIO()
+        if fmt == "webp":
+            img.save(b, "WEBP", lossless=True, quality=100)
+        else:
+            img = compact_image(img)
+            img.save(b, "PNG", compress_level=9 if img.mode == "1" else PNG_COMPRESS_LEVEL)
+        b.seek(0); return b
+
+def qr_svg(visitor_id, label_name=None, size=1024):
+    # مسار واحد: مستطيل لكل تتابع موديولات سود بالسطر؛ الإحداثيات بوحدة الموديول
+    m = qr_matrix(visitor_id); n = len(m)
+    d = []
+    for y, row in enumerate(m):
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.uint8), [0]))))
+        d.extend(f"M{x0} {y}h{x1-x0}v1h{x0-x1}z" for x0, x1 in zip(edges[::2], edges[1::2]))
+    band = n*160.0/size if label_name else 0.0
+    text = ""
+    if label_name:
+        text = (f'<text x="{n/2:g}" y="{n+band/2:.3f}" font-family="Times New Roman,Times,serif" font-weight="bold" '
+                f'font-size="{FONT_SIZE*n/size:.3f}" fill="#0f0f0f" text-anchor="middle" dominant-baseline="central">'
+                f'{html.escape(label_name)}</text>')
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{round(size+band*size/n)}" '
+            f'viewBox="0 0 {n} {n+band:g}" shape-rendering="crispEdges">'
+            f'<rect width="100%" height="100%" fill="#fff"/><path d="{"".join(d)}"/>{text}</svg>')
+
+def make_qr_png(visitor_id, label_name=None, size=1024, fmt="png"):
+    if fmt == "svg":
+        with metrics.timer("qr_render_seconds", kind="qr_svg"):
+            return io.BytesIO(qr_svg(visitor_id, label_name, size).encode("utf-8"))
+    with metrics.timer("qr_render_seconds", kind="qr"):
+        qr_img = build_qr_image(visitor_id, size)
+    if not label_name: return encode_image(qr_img, fmt, "qr")
     canvas = Image.new("RGB", (size, size+160), "white")
     canvas.paste(qr_img,(0,0))
     d = ImageDraw.Draw(canvas); f = load_times_bold(FONT_SIZE)
     tw, th = text_size(d, label_name, f)
     d.text(((size-tw)//2, size+(160-th)//2), label_name, font=f, fill=(15,15,15))
-    b = io.BytesIO(); canvas.save(b,"PNG"); b.seek(0); return b
+    return encode_image(canvas, fmt, "qr")
 
 # ---------- Badge ----------
-def compose_badge_portrait(name, company, position, visitor_id=None, w=BADGE_W, h=BADGE_H):
-    img = Image.new("RGB",(w,h),(255,255,255))
-    d   = ImageDraw.Draw(img)
-    f_label = load_times_bold(FONT_SIZE)
+# القالب يتبنى مرة وحدة لكل إعدادات (خط + لوغو + BADGE_*): الخلفية مع اللوغو والعناوين
+# جاهزة، وأبعاد الـ QR محسوبة؛ لكل زائر نرسم القيم والـ QR فقط.
+class BadgeTemplate:
+    LABELS = ("Name:", "Company:", "Position:")
+    INK    = (10,10,10)
 
-    safe_top_px   = cm_to_px(HOLE_SAFE_CM)
-    logo_shift_px = cm_to_px(LOGO_SHIFT_UP_CM)
-    logo_side     = cm_to_px(LOGO_CM)
-    y_logo        = max(cm_to_px(0.10), safe_top_px - logo_shift_px)
+    def __init__(self, w=BADGE_W, h=BADGE_H):
+        self.w, self.h = w, h
+        self.font = f = load_times_bold(FONT_SIZE)
+        base = Image.new("RGB",(w,h),(255,255,255))
 
-    after_logo = y_logo
-    if os.path.exists(LOGO_PATH):
-        try:
-            logo = Image.open(LOGO_PATH).convert("RGBA")
-            r = max(1e-6, logo.width/float(logo.height))
-            if r>=1.0: nw,nh = logo_side, int(round(logo_side/r))
-            else:      nh,nw = logo_side, int(round(logo_side*r))
-            logo = logo.resize((nw,nh), Image.LANCZOS)
-            lx = (w-nw)//2
-            img.paste(logo,(lx,y_logo),logo)
-            after_logo = y_logo+nh
-        except Exception: pass
+        safe_top_px   = cm_to_px(HOLE_SAFE_CM)
+        logo_shift_px = cm_to_px(LOGO_SHIFT_UP_CM)
+        logo_side     = cm_to_px(LOGO_CM)
+        y_logo        = max(cm_to_px(0.10), safe_top_px - logo_shift_px)
+
+        after_logo = y_logo
+        if os.path.exists(LOGO_PATH):
+            try:
+                logo = Image.open(LOGO_PATH).convert("RGBA")
+                r = max(1e-6, logo.width/float(logo.height))
+                if r>=1.0: nw,nh = logo_side, int(round(logo_side/r))
+                else:      nh,nw = logo_side, int(round(logo_side*r))
+                logo = logo.resize((nw,nh), Image.LANCZOS)
+                lx = (w-nw)//2
+                base.paste(logo,(lx,y_logo),logo)
+                after_logo = y_logo+nh
+            except Exception: pass
+
+        self.measure    = ImageDraw.Draw(Image.new("RGB",(1,1)))
+        self.widths     = {}
+        self.side_pad   = cm_to_px(0.6)
+        self.top_text   = after_logo + cm_to_px(TEXT_TOP_GAP_CM)
+        max_text_w      = w - 2*self.side_pad
+        gap_label_val   = cm_to_px(0.6)
+        lw_max          = max(self.text_w(lbl) for lbl in self.LABELS)
+        self.value_x    = self.side_pad + lw_max + gap_label_val
+        self.value_w    = max_text_w - lw_max - gap_label_val
+        self.line_h     = int(round(LINE_SPACING * FONT_SIZE))
+        self.row_gap    = cm_to_px(0.35)
+
+        # نسختين: بدون عناوين (لو القيم التفّت على أكثر من سطر) ومع العناوين بأماكنها الافتراضية
+        self.base    = base
+        self.labeled = base.copy()
+        d, y = ImageDraw.Draw(self.labeled), self.top_text
+        for lbl in self.LABELS:
+            d.text((self.side_pad,y), lbl, font=f, fill=self.INK); y += self.line_h + self.row_gap
 
-    side_pad      = cm_to_px(0.6)
-    top_text      = after_logo + cm_to_px(TEXT_TOP_GAP_CM)
-    max_text_w    = w - 2*side_pad
-    gap_label_val = cm_to_px(0.6)
-    labels        = ["Name:", "Company:", "Position:"]
-    lw_max        = max(text_size(d,lbl,f_label)[0] for lbl in labels)
-    value_x       = side_pad + lw_max + gap_label_val
-    value_w       = max_text_w - lw_max - gap_label_val
-    line_h        = int(round(LINE_SPACING * FONT_SIZE))
-
-    def row(label, value, y_top):
-        d.text((side_pad,y_top), label, font=f_label, fill=(10,10,10))
-        for i,ln in enumerate(wrap_lines(d,value,f_label,value_w)):
-            d.text((value_x, y_top+i*line_h), ln, font=f_label, fill=(10,10,10))
-        return max(line_h, line_h*len(wrap_lines(d,value,f_label,value_w)))
-
-    y = top_text
-    y += row("Name:",     (name or ""),     y); y += cm_to_px(0.35)
-    y += row("Company:",  (company or ""),  y); y += cm_to_px(0.35)
-    y += row("Position:", (position or ""), y)
-
-    if visitor_id:
         bottom_cm   = float(os.environ.get("BADGE_QR_BOTTOM_CM","0.8"))
         min_cm      = float(os.environ.get("BADGE_QR_MIN_CM","1.8"))
         max_cm      = float(os.environ.get("BADGE_QR_MAX_CM","4.0"))
         max_ratio   = float(os.environ.get("BADGE_QR_MAX_RATIO","0.28"))
         safety_cm   = float(os.environ.get("BADGE_QR_SAFETY_CM","1.6"))
 
-        bottom_margin = cm_to_px(bottom_cm)
-        safety_gap    = cm_to_px(safety_cm)
-        qr_nominal    = cm_to_px(QR_CM)
-        qr_min        = cm_to_px(min_cm)
-        qr_max        = min(int(w*max_ratio), cm_to_px(max_cm))
-        qr_side       = max(qr_min, min(qr_nominal, qr_max))
-        available_h   = h - bottom_margin - (y + safety_gap)
-        qr_side       = qr_min if available_h < qr_min else min(qr_side, available_h)
+        self.bottom_margin = cm_to_px(bottom_cm)
+        self.safety_gap    = cm_to_px(safety_cm)
+        qr_nominal         = cm_to_px(QR_CM)
+        self.qr_min        = cm_to_px(min_cm)
+        qr_max             = min(int(w*max_ratio), cm_to_px(max_cm))
+        self.qr_side       = max(self.qr_min, min(qr_nominal, qr_max))
+
+    def text_w(self, text):
+        tw = self.widths.get(text)
+        if tw is None:
+            if len(self.widths) > 8192: self.widths.clear()
+            tw = self.widths[text] = text_size(self.measure, text, self.font)[0]
+        return tw
+
+    def wrap(self, text):
+        # نفس wrap_lines بس مع كاش للعرض
+        text = (text or "").strip()
+        if not text: return [""]
+        lines, cur = [], ""
+        for w in text.split():
+            cand = (cur+" "+w).strip()
+            if self.text_w(cand) <= self.value_w or not cur:
+                cur = cand
+            else:
+                lines.append(cur); cur = w
+        if cur: lines.append(cur)
+        return lines
+
+    def render(self, name, company, position, visitor_id=None):
+        rows   = [self.wrap(name), self.wrap(company), self.wrap(position)]
+        single = all(len(r)==1 for r in rows)
+        img    = (self.labeled if single else self.base).copy()
+        d, f, line_h = ImageDraw.Draw(img), self.font, self.line_h
+
+        y = self.top_text
+        for i,(label,lines) in enumerate(zip(self.LABELS, rows)):
+            if not single: d.text((self.side_pad,y), label, font=f, fill=self.INK)
+            for j,ln in enumerate(lines):
+                if ln: d.text((self.value_x, y+j*line_h), ln, font=f, fill=self.INK)
+            y += max(line_h, line_h*len(lines))
+            if i < 2: y += self.row_gap
+
+        if visitor_id:
+            available_h = self.h - self.bottom_margin - (y + self.safety_gap)
+            qr_side     = self.qr_min if available_h < self.qr_min else min(self.qr_side, available_h)
+            qx = (self.w-qr_side)//2
+            qy = self.h - self.bottom_margin - qr_side
+            img.paste(build_qr_image(visitor_id, qr_side),(qx,qy))
 
-        qx = (w-qr_side)//2
-        qy = h - bottom_margin - qr_side
-        img.paste(build_qr_image(visitor_id, qr_side),(qx,qy))
+        return img
 
-    return img
+_BADGE_TEMPLATES = {}
+_BADGE_TEMPLATES_LOCK = threading.Lock()
+def badge_template(w=BADGE_W, h=BADGE_H):
+    stamp = (w, h, config_fingerprint(), _file_stamp(LOGO_PATH), _file_stamp(BADGE_FONT_PATH) if BADGE_FONT_PATH else "")
+    t = _BADGE_TEMPLATES.get(stamp)
+    if t is None:
+        with _BADGE_TEMPLATES_LOCK:
+            t = _BADGE_TEMPLATES.get(stamp)
+            if t is None:
+                # نسخة لوغو/خط جديدة: نرمي القوالب القديمة
+                if any(k[2:] != stamp[2:] for k in _BADGE_TEMPLATES): _BADGE_TEMPLATES.clear()
+                t = _BADGE_TEMPLATES[stamp] = BadgeTemplate(w, h)
+    return t
 
-def make_badge_png(name, company, position, visitor_id=None, rotate_ccw=False):
+def compose_badge_portrait(name, company, position, visitor_id=None, w=BADGE_W, h=BADGE_H):
+    with metrics.timer("qr_render_seconds", kind="badge"):
+        return badge_template(w, h).render(name, company, position, visitor_id)
+
+def make_badge_png(name, company, position, visitor_id=None, rotate_ccw=False, fmt="png"):
     img = compose_badge_portrait(name, company, position, visitor_id)
     if rotate_ccw: img = img.transpose(Image.ROTATE_90)
-    b = io.BytesIO(); img.save(b,"PNG"); b.seek(0); return b
+    return encode_image(img, fmt, "badge")
 
-# ---------- Decode ----------
-def decode_pyzbar(img_bgr):
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-    res  = pyzbar.decode(gray)
-    if not res: return "", []
-    b = res[0]
-    txt = b.data.decode("utf-8", errors="replace")
-    if b.polygon and len(b.polygon)>=4:
-        poly = [[float(p.x), float(p.y)] for p in b.polygon]
+# ---------- Render cache ----------
+# مفتاح الكاش = hash لكل مدخلات الرسم (الزائر + إعدادات الباج + mtime للّوغو والخط)
+# فنفس المفتاح = نفس الصورة، ونستخدمه كـ ETag مباشرة بدون ما نرسم.
+def render_key(kind, visitor_id, *fields):
+    parts = [RENDER_CACHE_VERSION, kind, visitor_id, *[f or "" for f in fields], config_fingerprint(),
+             _file_stamp(LOGO_PATH), _file_stamp(BADGE_FONT_PATH) if BADGE_FONT_PATH else ""]
+    return hashlib.sha256("\x1f".join(map(str,parts)).encode("utf-8")).hexdigest()
+
+class RenderCache:
+    def __init__(self, max_bytes, disk_dir="", disk_max_bytes=RENDER_CACHE_DISK_MB*1024*1024):
+        self.max_bytes = max_bytes
+        self.disk_dir  = disk_dir
+        self.disk_max  = disk_max_bytes
+        self.disk_size = None   # تقدير حجم المجلد؛ يتصحح بكل تنظيف (workers ثانيين يكتبون فيه بعد)
+        self.trim_lock = threading.Lock()
+        self.items     = OrderedDict()
+        self.size      = 0
+        self.lock      = threading.Lock()
+        self.hits = self.misses = self.disk_hits = self.disk_evicted = 0
+
+    def _disk_path(self, key): return os.path.join(self.disk_dir, key[:2], key + ".bin")
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key); self.hits += 1
+                metrics.inc("qr_render_cache_total", result="hit")
+                return data
+        if self.disk_dir:
+            p = self._disk_path(key)
+            try:
+                with open(p, "rb") as fh: data = fh.read()
+            except OSError: data = None
+            if data is not None:
+                try: os.utime(p)   # LRU للتنظيف
+                except OSError: pass
+                self.disk_hits += 1; self._remember(key, data)
+                metrics.inc("qr_render_cache_total", result="disk_hit")
+                return data
+        self.misses += 1
+        metrics.inc("qr_render_cache_total", result="miss")
+        return None
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.disk_dir:
+            p = self._disk_path(key); tmp = f"{p}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                _ensure_dir(p)
+                with open(tmp, "wb") as fh: fh.write(data)
+                os.replace(tmp, p)
+            except OSError: return
+            if self.disk_size is not None: self.disk_size += len(data)
+            if self.disk_size is None or self.disk_size > self.disk_max: self.trim_disk()
+
+    def trim_disk(self):
+        # مسح المجلد: لو فوق الحد نحذف الأقدم mtime لين 90% منه. thread واحد بس ينظّف بكل process
+        if not self.trim_lock.acquire(blocking=False): return
+        try:
+            files = []
+            for root, _, names in os.walk(self.disk_dir):
+                for n in names:
+                    if not n.endswith(".bin"): continue
+                    p = os.path.join(root, n)
+                    try: st = os.stat(p)
+                    except OSError: continue
+                    files.append((st.st_mtime, st.st_size, p))
+            total = sum(f[1] for f in files)
+            if total > self.disk_max:
+                files.sort()
+                for _, size, p in files:
+                    if total <= self.disk_max * 0.9: break
+                    try: os.remove(p)
+                    except OSError: continue
+                    total -= size; self.disk_evicted += 1
+            self.disk_size = total
+        finally: self.trim_lock.release()
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes: return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None: self.size -= len(old)
+            self.items[key] = data; self.size += len(data)
+            while self.size > self.max_bytes:
+                _, ev = self.items.popitem(last=False); self.size -= len(ev)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear(); self.size = 0
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+        self.disk_size = 0
+
+render_cache = RenderCache(RENDER_CACHE_MB*1024*1024, RENDER_CACHE_DIR)
+
+def negotiate_format(formats, ext=None):
+    # امتداد الـ URL (.png/.svg/.webp) يثبّت الصيغة؛ بدون امتداد: ?format= صريح، وإلا أول صيغة من formats
+    # يذكرها الـ Accept بالاسم (مو */* ولا image/*)، وإلا png. None = صيغة مو مدعومة هنا
+    f = (ext or request.args.get("format") or "").strip().lower()
+    if f: return f if f in formats else None
+    listed = {v for v, q in request.accept_mimetypes if q > 0}
+    return next((f for f in formats if FORMAT_MIME[f] in listed), "png")
+
+def cached_image_response(key, render, fmt="png", download_name=None, negotiated=False):
+    # render() ترجع BytesIO؛ ما تنادى إلا إذا الصورة مش بالكاش. key لازم يشمل الصيغة.
+    # negotiated = الصيغة طلعت من الـ Accept (URL بدون امتداد) -> Vary: Accept
+    etag = key[:32]
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
     else:
-        x,y,w,h = b.rect; poly = [[x,y],[x+w,y],[x+w,y+h],[x,y+h]]
-    return txt, poly
+        data = render_cache.get(key)
+        if data is None:
+            with render_gate.slot(): data = render().getvalue()
+            render_cache.put(key, data)
+        resp = make_response(data)
+        resp.mimetype = FORMAT_MIME[fmt]
+        if download_name:
+            resp.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={RENDER_CACHE_MAX_AGE}, must-revalidate"
+    if negotiated: resp.vary.add("Accept")
+    return resp
+
+# ---------- Decode ----------
+def decode_pyzbar_all(img):
+    # كل الرموز بالصورة: [(النص، المضلّع)]
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    with metrics.timer("qr_pyzbar_seconds"):
+        res = pyzbar.decode(gray)
+    out = []
+    for b in res:
+        if b.polygon and len(b.polygon)>=4:
+            poly = [[float(p.x), float(p.y)] for p in b.polygon]
+        else:
+            x,y,w,h = b.rect; poly = [[x,y],[x+w,y],[x+w,y+h],[x,y+h]]
+        out.append((b.data.decode("utf-8", errors="replace"), poly))
+    return out
+
+def decode_pyzbar(img):
+    res = decode_pyzbar_all(img)
+    return res[0] if res else ("", [])
 
 def preprocess_contrast(img): return cv2.convertScaleAbs(img, alpha=1.35, beta=8)
 
-def robust_decode(img):
-    h,w = img.shape[:2]
-    if max(w,h)<800:
-        s = 800.0/max(w,h); img = cv2.resize(img,None,fx=s,fy=s,interpolation=cv2.INTER_CUBIC)
-    elif max(w,h)>2000:
-        s = 2000.0/max(w,h); img = cv2.resize(img,None,fx=s,fy=s,interpolation=cv2.INTER_AREA)
-    t,p = decode_pyzbar(img)
-    if t: return t,p
-    boosted = preprocess_contrast(img)
-    t,p = decode_pyzbar(boosted)
-    if t: return t,p
-    for k in [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE]:
-        t,p = decode_pyzbar(cv2.rotate(boosted,k))
-        if t: return t,p
-    g = cv2.cvtColor(boosted, cv2.COLOR_BGR2GRAY)
-    g = cv2.medianBlur(g,3)
-    thr = cv2.adaptiveThreshold(g,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY,31,5)
-    t,p = decode_pyzbar(cv2.cvtColor(thr,cv2.COLOR_GRAY2BGR))
-    if t: return t,p
-    inv = cv2.bitwise_not(thr)
-    t,p = decode_pyzbar(cv2.cvtColor(inv,cv2.COLOR_GRAY2BGR))
-    if t: return t,p
-    return "", []
+# مراحل الـ cascade بالترتيب؛ كل مرحلة ترجع (الصورة، الدوران) والنسخ المشتقة
+# (contrast / threshold) تنحسب مرة وحدة لكل إطار عن طريق _Frame.
+class _Frame:
+    def __init__(self, img): self.img = img; self._boosted = self._thr = None
+    @property
+    def boosted(self):
+        if self._boosted is None: self._boosted = preprocess_contrast(self.img)
+        return self._boosted
+    @property
+    def thr(self):
+        if self._thr is None:
+            g = self.boosted if self.boosted.ndim == 2 else cv2.cvtColor(self.boosted, cv2.COLOR_BGR2GRAY)
+            g = cv2.medianBlur(g,3)
+            self._thr = cv2.adaptiveThreshold(g,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY,31,5)
+        return self._thr
+
+DECODE_STAGES = OrderedDict([
+    ("plain",    lambda fr: (fr.img, None)),
+    ("contrast", lambda fr: (fr.boosted, None)),
+    ("rot90",    lambda fr: (cv2.rotate(fr.boosted, cv2.ROTATE_90_CLOCKWISE), cv2.ROTATE_90_CLOCKWISE)),
+    ("rot180",   lambda fr: (cv2.rotate(fr.boosted, cv2.ROTATE_180), cv2.ROTATE_180)),
+    ("rot270",   lambda fr: (cv2.rotate(fr.boosted, cv2.ROTATE_90_COUNTERCLOCKWISE), cv2.ROTATE_90_COUNTERCLOCKWISE)),
+    ("adaptive", lambda fr: (fr.thr, None)),
+    ("inverted", lambda fr: (cv2.bitwise_not(fr.thr), None)),
+])
+
+def _unrotate(poly, rot, shape):
+    # نقاط من الصورة المدوّرة -> إحداثيات الصورة قبل الدوران (shape = شكل الأصل)
+    if rot is None or not poly: return poly
+    h, w = shape[:2]
+    if rot == cv2.ROTATE_90_CLOCKWISE: return [[y, h-1-x] for x,y in poly]
+    if rot == cv2.ROTATE_180:          return [[w-1-x, h-1-y] for x,y in poly]
+    return [[w-1-y, x] for x,y in poly]
+
+# ---------- Adaptive ordering ----------
+# لكل (جهاز، مرحلة): محاولات، نجاحات، مجموع الوقت. المراحل تترتب بنسبة النجاح ÷ الكلفة
+# (الأعلى أول)، وإحصائية الجهاز تنخلط بالعامة بوزن DECODE_STATS_PRIOR فالجهاز الجديد
+# يبدأ بالترتيب العام. بدون بيانات الكل متساوي فيبقى ترتيب DECODE_STAGES. لكل process.
+class StageStats:
+    DEFAULT_COST = 0.02
+
+    def __init__(self, max_devices=DECODE_STATS_DEVICES):
+        self.max_devices = max_devices
+        self.by   = OrderedDict()     # device -> {stage: [tries, hits, secs]}
+        self.lock = threading.Lock()
+
+    def _dev(self, device):
+        d = self.by.get(device)
+        if d is None:
+            d = self.by[device] = {}
+            while len(self.by) > self.max_devices + 1: self.by.popitem(last=False)
+        else: self.by.move_to_end(device)
+        return d
+
+    def record(self, device, stage, hit, secs):
+        with self.lock:
+            for dev in {"", device}:
+                c = self._dev(dev).setdefault(stage, [0, 0, 0.0])
+                c[0] += 1; c[1] += bool(hit); c[2] += secs
+
+    def estimate(self, device, stage):
+        # (احتمال النجاح، الكلفة المتوقعة بالثواني)
+        with self.lock:
+            g = self.by.get("", {}).get(stage) or [0, 0, 0.0]
+            d = self.by.get(device, {}).get(stage) if device else None
+        pg = (g[1] + 1.0) / (g[0] + 2.0)
+        cg = g[2] / g[0] if g[0] else self.DEFAULT_COST
+        if not d: return pg, cg
+        k = DECODE_STATS_PRIOR
+        return (d[1] + k*pg) / (d[0] + k), (d[2] + k*cg) / (d[0] + k)
+
+    def order(self, device, stages):
+        # stages = [(الاسم، مفتاح الإحصائية)]
+        if not DECODE_ADAPTIVE: return list(stages)
+        def score(item):
+            p, c = self.estimate(device, item[1])
+            return -p / max(c, 1e-4)
+        return sorted(stages, key=score)
+
+    def snapshot(self):
+        with self.lock:
+            return {dev or "*": {st: dict(tries=c[0], hits=c[1], avg_ms=round(1000*c[2]/c[0], 2) if c[0] else 0.0)
+                                 for st, c in d.items()} for dev, d in self.by.items()}
+
+stage_stats = StageStats()
+
+class DecodePlan:
+    # طلب قراءة واحد: الجهاز، الـ deadline، والمراحل اللي انجربت
+    def __init__(self, device="", deadline_ms=0):
+        self.device    = device
+        self.t0        = time.perf_counter()
+        self.deadline  = self.t0 + deadline_ms/1000.0 if deadline_ms and deadline_ms > 0 else None
+        self.tried     = []
+        self.skipped   = []
+        self.timed_out = False
+
+    def left(self):
+        return None if self.deadline is None else self.deadline - time.perf_counter()
+
+    def expired(self):
+        if self.deadline is not None and time.perf_counter() >= self.deadline: self.timed_out = True
+        return self.timed_out
+
+    def stages(self, names, prefix=""):
+        # بالترتيب التكيّفي؛ مع deadline نتخطى المرحلة اللي كلفتها المتوقعة أكبر من الباقي
+        for name, key in stage_stats.order(self.device, [(n, prefix+n) for n in names]):
+            left = self.left()
+            if left is not None:
+                if left <= 0: self.timed_out = True; return
+                if stage_stats.estimate(self.device, key)[1] > left: self.skipped.append(key); continue
+            yield name
+
+    def record(self, key, hit, secs):
+        self.tried.append(key)
+        stage_stats.record(self.device, key, hit, secs)
+
+    def report(self):
+        return dict(tried=self.tried, skipped=self.skipped, timed_out=self.timed_out,
+                    elapsed_ms=round(1000*(time.perf_counter()-self.t0), 1))
+
+def decode_cascade(img, stages=None, prefix="", plan=None):
+    # prefix لمفاتيح الإحصائية والـ metrics (roi_ للقصاصات)؛ الاسم الراجع بدونه
+    plan = plan or DecodePlan()
+    fr = _Frame(img)
+    for name in plan.stages(stages or DECODE_STAGES, prefix):
+        t0 = time.perf_counter()
+        im, rot = DECODE_STAGES[name](fr)
+        t,p = decode_pyzbar(im)
+        dt = time.perf_counter() - t0
+        plan.record(prefix+name, t, dt)
+        metrics.observe("qr_decode_stage_seconds", dt, stage=prefix+name)
+        metrics.inc("qr_decode_stage_total", stage=prefix+name, result="hit" if t else "miss")
+        if t: return t, _unrotate(p, rot, img.shape), name
+    return "", [], ""
+
+# ---------- Ingest ----------
+# الصور المرفوعة تنفك رمادي مباشرة (الـ cascade كله قناة وحدة)، والـ JPEG الكبير ينفك مصغّر
+# من libjpeg نفسه. المعامل f يرجع مع الصورة عشان المضلّع يرجع لإحداثيات الصورة الأصلية.
+def jpeg_size(buf):
+    # (w, h) من مقطع SOF بالهيدر بدون فك الصورة؛ None لو مو JPEG
+    n = len(buf)
+    if n < 4 or buf[0] != 0xFF or buf[1] != 0xD8: return None
+    i = 2
+    while i + 9 <= n:
+        if buf[i] != 0xFF: return None
+        m = buf[i+1]
+        if m == 0xFF: i += 1; continue
+        if m == 0x01 or 0xD0 <= m <= 0xD8: i += 2; continue
+        if 0xC0 <= m <= 0xCF and m not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack_from(">HH", buf, i+5)
+            return w, h
+        i += 2 + struct.unpack_from(">H", buf, i+2)[0]
+    return None
+
+def imdecode(buf, min_side=None):
+    # بايتات صورة -> (صورة رمادية، f) أو (None, 1)
+    if not buf: return None, 1
+    f, flags, min_side = 1, cv2.IMREAD_GRAYSCALE, min_side or DECODE_INGEST_MIN_SIDE
+    size = jpeg_size(buf)
+    if size:
+        for r, fl in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if max(size) // r >= min_side: f, flags = r, fl; break
+    with metrics.timer("qr_ingest_seconds", step="imdecode"):
+        img = cv2.imdecode(np.frombuffer(buf,np.uint8), flags)
+    metrics.inc("qr_ingest_total", reduce=f)
+    return img, f
+
+def b64_image(b64, min_side=None):
+    # data URL أو base64 خام -> (صورة رمادية، f)؛ a2b_base64 يقرا الـ str (ASCII) مباشرة بدون نسخة bytes وسطية
+    i = b64.find(",", 0, 256)
+    if i >= 0: b64 = b64[i+1:]
+    if not b64: return None, 1
+    try:
+        with metrics.timer("qr_ingest_seconds", step="b64"):
+            buf = binascii.a2b_base64(b64)
+    except (binascii.Error, ValueError): return None, 1
+    return imdecode(buf, min_side)
+
+@contextmanager
+def upload_buffer(fs):
+    # ملف multipart كبير ينحفظ بملف مؤقت: mmap بدل read() فالبايتات ما تنسخ للذاكرة.
+    # الـ mmap يتسكر بنهاية الـ with (imdecode ما يخلي مرجع عليه)
+    # werkzeug يعطي SpooledTemporaryFile: لو لسا بالذاكرة (_rolled=False) fileno() يجبره ينكتب للقرص،
+    # فنقرا عادي. الـ mmap بس لملف فعلاً على القرص
+    st, m = fs.stream, None
+    if getattr(st, "_rolled", not isinstance(st, io.BytesIO)):
+        try: m = mmap.mmap(st.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation): pass
+    if m is None:
+        yield st.read(); return
+    try: yield m
+    finally: m.close()
+
+# الـ routes اللي تقبل أكبر من MAX_CONTENT_LENGTH تقرا wsgi.input بحدها هي (413 لو تعدّاه)، ولازم
+# ما تلمس request.files / request.data / request.stream قبلها (هذي تطبّق الحد العام)
+def request_stream(limit):
+    return get_input_stream(request.environ, max_content_length=limit)
+
+def spool_request(limit):
+    # الـ body كامل لملف مؤقت (بالذاكرة لحد SPOOL_MEMORY_BYTES ثم القرص) لما نحتاج seek، مثل zip
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    try: shutil.copyfileobj(request_stream(limit), out, 1 << 20)
+    except BaseException: out.close(); raise
+    out.seek(0)
+    return out
+
+def request_files(limit):
+    # ملفات multipart بحد الـ route؛ werkzeug يكتب الملفات الكبيرة لملفات مؤقتة مو بالذاكرة
+    return parse_form_data(request.environ, max_content_length=limit)[2]
+
+# ---------- Localization ----------
+# نلقط مكان الـ QR على نسخة رمادية مصغّرة، ونفرد كل مرشّح (perspective) لمربع مستقل
+# ونشغّل الـ cascade على القصاصة بس بدل الصورة كاملة.
+_tls = threading.local()
+def _qr_detector():
+    det = getattr(_tls, "qr_detector", None)
+    if det is None: det = _tls.qr_detector = cv2.QRCodeDetector()
+    return det
+
+def locate_qr_regions(img, max_side=LOCALIZE_MAX_SIDE):
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h,w  = gray.shape[:2]
+    s    = min(1.0, float(max_side)/max(w,h))
+    small = cv2.resize(gray,None,fx=s,fy=s,interpolation=cv2.INTER_AREA) if s < 1.0 else gray
+    det  = _qr_detector()
+    try:
+        ok, pts = det.detectMulti(small)
+        if not ok or pts is None: ok, pts = det.detect(small)
+    except cv2.error: return []
+    if not ok or pts is None: return []
+    return [np.asarray(q, np.float32).reshape(4,2) / s for q in np.asarray(pts).reshape(-1,4,2)]
+
+def _warp_roi(img, quad):
+    side = max(np.linalg.norm(quad[i]-quad[(i+1)%4]) for i in range(4))
+    t    = int(min(ROI_MAX_SIDE, max(ROI_MIN_SIDE, side)))
+    m    = int(round(t*ROI_MARGIN))
+    dst  = np.float32([[m,m],[m+t,m],[m+t,m+t],[m,m+t]])
+    H    = cv2.getPerspectiveTransform(quad, dst)
+    roi  = cv2.warpPerspective(img, H, (t+2*m, t+2*m), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return roi, H
+
+def decode_regions(img, quads, plan=None):
+    for quad in quads:
+        if plan and plan.expired(): break
+        with metrics.timer("qr_decode_step_seconds", step="warp"):
+            roi, H = _warp_roi(img, quad)
+        t,p,stage = decode_cascade(roi, prefix="roi_", plan=plan)
+        if t:
+            back = cv2.perspectiveTransform(np.float32(p).reshape(-1,1,2), np.linalg.inv(H)).reshape(-1,2)
+            return t, [[float(x), float(y)] for x,y in back], "roi_"+stage
+    return "", [], ""
+
+def robust_decode_ex(img, f=1, plan=None, pyramid=False):
+    # ترجع (النص، المضلّع بإحداثيات الصورة الأصلية، اسم المرحلة اللي نجحت)
+    # f = معامل التصغير من imdecode (المضلّع ينضرب فيه)؛ plan = الجهاز + الـ deadline + المراحل المجرّبة
+    t0 = time.perf_counter()
+    plan = plan or DecodePlan()
+    t,p,stage = _pyramid_decode(img, plan) if pyramid else _robust_decode_ex(img, plan)
+    if f != 1: p = [[x*f, y*f] for x,y in p]
+    metrics.observe("qr_decode_seconds", time.perf_counter()-t0, result="hit" if t else "miss")
+    metrics.inc("qr_decode_total", stage=stage or "none")
+    if plan.timed_out and not t: metrics.inc("qr_decode_deadline_total")
+    return t,p,stage
+
+def _robust_decode_ex(img, plan):
+    if img.ndim == 3:
+        with metrics.timer("qr_decode_step_seconds", step="gray"):
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    src = img
+    h,w = img.shape[:2]; s = 1.0
+    with metrics.timer("qr_decode_step_seconds", step="resize"):
+        if max(w,h)<800:
+            s = 800.0/max(w,h); img = cv2.resize(img,None,fx=s,fy=s,interpolation=cv2.INTER_CUBIC)
+        elif max(w,h)>2000:
+            s = 2000.0/max(w,h); img = cv2.resize(img,None,fx=s,fy=s,interpolation=cv2.INTER_AREA)
+    scale_back = lambda p: [[x/s, y/s] for x,y in p]
+    if DECODE_LOCALIZE:
+        t,p,stage = decode_cascade(img, ("plain",), plan=plan)
+        if t: return t, scale_back(p), stage
+        if plan.expired(): return "", [], ""
+        with metrics.timer("qr_decode_step_seconds", step="localize"):
+            quads = locate_qr_regions(src)
+        t,p,stage = decode_regions(src, quads, plan)
+        if t: return t, p, stage
+        # الصورة كاملة بس لو المحدد ما لقى شي: لو لقى وما انقرا فالقصاصة جربت نفس المراحل، والإعادة
+        # على الصورة كاملة تضاعف كلفة الفشل فوق الـ cascade القديم
+        if quads or not DECODE_FULLFRAME_FALLBACK or plan.expired(): return "", [], ""
+        t,p,stage = decode_cascade(img, [k for k in DECODE_STAGES if k != "plain"], plan=plan)
+    else:
+        t,p,stage = decode_cascade(img, plan=plan)
+    return (t, scale_back(p), stage) if t else ("", [], "")
+
+def robust_decode(img, f=1, plan=None):
+    t,p,_ = robust_decode_ex(img, f, plan)
+    return t,p
+
+# ---------- Multi-code ----------
+# صورة فيها عدة باجات (مجموعة): نكمّل كل المراحل بدل ما نوقف عند أول رمز، ونجمع اللي طلع من كل
+# مرحلة ودوران. التكرار ينعرف بالنص (نفس الباج من مرحلتين أو انعكاس) أو بالمكان (المركز داخل نص حجمه
+# من الثاني). المرشّحات من detectMulti اللي ما غطاها رمز تنقرا بقصاصة، وبعدها باقي مراحل الصورة كاملة
+# دايماً لين يخلص الـ deadline: رمز ما شافه الـ plain ولا detectMulti ممكن يطلع بدوران أو threshold.
+def _poly_box(poly):
+    a = np.float32(poly).reshape(-1, 2)
+    return a.mean(0), float((a.max(0) - a.min(0)).max())
+
+def _same_spot(p, q):
+    (c1, s1), (c2, s2) = _poly_box(p), _poly_box(q)
+    return float(np.linalg.norm(c1 - c2)) < 0.5 * max(1.0, min(s1, s2))
+
+class _Codes:
+    def __init__(self): self.items = []
+    def add(self, text, poly, stage):
+        if not text or any(c["text"] == text or _same_spot(poly, c["poly"]) for c in self.items): return False
+        self.items.append(dict(text=text, poly=poly, stage=stage)); return True
+    def covers(self, poly): return any(_same_spot(poly, c["poly"]) for c in self.items)
+
+def _cascade_all(img, stages, codes, back, plan, prefix=""):
+    # كل رمز جديد يتسجل بإحداثيات المصدر عن طريق back(poly)
+    fr = _Frame(img)
+    for name in plan.stages(stages, prefix):
+        t0 = time.perf_counter()
+        im, rot = DECODE_STAGES[name](fr)
+        new = sum(codes.add(t, back(_unrotate(p, rot, img.shape)), prefix+name) for t, p in decode_pyzbar_all(im))
+        dt = time.perf_counter() - t0
+        plan.record(prefix+name, new, dt)
+        metrics.observe("qr_decode_stage_seconds", dt, stage=prefix+name)
+        metrics.inc("qr_decode_stage_total", stage=prefix+name, result="hit" if new else "miss")
+
+def decode_multi(img, f=1, plan=None):
+    # [{text, poly, stage}] بإحداثيات الصورة الأصلية، بترتيب الاكتشاف
+    t0 = time.perf_counter()
+    plan = plan or DecodePlan()
+    if img.ndim == 3: img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    src, codes = img, _Codes()
+    h,w = img.shape[:2]; s = 1.0
+    if max(w,h) < 800:    s = 800.0/max(w,h)
+    elif max(w,h) > 2000: s = 2000.0/max(w,h)
+    if s != 1.0: img = cv2.resize(img,None,fx=s,fy=s,interpolation=cv2.INTER_CUBIC if s > 1 else cv2.INTER_AREA)
+    scale_back = lambda p: [[x/s, y/s] for x,y in p]
+    _cascade_all(img, ("plain",), codes, scale_back, plan)
+    if DECODE_LOCALIZE and not plan.expired():
+        with metrics.timer("qr_decode_step_seconds", step="localize"):
+            quads = locate_qr_regions(src)
+        for quad in quads:
+            if codes.covers(quad.tolist()): continue
+            if plan.expired(): break
+            with metrics.timer("qr_decode_step_seconds", step="warp"):
+                roi, H = _warp_roi(src, quad)
+            t,p,stage = decode_cascade(roi, prefix="roi_", plan=plan)
+            if t:
+                back = cv2.perspectiveTransform(np.float32(p).reshape(-1,1,2), np.linalg.inv(H)).reshape(-1,2)
+                codes.add(t, [[float(x), float(y)] for x,y in back], "roi_"+stage)
+    if DECODE_FULLFRAME_FALLBACK and not plan.expired():
+        # plan.stages يتخطى المراحل اللي كلفتها المتوقعة أكبر من الباقي من الـ deadline
+        _cascade_all(img, [k for k in DECODE_STAGES if k != "plain"], codes, scale_back, plan)
+    if f != 1:
+        for c in codes.items: c["poly"] = [[x*f, y*f] for x,y in c["poly"]]
+    metrics.observe("qr_decode_seconds", time.perf_counter()-t0, result="multi")
+    metrics.inc("qr_decode_multi_codes_total", len(codes.items))
+    return codes.items
+
+# ---------- Pyramid ----------
+# مستوى 2000px أول (plain بس)، وبعدين علامات الزوايا (3 مربعات متداخلة) على نفس المستوى، تنضرب لإحداثيات
+# الدقة الكاملة: شبكة tiles بتداخل ربع، وكل tile فيه علامتين على الأقل ينقرا بـ thread من الدقة الكاملة
+# (OpenCV و zbar يفكّون الـ GIL). QR أصغر من ربع الـ tile يقع كامل بتيل واحد على الأقل. العلامة لازم
+# تكون ~14px على المستوى (موديول ~2px). لو ما انقرا شي نكمّل الـ cascade العادي على المستوى الصغير.
+_pyr_pool = (None, None)
+
+def pyramid_pool():
+    global _pyr_pool
+    pool, pid = _pyr_pool
+    if pool is None or pid != os.getpid():
+        with _POOL_LOCK:
+            pool, pid = _pyr_pool
+            if pool is None or pid != os.getpid():
+                pool = ThreadPoolExecutor(max_workers=max(1, DECODE_PYRAMID_THREADS), thread_name_prefix="pyramid")
+                _pyr_pool = (pool, os.getpid())
+    return pool
+
+def finder_candidates(gray):
+    # [(cx, cy, side)]: كونتور له ابن وحفيد، شبه مربع، ونسبة مساحته للحفيد قريبة من 49/9.
+    # الـ median يمسح نقط الضجيج/الملمس اللي تطلّع مئات الآلاف من الكونتورات (findContours هو الكلفة كلها)؛
+    # 3 مو أكبر لأن المستوى المصغّر فيه حلقة العلامة الخارجية ~2px
+    thr = cv2.adaptiveThreshold(cv2.medianBlur(gray, 3), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 51, 10)
+    cnts, hier = cv2.findContours(thr, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if hier is None: return []
+    hier = hier[0]; child = hier[:, 2]
+    grand = np.where(child >= 0, hier[np.maximum(child, 0), 2], -1)
+    out = []
+    for i in np.flatnonzero(grand >= 0):
+        x, y, w, h = cv2.boundingRect(cnts[i])
+        if w < 7 or h < 7 or not 0.6 < w / h < 1.66: continue
+        a_in = cv2.contourArea(cnts[grand[i]])
+        if a_in <= 0 or not 2.5 < cv2.contourArea(cnts[i]) / a_in < 12: continue
+        out.append((x + w / 2.0, y + h / 2.0, float(max(w, h))))
+    return out
+
+def pyramid_tiles(shape, cands, tile=DECODE_PYRAMID_TILE, max_tiles=DECODE_PYRAMID_MAX_TILES):
+    # [(x, y, side, علامات)]: اختيار جشع لين كل العلامات تصير بداخل tile (بعيد ثُمن عن حافة التيل).
+    # التيلات على طرف الصورة ملصوقة فيه، والحافة اللي على طرف الصورة ما لها هامش: QR بزاوية الصورة
+    # يقع كامل بتيل الزاوية
+    h, w = shape[:2]; step, m = tile * 3 // 4, tile // 8
+    xs = sorted({min(x, max(0, w - tile)) for x in range(0, max(1, w - tile + step), step)})
+    ys = sorted({min(y, max(0, h - tile)) for y in range(0, max(1, h - tile + step), step)})
+    span = lambda a, n: (a + m if a > 0 else 0, a + tile - m if a + tile < n else n)
+    def inner(x, y, c):
+        (x0, x1), (y0, y1) = span(x, w), span(y, h)
+        return x0 <= c[0] < x1 and y0 <= c[1] < y1
+    grid = [(x, y, {i for i, c in enumerate(cands) if inner(x, y, c)}) for y in ys for x in xs]
+    grid = [g for g in grid if len(g[2]) >= 2]
+    left, out = set().union(*(g[2] for g in grid)) if grid else set(), []
+    while left and len(out) < max_tiles:
+        x, y, ids = max(grid, key=lambda g: len(g[2] & left))
+        if not ids & left: break
+        out.append((x, y, tile, [cands[i] for i in ids])); left -= ids
+    return out
+
+def _decode_tile(gray, x, y, side, finders):
+    # علامة أصغر من 21px (module < 3px) -> نكبّر التيل مرتين قبل zbar
+    crop = np.ascontiguousarray(gray[y:y+side, x:x+side])
+    up = 2.0 if np.median([c[2] for c in finders]) < 21 else 1.0
+    if up != 1.0: crop = cv2.resize(crop, None, fx=up, fy=up, interpolation=cv2.INTER_CUBIC)
+    fr = _Frame(crop)
+    for name in ("plain", "adaptive"):
+        im, rot = DECODE_STAGES[name](fr)
+        t, p = decode_pyzbar(im)
+        if t: return t, [[px / up + x, py / up + y] for px, py in p], name
+    return "", [], ""
+
+def _pyramid_decode(img, plan):
+    if img.ndim == 3: img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h, w = img.shape[:2]
+    if max(w, h) <= 2000 * 1.25: return _robust_decode_ex(img, plan)   # ما فيه مستوى أعلى يستاهل
+    s = 2000.0 / max(w, h)
+    with metrics.timer("qr_decode_step_seconds", step="resize"):
+        small = cv2.resize(img, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+    t, p, stage = decode_cascade(small, ("plain",), plan=plan)
+    if t: return t, [[x / s, y / s] for x, y in p], stage
+    if plan.expired(): return "", [], ""
+    t0 = time.perf_counter()
+    with metrics.timer("qr_decode_step_seconds", step="finders"):
+        tiles = pyramid_tiles(img.shape, [(x / s, y / s, side / s) for x, y, side in finder_candidates(small)])
+    res = ("", [], "")
+    if tiles:
+        futs = [pyramid_pool().submit(_decode_tile, img, *tl) for tl in tiles]
+        try:
+            pending = set(futs)
+            while pending and not res[0]:
+                left = plan.left()
+                if left is not None and left <= 0: plan.timed_out = True; break
+                done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+                for fu in done:
+                    try: r = fu.result()
+                    except Exception:   # تيل خربان (خطأ cv2/zbar) = miss مو 500
+                        metrics.inc("qr_decode_stage_total", stage="pyramid_tile", result="error"); continue
+                    if r[0]: res = r; break
+        finally:
+            for fu in futs: fu.cancel()
+    plan.record("pyramid", bool(res[0]), time.perf_counter() - t0)
+    metrics.inc("qr_decode_stage_total", stage="pyramid", result="hit" if res[0] else "miss")
+    if res[0]: return res[0], res[1], "pyramid_" + res[2]
+    if plan.expired(): return "", [], ""
+    t, p, stage = _robust_decode_ex(small, plan)   # الـ plain بيتكرر على نفس المستوى: رخيص مقابل الباقي
+    return t, [[x / s, y / s] for x, y in p], stage
+
+# ---------- Process pools ----------
+# pool لكل غرض (decode / export)، يتبنى أول مرة بكل process (بعد fork الـ worker)
+_POOLS      = {}
+_POOL_LOCK   = threading.Lock()
+_BATCH_SLOTS = threading.BoundedSemaphore(DECODE_BATCH_INFLIGHT)
+
+def process_pool(name, workers):
+    pool, pid = _POOLS.get(name, (None, None))
+    if pool is None or pid != os.getpid():
+        with _POOL_LOCK:
+            pool, pid = _POOLS.get(name, (None, None))
+            if pool is None or pid != os.getpid():
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                _POOLS[name] = (pool, os.getpid())
+    return pool
+
+def decode_pool(): return process_pool("decode", DECODE_POOL_WORKERS)
+
+def ordered_map(pool, fn, items, inflight, *args):
+    # زي pool.map بس ما يسحب من items أكثر من inflight قدّام — الذاكرة ثابتة مهما كان العدد
+    q = deque()
+    try:
+        for it in items:
+            q.append(pool.submit(fn, it, *args))
+            if len(q) >= inflight: yield q.popleft().result()
+        while q: yield q.popleft().result()
+    finally:
+        for f in q: f.cancel()
+
+def decode_image_bytes(data):
+    # تشتغل داخل process الـ pool
+    img, f = imdecode(data)
+    if img is None: return dict(ok=False, error="bad_image", text="", poly=[])
+    t,p = robust_decode(img, f)
+    return dict(ok=bool(t), text=t or "", poly=p or [])
+
+def _batch_sources(files, raw=None):
+    # (الاسم، البايتات) لكل صورة: ملفات multipart عادية أو محتوى zip؛ بدل البايتات None (zip خربان)
+    # أو "too_large" (أكبر من DECODE_BATCH_MAX_IMAGE_BYTES)
+    def from_zip(fh):
+        try: zf = zipfile.ZipFile(fh)
+        except zipfile.BadZipFile:
+            yield "", None; return
+        with zf:
+            for info in zf.infolist():
+                if info.is_dir(): continue
+                if info.file_size > DECODE_BATCH_MAX_IMAGE_BYTES: yield info.filename, "too_large"; continue
+                yield info.filename, zf.read(info)
+    for field in files:
+        for fs in files.getlist(field):
+            if (fs.filename or "").lower().endswith(".zip") or fs.mimetype in ("application/zip","application/x-zip-compressed"):
+                yield from from_zip(fs.stream)
+            else:
+                data = fs.read(DECODE_BATCH_MAX_IMAGE_BYTES + 1)
+                yield fs.filename or field, data if len(data) <= DECODE_BATCH_MAX_IMAGE_BYTES else "too_large"
+    if raw is not None: yield from from_zip(raw)
+
+def decode_batch_stream(sources):
+    pool, pending = decode_pool(), {}
+    def record(fut):
+        index, name = pending.pop(fut)
+        try: res = fut.result()
+        except Exception as e: res = dict(ok=False, error=type(e).__name__, text="", poly=[])
+        return json.dumps(dict(index=index, name=name, **res), ensure_ascii=False) + "\n"
+    try:
+        for index, (name, data) in enumerate(sources):
+            if data is None or isinstance(data, str):
+                yield json.dumps(dict(index=index, name=name, ok=False, error=data or "bad_archive_entry", text="", poly=[])) + "\n"
+                continue
+            _BATCH_SLOTS.acquire()
+            try: fut = pool.submit(decode_image_bytes, data)
+            except Exception:
+                _BATCH_SLOTS.release(); raise
+            fut.add_done_callback(lambda _f: _BATCH_SLOTS.release())
+            pending[fut] = (index, name)
+            for f in [f for f in pending if f.done()]: yield record(f)
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for f in done: yield record(f)
+    finally:
+        for f in pending: f.cancel()
+
+# ---------- Scanner sessions ----------
+class ScanSession:
+    # حالة ماسح واحد على طول الـ stream: آخر بصمة فريم، آخر مكان للـ QR، والـ IDs اللي طلعت
+    def __init__(self, device=""):
+        self.device    = device
+        self.prev_sig  = None
+        self.last_box  = None
+        self.seen      = {}
+        self.frames = self.skipped = self.decoded = 0
+
+    @staticmethod
+    def signature(img):
+        g = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(g, (32,32), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def _decode_near_last(self, img):
+        # إعادة قراءة سريعة (plain + contrast) بالمنطقة اللي لقينا فيها الـ QR آخر مرة
+        x0,y0,x1,y1 = self.last_box
+        mx, my = (x1-x0)//2, (y1-y0)//2
+        h,w = img.shape[:2]
+        x0,y0,x1,y1 = max(0,x0-mx), max(0,y0-my), min(w,x1+mx), min(h,y1+my)
+        if x1-x0 < 16 or y1-y0 < 16: return "", [], ""
+        t,p,stage = decode_cascade(img[y0:y1, x0:x1], ("plain","contrast"), "last_roi_", DecodePlan(self.device))
+        return (t, [[x+x0, y+y0] for x,y in p], "last_roi_"+stage) if t else ("", [], "")
+
+    def feed(self, img, now=None, f=1):
+        # ترجع event لو طلع ID جديد، وإلا None (الحالة بإحداثيات الفريم المفكوك، والـ event بالأصل)
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        sig = self.signature(img)
+        if self.prev_sig is not None and float(np.abs(sig - self.prev_sig).mean()) < SCAN_SIMILAR_THRESH:
+            self.skipped += 1; return None
+        self.prev_sig = sig
+        t,p,stage = self._decode_near_last(img) if self.last_box else ("", [], "")
+        if not t: t,p,stage = robust_decode_ex(img, plan=DecodePlan(self.device))
+        if not t:
+            self.last_box = None; return None
+        xs, ys = [int(x) for x,_ in p], [int(y) for _,y in p]
+        self.last_box = (min(xs), min(ys), max(xs)+1, max(ys)+1)
+        self.decoded += 1
+        last = self.seen.get(t)
+        self.seen[t] = now
+        if last is not None and now - last < SCAN_DEDUPE_S: return None
+        return dict(event="id", frame=self.frames-1, text=t, poly=[[x*f, y*f] for x,y in p], stage=stage)
+
+    def stats(self): return dict(frames=self.frames, skipped=self.skipped, decoded=self.decoded, ids=len(self.seen))
+
+def _read_exact(stream, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = stream.read(n - len(buf))
+        if not chunk: break
+        buf += chunk
+    return bytes(buf)
+
+def scan_frames(stream, ndjson=False):
+    # فريمات من body طويل: إما [طول 4 بايت big-endian][صورة] أو أسطر NDJSON فيها image_b64.
+    # فريم أطول من الحد بالطول المسبق ينهي الـ stream (ما نقدر نتخطاه بدون ما نقراه)؛ سطر NDJSON أطول
+    # من الحد ينرمى باقيه لين نهاية السطر وينحسب فريم خربان بدل ما readline يقطّعه لفريمات
+    cap = SCAN_MAX_FRAME_BYTES*2
+    while True:
+        if ndjson:
+            line = stream.readline(cap)
+            if not line: return
+            if len(line) >= cap and not line.endswith(b"\n"):
+                while line and not line.endswith(b"\n"): line = stream.readline(1 << 16)
+                yield None, 1; continue
+            if not line.strip(): continue
+            try: obj = json.loads(line)
+            except ValueError: obj = None
+            b64 = obj.get("image_b64") if isinstance(obj, dict) else None
+            if not isinstance(b64, str): yield None, 1; continue
+            yield b64_image(b64.strip()); continue
+        else:
+            head = _read_exact(stream, 4)
+            if len(head) < 4: return
+            n = struct.unpack(">I", head)[0]
+            if n > SCAN_MAX_FRAME_BYTES: return
+            data = _read_exact(stream, n)
+            if len(data) < n: return
+        yield imdecode(data)
 
 # ---------- Dashboard ----------
 INDEX_HTML = """
@@ -284,11 +1338,11 @@ h1{margin:0 0 18px 0; padding-inline-start:140px;}
     <div class="card"><div class="muted">طلبات اليوم</div><div class="kpi">{{kpis.today}}</div></div>
     <div class="card"><div class="muted">إرسال واتساب</div><div class="kpi">{{kpis.wa}}</div></div>
   </div>
-  <div class="cards">
+  <div class="cards" id="cards">
     {% for v in last %}
     <div class="vcard">
-      <img class="vimg" id="img_{{v['id']}}" src="/qr/{{v['id']}}.png" 
-           data-qr="/qr/{{v['id']}}.png" data-badge="/card/{{v['id']}}.png" alt="preview"/>
+      <img class="vimg" id="img_{{v['id']}}" src="/qr/{{v['id']}}" 
+           data-qr="/qr/{{v['id']}}" data-badge="/card/{{v['id']}}" alt="preview"/>
       <div class="btns">
         <button class="btn active" onclick="showQR('{{v['id']}}', this)">QR</button>
         <button class="btn" onclick="showBadge('{{v['id']}}', this)">Badge</button>
@@ -300,11 +1354,31 @@ h1{margin:0 0 18px 0; padding-inline-start:140px;}
     </div>
     {% endfor %}
   </div>
+  {% if next_cursor %}<p><button class="btn" id="more" data-cursor="{{next_cursor}}" onclick="loadMore(this)">عرض المزيد</button></p>{% endif %}
 </div>
 <script>
 function activate(btn){ const p = btn.parentElement.querySelectorAll('.btn'); p.forEach(b=>b.classList.remove('active')); btn.classList.add('active'); }
 function showQR(id, btn){  const img=document.getElementById('img_'+id); img.src=img.dataset.qr;    activate(btn); }
 function showBadge(id, btn){const img=document.getElementById('img_'+id); img.src=img.dataset.badge; activate(btn); }
+function el(tag, cls, text){ const e=document.createElement(tag); if(cls) e.className=cls; if(text!==undefined) e.textContent=text; return e; }
+function card(v){
+  const c=el('div','vcard'), img=el('img','vimg'), btns=el('div','btns');
+  img.id='img_'+v.id; img.loading='lazy'; img.alt='preview';
+  img.src=img.dataset.qr='/qr/'+v.id; img.dataset.badge='/card/'+v.id;
+  const bq=el('button','btn active','QR'), bb=el('button','btn','Badge');
+  bq.onclick=()=>showQR(v.id,bq); bb.onclick=()=>showBadge(v.id,bb);
+  const dl=el('a','btn','تحميل QR'); dl.href='/qr/'+v.id+'.png?dl=1';
+  const op=el('a','btn','فتح الباج'); op.href='/card/'+v.id+'.png'; op.target='_blank';
+  btns.append(bq,bb,dl,op);
+  c.append(img,btns,el('div','name',v.name),el('div','sub',v.company+' — '+v.created_at.slice(0,16).replace('T',' ')));
+  return c;
+}
+async function loadMore(btn){
+  btn.disabled=true;
+  const r=await fetch('/visitors?limit=12&cursor='+encodeURIComponent(btn.dataset.cursor)); const j=await r.json();
+  const box=document.getElementById('cards'); (j.items||[]).forEach(v=>box.appendChild(card(v)));
+  if(j.next_cursor){ btn.dataset.cursor=j.next_cursor; btn.disabled=false; } else btn.remove();
+}
 </script>
 </body></html>
 """
@@ -322,28 +1396,859 @@ def pick(d,*keys):
         if k and k in d and d[k]: return d[k]
     return ""
 
+def flag_arg(name):
+    # ?name=1 أو حقل فورم/JSON
+    data = request.get_json(silent=True) if request.is_json else None
+    v = request.args.get(name) or request.form.get(name) or (data or {}).get(name)
+    return str(v).lower() in ("1","true","yes","on")
+
+def request_image(min_side=None):
+    # (صورة رمادية، f) من ملف multipart أو body صورة خام أو image_b64 بالـ JSON؛ (None, 1) لو ما فيه
+    for field in ("image","file","photo","frame","upload"):
+        if field in request.files:
+            with upload_buffer(request.files[field]) as buf: return imdecode(buf, min_side)
+    if request.data and request.content_type and ("image/" in request.content_type or "application/octet-stream" in request.content_type):
+        return imdecode(request.data, min_side)
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        return b64_image((data.get("image_b64") or data.get("image") or "").strip(), min_side)
+    return None, 1
+
+def request_pyramid():
+    # (pyramid؟، min_side لـ imdecode)
+    on = DECODE_PYRAMID or flag_arg("pyramid")
+    return on, (DECODE_PYRAMID_MAX_SIDE if on else None)
+
+def request_device():
+    return (request.headers.get(DECODE_DEVICE_HEADER) or "").strip()[:64]
+
+def request_plan():
+    # deadline_ms من الـ query أو الفورم أو الـ JSON (وإلا DECODE_DEADLINE_MS)
+    data = request.get_json(silent=True) if request.is_json else None
+    raw  = request.args.get("deadline_ms") or request.form.get("deadline_ms") or (data or {}).get("deadline_ms")
+    try: ms = max(0.0, float(raw)) if raw not in (None, "") else DECODE_DEADLINE_MS
+    except (TypeError, ValueError): ms = DECODE_DEADLINE_MS
+    return DecodePlan(request_device(), ms)
+
+def encode_cursor(rec):
+    raw = json.dumps([rec["created_at"], rec["id"]], separators=(",",":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cur):
+    try:
+        v = json.loads(base64.urlsafe_b64decode(cur + "=" * (-len(cur) % 4)))
+        return (str(v[0]), str(v[1])) if isinstance(v, list) and len(v) == 2 else None
+    except Exception: return None
+
+# ---------- Registration ----------
+# INSERT ... ON CONFLICT DO NOTHING بدل SELECT ثم INSERT: طلبين لنفس الشخص (retry من Apps Script)
+# ما يطيحون على UNIQUE؛ الثاني ياخذ الموجود. مفتاح الـ idempotency وjob الواتساب بنفس الـ transaction،
+# فالـ retry يرجع نفس النتيجة بدون رسالة ثانية حتى لو الأولى انرسلت.
+def _register_one(con, item, now):
+    key = item.get("key")
+    if key:
+        row = con.execute(db.SQL_IDEM_GET, (key, datetime.utcfromtimestamp(now - IDEMPOTENCY_TTL_S).isoformat())).fetchone()
+        if row: return dict(json.loads(row["result"]), replayed=True)
+    name, company, position, email, phone = item["fields"]
+    ts = datetime.utcfromtimestamp(now).isoformat()
+    for _ in range(3):
+        vid, pin = rand_token(), rand_pin()
+        if con.execute(db.SQL_VISITOR_UPSERT, (vid,name,company,position,email,phone,pin,ts)).rowcount:
+            rec, created = dict(id=vid, name=name, company=company, position=position, email=email, phone=phone), True
+            break
+        row = con.execute(db.SQL_VISITOR_CONTACT, (email, phone)).fetchone()
+        if row: rec, created = dict(row), False; break
+        # ما فيه زائر بنفس التواصل: تصادم ID عشوائي، نجرب توكن ثاني
+    else: raise sqlite3.IntegrityError("could not allocate visitor id")
+    out = dict(id=rec["id"], name=rec["name"], created=created, replayed=False)
+    if item.get("wa"):
+        job = _wa_insert(con, rec, now)
+        out["whatsapp"] = dict(ok=True, status="queued" if job else "already_queued", job=job)
+    if key: con.execute(db.SQL_IDEM_PUT, (key, rec["id"], json.dumps(out), ts))
+    out["_rec"] = rec
+    return out
+
+class RegisterBatcher:
+    # group commit بدون thread: أول طلب يصير leader ويكتب كل اللي تجمعوا وهو ينتظر القفل،
+    # وبعد الـ COMMIT يسلّم القيادة لأول واحد وصل خلال الكتابة
+    def __init__(self, batch=REGISTER_BATCH, wait_s=REGISTER_BATCH_S):
+        self.batch, self.wait_s = max(1, batch), wait_s
+        self.lock, self.pending, self.leading = threading.Lock(), [], False
+        self.purged = 0.0
+
+    def submit(self, item):
+        item["ev"] = threading.Event()
+        with self.lock:
+            self.pending.append(item)
+            lead = not self.leading
+            self.leading = True
+        if not lead:
+            item["ev"].wait()
+            if not item.pop("lead", False): return self._result(item)
+        if self.wait_s: time.sleep(self.wait_s)
+        with self.lock:
+            batch, self.pending = self.pending[:self.batch], self.pending[self.batch:]
+        try: self._commit(batch)
+        finally:
+            with self.lock:
+                if self.pending: nxt = self.pending[0]; nxt["lead"] = True; nxt["ev"].set()
+                else: self.leading = False
+            for it in batch: it["ev"].set()
+        return self._result(item)
+
+    @staticmethod
+    def _result(item):
+        if "error" in item: raise item["error"]
+        return item["result"]
+
+    def _commit(self, batch):
+        now, jobs = time.time(), False
+        for attempt in range(REGISTER_RETRIES + 1):
+            for it in batch: it.pop("result", None); it.pop("error", None)
+            try:
+                self._write(batch, now)
+                break
+            except sqlite3.OperationalError as e:
+                # القفل ما تحرر خلال busy_timeout: الـ transaction كلها رجعت، نعيد الدفعة كاملة وبعدها 503
+                if attempt < REGISTER_RETRIES: continue
+                err = Overloaded("register", "db_locked", max(1, math.ceil(REGISTER_RETRY_S)))
+                err.__cause__ = e
+                for it in batch: it.pop("result", None); it["error"] = err
+            except Exception as e:
+                for it in batch: it.pop("result", None); it["error"] = e
+                break
+        metrics.inc("qr_register_batches_total")
+        for it in batch:
+            res = it.get("result")
+            if not res: metrics.inc("qr_register_total", result="error"); continue
+            rec = res.pop("_rec", None)
+            if rec and res["created"]: registry.add(rec)
+            jobs = jobs or bool(rec and (res.get("whatsapp") or {}).get("job"))
+            metrics.inc("qr_register_total", result="replayed" if res["replayed"] else "created" if res["created"] else "existing")
+        if jobs: start_wa_workers(); _wa_wake.set()
+
+    def _write(self, batch, now):
+        with metrics.timer("qr_register_commit_seconds"), db.transaction() as con:
+            for it in batch:
+                # savepoint لكل تسجيل: خطأ بواحد ما يرجّع الباقين
+                con.execute("SAVEPOINT reg")
+                try: it["result"] = _register_one(con, it, now)
+                except sqlite3.Error as e:
+                    con.execute("ROLLBACK TO reg"); it["error"] = e
+                con.execute("RELEASE reg")
+            if now - self.purged > 600:
+                con.execute(db.SQL_IDEM_PURGE, (datetime.utcfromtimestamp(now - IDEMPOTENCY_TTL_S).isoformat(),))
+                self.purged = now
+
+register_batcher = RegisterBatcher()
+
+def register(fields, key=None, wa=False):
+    # dict(id, name, created, replayed[, whatsapp]) — نفس الرد لنفس المفتاح
+    return register_batcher.submit(dict(fields=fields, key=key, wa=wa))
+
+def idempotency_key(scope, fields, data=None):
+    # الهيدر، ثم responseId من Apps Script، وإلا hash للحقول بعد التنظيف
+    data = data or {}
+    k = str(request.headers.get(IDEMPOTENCY_HEADER) or pick(data, "idempotency_key", "responseId", "response_id") or "").strip()
+    if not k: k = "sha256:" + hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+    return f"{scope}:{k[:200]}"
+
+def registration_fields(data):
+    # (name, company, position, email, phone) بنفس التنظيف بكل مداخل التسجيل
+    return ((pick(data,"name","Name","الاسم","Full Name") or "").strip(),
+            (pick(data,"company","Company","الشركة") or "").strip(),
+            (pick(data,"position","Position","المنصب") or "").strip(),
+            (pick(data,"email","Email","البريد") or "").strip().lower(),
+            (pick(data,"phone","Phone","الهاتف") or "").strip())
+
 def _ensure_dir(path):
     d = os.path.dirname(path)
     if d: os.makedirs(d, exist_ok=True)
 
+# ---------- Bulk import ----------
+# قراءة stream سطر بسطر، وكل IMPORT_BATCH صف بـ transaction وحدة و executemany.
+# التكرار (إيميل أو جوال) يُحسب "موجود" مثل /create، سواء بالداتابيس أو بنفس الملف.
+def iter_import_rows(fh, fmt):
+    text = io.TextIOWrapper(fh, encoding="utf-8-sig", newline="")
+    if fmt == "jsonl":
+        for line in text:
+            if not line.strip(): continue
+            try: row = json.loads(line)
+            except ValueError: row = None
+            yield row if isinstance(row, dict) else None
+    else:
+        yield from csv.DictReader(text)
+
+def import_format(filename="", content_type=""):
+    name, ctype = (filename or "").lower(), (content_type or "").lower()
+    return "jsonl" if name.endswith((".jsonl",".ndjson")) or "json" in ctype else "csv"
+
+def _existing_contacts(con, col, values):
+    found = set()
+    values = list(values)
+    for i in range(0, len(values), 500):
+        chunk = values[i:i+500]
+        q = f"SELECT {col} FROM visitors WHERE {col} IN ({','.join('?'*len(chunk))})"
+        found.update(r[0] for r in con.execute(q, chunk))
+    return found
+
+def _import_batch(batch, seen_email, seen_phone, summary):
+    with db.transaction() as con:
+        db_email = _existing_contacts(con, "email", {r[3] for r in batch})
+        db_phone = _existing_contacts(con, "phone", {r[4] for r in batch})
+        now, rows = datetime.utcnow().isoformat(), []
+        for name, company, position, email, phone in batch:
+            if email in db_email or phone in db_phone or email in seen_email or phone in seen_phone:
+                summary["existing"] += 1
+            else:
+                rows.append((rand_token(), name, company, position, email, phone, rand_pin(), now))
+            seen_email.add(email); seen_phone.add(phone)
+        # OR IGNORE: لو تسجيل من الويبهوك سبقنا بنفس اللحظة؛ rowcount = المضاف فعلاً (بدون الـ triggers)
+        n = con.executemany(db.SQL_VISITOR_INSERT_IGNORE, rows).rowcount if rows else 0
+    registry.add_ids(r[0] for r in rows)   # المتجاهَلة (OR IGNORE) تبقى false positive بالفلتر، ما تضر
+    summary["inserted"] += n
+    summary["existing"] += len(rows) - n
+
+def import_visitors(rows_iter):
+    summary = dict(inserted=0, existing=0, rejected=0, rows=0, errors=[])
+    seen_email, seen_phone, batch = set(), set(), []
+    for line_no, row in enumerate(rows_iter, 1):
+        summary["rows"] += 1
+        fields = registration_fields(row) if isinstance(row, dict) else None
+        if not fields or not all(fields):
+            summary["rejected"] += 1
+            if len(summary["errors"]) < 20: summary["errors"].append(dict(row=line_no, error="missing_fields" if fields else "bad_row"))
+            continue
+        batch.append(fields)
+        if len(batch) >= IMPORT_BATCH:
+            _import_batch(batch, seen_email, seen_phone, summary); batch = []
+    if batch: _import_batch(batch, seen_email, seen_phone, summary)
+    return summary
+
+# ---------- Print-run export ----------
+# الرسم بالـ process pool (ordered_map) والكتابة تدريجياً: ZIP بـ PNG لكل زائر، أو PDF
+# فيه كل صفحة شبكة باجات بمقاسها الحقيقي حسب BADGE_DPI.
+PAGE_SIZES_PT = {"A4": (595.28, 841.89), "A3": (841.89, 1190.55), "LETTER": (612.0, 792.0)}
+
+def render_export_item(rec, fmt):
+    # تشتغل داخل process الـ pool
+    if fmt == "zip":
+        return rec["id"], make_badge_png(rec["name"], rec["company"], rec["position"], visitor_id=rec["id"]).getvalue()
+    img = compose_badge_portrait(rec["name"], rec["company"], rec["position"], visitor_id=rec["id"])
+    return rec["id"], (img.width, img.height, zlib.compress(img.tobytes(), 6))
+
+class _ChunkSink:
+    # ملف للكتابة فقط: zipfile/PDF يكتبوا فيه ونفرّغه قطع للـ stream
+    def __init__(self): self.chunks = []
+    def write(self, b): self.chunks.append(bytes(b)); return len(b)
+    def flush(self): pass
+    def drain(self):
+        out = b"".join(self.chunks); self.chunks = []; return out
+
+class PdfSheetWriter:
+    # PDF بسيط يتكتب تدريجياً: كل باج image XObject (Flate) مرسوم بمقاسه على شبكة الصفحة،
+    # والـ xref/Pages بالنهاية. ما نحتفظ إلا بأرقام الكائنات وإزاحاتها.
+    def __init__(self, out, page=EXPORT_PAGE, margin_cm=EXPORT_MARGIN_CM, dpi=BADGE_DPI):
+        self.out, self.pos, self.offsets, self.kids = out, 0, {}, []
+        self.pw, self.ph = PAGE_SIZES_PT.get(page, PAGE_SIZES_PT["A4"])
+        self.margin, self.dpi = margin_cm/2.54*72, dpi
+        self.next_obj, self.slot, self.layout, self.cells = 3, 0, None, []   # 1 = Catalog, 2 = Pages
+        self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _emit(self, b): self.out.write(b); self.pos += len(b)
+
+    def _obj(self, body, stream=None, num=None):
+        num = num or self._alloc()
+        self.offsets[num] = self.pos
+        self._emit(f"{num} 0 obj\n".encode())
+        if stream is None: self._emit(body.encode() + b"\nendobj\n")
+        else: self._emit(body.encode() + b"\nstream\n" + stream + b"\nendstream\nendobj\n")
+        return num
+
+    def _alloc(self):
+        n = self.next_obj; self.next_obj += 1; return n
+
+    def _grid(self, w_px, h_px):
+        bw, bh = w_px/self.dpi*72, h_px/self.dpi*72
+        cols = max(1, int((self.pw - 2*self.margin) // bw))
+        rows = max(1, int((self.ph - 2*self.margin) // bh))
+        x0, y0 = (self.pw - cols*bw)/2, (self.ph - rows*bh)/2
+        return [(x0 + c*bw, self.ph - y0 - (r+1)*bh, bw, bh) for r in range(rows) for c in range(cols)]
+
+    def add(self, w_px, h_px, flate_rgb):
+        if self.layout is None: self.layout = self._grid(w_px, h_px)
+        im = self._obj(f"<< /Type /XObject /Subtype /Image /Width {w_px} /Height {h_px} /ColorSpace /DeviceRGB "
+                       f"/BitsPerComponent 8 /Filter /FlateDecode /Length {len(flate_rgb)} >>", flate_rgb)
+        self.cells.append((im, self.layout[self.slot]))
+        self.slot += 1
+        if self.slot == len(self.layout): self._flush_page()
+
+    def _flush_page(self):
+        if not self.cells: return
+        ops = []
+        for i,(im,(x,y,w,h)) in enumerate(self.cells):
+            ops.append(f"q {w:.2f} 0 0 {h:.2f} {x:.2f} {y:.2f} cm /I{i} Do Q")
+            ops.append(f"q 0.8 G 0.25 w {x:.2f} {y:.2f} {w:.2f} {h:.2f} re S Q")   # خط قص خفيف
+        content = "\n".join(ops).encode()
+        c = self._obj(f"<< /Length {len(content)} >>", content)
+        xobjs = " ".join(f"/I{i} {im} 0 R" for i,(im,_) in enumerate(self.cells))
+        self.kids.append(self._obj(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {self.pw:.2f} {self.ph:.2f}] "
+                                   f"/Resources << /XObject << {xobjs} >> >> /Contents {c} 0 R >>"))
+        self.cells, self.slot = [], 0
+
+    def close(self):
+        self._flush_page()
+        kids = " ".join(f"{k} 0 R" for k in self.kids)
+        self._obj(f"<< /Type /Pages /Kids [{kids}] /Count {len(self.kids)} >>", num=2)
+        self._obj("<< /Type /Catalog /Pages 2 0 R >>", num=1)
+        xref = self.pos
+        lines = [f"xref\n0 {self.next_obj}\n", "0000000000 65535 f \n"]
+        lines += [f"{self.offsets.get(n, 0):010d} 00000 {'n' if n in self.offsets else 'f'} \n" for n in range(1, self.next_obj)]
+        self._emit("".join(lines).encode())
+        self._emit(f"trailer\n<< /Size {self.next_obj} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+def export_badges(out, fmt, visitors):
+    # generator: يكتب في out ويعطي العدد بعد كل باج (عشان الـ stream يفرّغ اللي انكتب)
+    pool, n = process_pool("export", EXPORT_POOL_WORKERS), 0
+    if fmt == "zip":
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+            for vid, png in ordered_map(pool, render_export_item, visitors, EXPORT_INFLIGHT, fmt):
+                zf.writestr(f"{vid}.png", png); n += 1; yield n
+    else:
+        pdf = PdfSheetWriter(out)
+        for vid, (w, h, data) in ordered_map(pool, render_export_item, visitors, EXPORT_INFLIGHT, fmt):
+            pdf.add(w, h, data); n += 1; yield n
+        pdf.close()
+
+def export_stream(fmt, visitors):
+    sink = _ChunkSink()
+    for _ in export_badges(sink, fmt, visitors):
+        b = sink.drain()
+        if b: yield b
+    b = sink.drain()   # central directory / xref
+    if b: yield b
+
+# ---------- Visitor registry ----------
+# السكان (lookup/decode_badge/qr/card) يقرأ الزائر من كاش LRU بكل worker. قبل القاعدة: ID بغير
+# شكل rand_token أو مو بالـ Bloom filter = غير موجود بدون استعلام. الإضافات من نفس الـ process
+# تدخل الكاش والفلتر مباشرة، واللي من process ثاني (worker/استيراد CLI) تنسحب بـ rowid > watermark
+# لما يتغير PRAGMA data_version (نفحصه مع رفض الفلتر، مرة كل REGISTRY_SYNC_MS).
+# الزوار ما ينحذفون ولا يتعدلون، فما فيه invalidation غير الإضافة.
+class BloomFilter:
+    def __init__(self, capacity, fp=REGISTRY_BLOOM_FP):
+        self.capacity = max(1024, int(capacity))
+        self.m = int(math.ceil(-self.capacity * math.log(fp) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / self.capacity * math.log(2)))
+        self.bits, self.n = bytearray((self.m + 7) // 8), 0
+
+    def _positions(self, key):
+        # double hashing: k موقع من blake2b وحد
+        d = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+        h1, h2, m = d & 0xFFFFFFFFFFFFFFFF, (d >> 64) | 1, self.m
+        return ((h1 + i * h2) % m for i in range(self.k))
+
+    def add(self, key):
+        for p in self._positions(key): self.bits[p >> 3] |= 1 << (p & 7)
+        self.n += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] >> (p & 7) & 1: return False   # أغلب الـ IDs الغلط تطلع من أول بت أو ثاني
+        return True
+
+class VisitorRegistry:
+    def __init__(self, size=REGISTRY_CACHE_SIZE, pattern=REGISTRY_ID_PATTERN):
+        self.size  = size
+        self.shape = re.compile(pattern) if pattern else None
+        self.cache = OrderedDict()
+        self.lock  = threading.Lock()
+        self.bloom, self.watermark, self.synced = None, 0, 0.0
+        self.rebuilding = None   # IDs انضافت أثناء بناء فلتر أكبر بالخلفية (None = ما فيه بناء)
+        self.local = threading.local()
+        self.snapshot = None
+
+    def load(self, con=None):
+        # بناء كامل؛ السعة ضعف العدد الحالي عشان الإضافات ما تعبّي الفلتر بسرعة
+        if REGISTRY_SNAPSHOT:
+            self.snapshot = snapshot.Snapshot(REGISTRY_SNAPSHOT)
+            return self.snapshot.stats()["visitors"]
+        con = con or db.conn()
+        rows = con.execute(db.SQL_VISITOR_IDS_AFTER, (0,)).fetchall()
+        bloom = BloomFilter(2 * len(rows))
+        for r in rows: bloom.add(r["id"])
+        with self.lock:
+            for vid in self.rebuilding or (): bloom.add(vid)   # انضافت بعد ما قرينا الجدول
+            self.bloom, self.watermark, self.rebuilding = bloom, max(self.watermark, rows[-1]["rowid"] if rows else 0), None
+            if self.shape and any(not self.shape.match(r["id"]) for r in rows):
+                self.shape = None   # قاعدة فيها IDs قديمة بشكل ثاني: نعتمد على الفلتر بس
+        return len(rows)
+
+    def _sync(self):
+        # True لو القاعدة تغيرت من process ثاني من آخر مرة (لهذا الاتصال) وسحبنا الجديد
+        self.synced = time.monotonic()
+        con = db.conn()
+        ver = (id(con), con.execute("PRAGMA data_version").fetchone()[0])
+        if getattr(self.local, "ver", None) == ver and self.bloom is not None: return False
+        self.local.ver = ver
+        if self.bloom is None: self.load(con); return True
+        rows = con.execute(db.SQL_VISITOR_IDS_AFTER, (self.watermark,)).fetchall()
+        if not rows: return False
+        self.add_ids([r["id"] for r in rows])
+        with self.lock: self.watermark = max(self.watermark, rows[-1]["rowid"])
+        return True
+
+    def might_exist(self, vid):
+        if self.shape and not self.shape.match(vid):
+            metrics.inc("qr_registry_total", result="shape_reject"); return False
+        bloom = self.bloom
+        if bloom is None: self._sync(); bloom = self.bloom
+        if vid in bloom: return True
+        # رفض الفلتر يصدق إلا لو القاعدة تغيرت من برّا؛ نسأل SQLite عن هذا مرة كل REGISTRY_SYNC_S بالكثير
+        if time.monotonic() - self.synced >= REGISTRY_SYNC_S and self._sync() and vid in (self.bloom or bloom): return True
+        metrics.inc("qr_registry_total", result="bloom_reject"); return False
+
+    def get(self, vid, strict=True):
+        # dict (id,name,company,position) أو None. strict=False (صفحات الرسم): بدون الفلتر، فالزائر المسجّل
+        # من worker ثاني قبل أول sync يطلع من SQLite بدل 404 (الفلتر لمسارات المسح بس)
+        if REGISTRY_SNAPSHOT: return self._get_snapshot(vid)
+        with self.lock:
+            rec = self.cache.get(vid)
+            if rec is not None: self.cache.move_to_end(vid)
+        if rec is not None:
+            metrics.inc("qr_registry_total", result="hit"); return dict(rec)
+        if strict and not self.might_exist(vid): return None
+        row = db.row(db.SQL_VISITOR_LOOKUP, (vid,))
+        metrics.inc("qr_registry_total", result="miss" if row else "unknown")
+        if not row: return None
+        rec = dict(row); self._put(rec)
+        return dict(rec)
+
+    def _get_snapshot(self, vid):
+        # mmap مشترك + bisect؛ ما يحتاج كاش ولا فلتر
+        if self.shape and not self.shape.match(vid):
+            metrics.inc("qr_registry_total", result="shape_reject"); return None
+        if self.snapshot is None: self.load()
+        rec = self.snapshot.get(vid)
+        metrics.inc("qr_registry_total", result="snapshot_hit" if rec else "unknown")
+        return rec
+
+    def get_many(self, vids):
+        # {id: dict} للموجودين؛ الكاش أول، وبعدين استعلام IN واحد للباقي اللي عدّى الفلتر
+        if REGISTRY_SNAPSHOT: return {v: r for v in dict.fromkeys(vids) for r in [self._get_snapshot(v)] if r}
+        out, need = {}, []
+        for vid in dict.fromkeys(vids):
+            with self.lock:
+                rec = self.cache.get(vid)
+                if rec is not None: self.cache.move_to_end(vid)
+            if rec is not None: out[vid] = dict(rec); metrics.inc("qr_registry_total", result="hit")
+            elif self.might_exist(vid): need.append(vid)
+        for row in (db.visitors_by_ids(need) if need else []):
+            rec = dict(row); self._put(rec); out[rec["id"]] = dict(rec)
+        for vid in need: metrics.inc("qr_registry_total", result="miss" if vid in out else "unknown")
+        return out
+
+    def _put(self, rec):
+        with self.lock:
+            self.cache[rec["id"]] = rec; self.cache.move_to_end(rec["id"])
+            while len(self.cache) > self.size: self.cache.popitem(last=False)
+
+    def add(self, rec):
+        # بعد INSERT من نفس الـ process
+        self.add_ids([rec["id"]])
+        self._put({k: rec[k] for k in ("id", "name", "company", "position")})
+
+    def add_ids(self, ids):
+        with self.lock:
+            if self.bloom is None: return
+            ids = list(ids)
+            for vid in ids: self.bloom.add(vid)
+            if self.rebuilding is not None: self.rebuilding.extend(ids)
+            elif self.bloom.n > self.bloom.capacity:
+                # امتلأ: الفلتر القديم يبقى يخدم (false positives أكثر بس بدون false negatives) والجديد
+                # بضعف العدد يتبنى بـ thread، مو بمسح الجدول داخل request سكان
+                self.rebuilding = []
+                threading.Thread(target=self._rebuild, name="registry-bloom", daemon=True).start()
+
+    def _rebuild(self):
+        con = db.connect()
+        try: self.load(con)
+        except Exception:
+            with self.lock: self.rebuilding = None   # نحاول مرة ثانية مع الإضافة الجاية
+        finally: con.close()
+
+    def stats(self):
+        with self.lock:
+            b = self.bloom
+            return dict(cached=len(self.cache), size=self.size, shape_check=bool(self.shape), watermark=self.watermark,
+                        bloom=dict(items=b.n, capacity=b.capacity, bits=b.m, hashes=b.k,
+                                   rebuilding=self.rebuilding is not None) if b else None,
+                        snapshot=self.snapshot.stats() if self.snapshot else None)
+
+registry = VisitorRegistry()
+
+# ---------- Check-ins ----------
+# أول دخول ولا رجوع: ذاكرة الـ worker أول، وبعدين القاعدة (قراءة بس). بين workers مختلفين
+# الـ flag ممكن يتأخر لحد CHECKIN_FLUSH_MS (الحدث لسه بذاكرة worker ثاني).
+class CheckinLog:
+    def __init__(self, batch=CHECKIN_BATCH, flush_s=CHECKIN_FLUSH_S, max_buffer=CHECKIN_MAX_BUFFER, seen_max=CHECKIN_SEEN_MAX):
+        self.batch, self.flush_s, self.max_buffer, self.seen_max = batch, flush_s, max_buffer, seen_max
+        self.buf    = []
+        self.seen   = OrderedDict()
+        self.cond   = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.pid    = None
+        self.closed = False
+        self.written = self.dropped = 0
+
+    def _start(self):
+        if self.pid == os.getpid(): return
+        with self.cond:
+            if self.pid == os.getpid(): return
+            self.buf, self.seen, self.closed = [], OrderedDict(), False
+            threading.Thread(target=self._run, name="checkin-flush", daemon=True).start()
+            self.pid = os.getpid()
+
+    def _remember(self, vid):
+        # True لو الـ ID كان معروف قبل (بالذاكرة)
+        with self.cond:
+            known = vid in self.seen
+            self.seen[vid] = True; self.seen.move_to_end(vid)
+            while len(self.seen) > self.seen_max: self.seen.popitem(last=False)
+        return known
+
+    def add(self, vid, gate, stage):
+        self._start()
+        with self.cond:
+            known = vid in self.seen
+            if known: self.seen.move_to_end(vid)
+        first = not known and db.row(db.SQL_CHECKIN_SEEN, (vid,)) is None
+        if not known and self._remember(vid): first = False   # thread ثاني بنفس الـ worker سبقنا
+        ev = (vid, gate, stage, datetime.utcnow().isoformat(), int(first))
+        with self.cond:
+            self.buf.append(ev)
+            if len(self.buf) > self.max_buffer:
+                n = len(self.buf) - self.max_buffer; del self.buf[:n]; self.dropped += n
+                metrics.inc("qr_checkin_dropped_total", n)
+            if len(self.buf) >= self.batch: self.cond.notify()
+        metrics.inc("qr_checkins_total", entry="first" if first else "reentry")
+        return dict(first=first, gate=gate, ts=ev[3])
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.buf) >= self.batch or self.closed, timeout=self.flush_s)
+                if self.closed: return
+            self.flush()
+
+    def flush(self):
+        # group commit: كل اللي بالـ buffer بـ transaction وحدة؛ لو فشل يرجعون لأول الـ buffer
+        with self.flush_lock:
+            with self.cond: rows, self.buf = self.buf, []
+            if not rows: return 0
+            t0 = time.perf_counter()
+            try:
+                with db.transaction() as con: con.executemany(db.SQL_CHECKIN_INSERT, rows)
+            except Exception:
+                with self.cond: self.buf[:0] = rows
+                metrics.inc("qr_checkin_flush_errors_total")
+                return 0
+            metrics.observe("qr_checkin_flush_seconds", time.perf_counter() - t0)
+            self.written += len(rows)
+            return len(rows)
+
+    def close(self):
+        # نهاية الـ worker: نوقف الـ thread ونكتب الباقي
+        if self.pid != os.getpid(): return
+        with self.cond: self.closed = True; self.cond.notify_all()
+        self.flush()
+
+    def stats(self):
+        with self.cond: return dict(pending=len(self.buf), written=self.written, dropped=self.dropped, known_ids=len(self.seen))
+
+checkin_log = CheckinLog()
+atexit.register(checkin_log.close)
+
+def request_gate():
+    return ((request.args.get("gate") or request.headers.get(CHECKIN_GATE_HEADER) or request_device() or "default")
+            .strip()[:64])
+
+def wants_checkin():
+    return (request.args.get("checkin") or "1").lower() not in ("0","false","no")
+
+# ---------- WhatsApp queue ----------
+# الويبهوك يضيف job بجدول wa_jobs ويرجع فوراً؛ workers بكل process ياخذوا الـ jobs المستحقة
+# (lease عن طريق next_at عشان لو مات worker ترجع الـ job لغيره) ويرسلوا عبر Session واحدة keep-alive.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, float(burst)
+        self.tokens, self.t = float(burst), time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now-self.t)*self.rate); self.t = now
+                if self.tokens >= 1: self.tokens -= 1; return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+_wa_lock, _wa_pid, _wa_session = threading.Lock(), None, None
+_wa_wake    = threading.Event()
+_wa_buckets = OrderedDict()
+
+def _wa_bucket(dest):
+    # bucket لكل رقم مستلم بهذا الـ process؛ الـ bucket اللي انشال يرجع ممتلي (burst) وهذا مقبول
+    with _wa_lock:
+        b = _wa_buckets.get(dest)
+        if b is None:
+            b = _wa_buckets[dest] = TokenBucket(WA_RATE_PER_S, WA_RATE_BURST)
+            while len(_wa_buckets) > WA_RATE_DESTS: _wa_buckets.popitem(last=False)
+        else: _wa_buckets.move_to_end(dest)
+    return b
+
+def start_wa_workers():
+    global _wa_pid, _wa_session
+    if not WA_PROXY_URL or requests is None or _wa_pid == os.getpid(): return
+    with _wa_lock:
+        if _wa_pid == os.getpid(): return
+        _wa_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, WA_WORKERS))
+        _wa_session.mount("http://", adapter); _wa_session.mount("https://", adapter)
+        for i in range(WA_WORKERS):
+            threading.Thread(target=_wa_worker, name=f"wa-{i}", daemon=True).start()
+        _wa_pid = os.getpid()
+
+def _wa_insert(con, rec, now):
+    # داخل transaction التسجيل (RegisterBatcher)؛ رقم الـ job، أو None لو فيه job معلّقة لنفس الزائر أصلاً
+    ts = datetime.utcfromtimestamp(now).isoformat()
+    cur = con.execute(db.SQL_WA_ENQUEUE, (rec["id"], rec["phone"], rec["name"], now, ts, ts, rec["id"]))
+    return cur.lastrowid if cur.rowcount else None
+
+def _wa_claim():
+    # البحث قراءة عادية (الـ poll الفاضي ما ياخذ قفل الكتابة)، والـ UPDATE مشروط بأن الـ job لسه
+    # مستحقة: لو worker ثاني سبقنا عليها rowcount = 0 ونجرّب اللي بعدها
+    for _ in range(3):
+        now = time.time()
+        row = db.row(db.SQL_WA_DUE, (now,))
+        if not row: return None
+        with db.transaction() as con:
+            cur = con.execute(db.SQL_WA_CLAIM, (now + WA_LEASE_S, datetime.utcnow().isoformat(), row["id"], now))
+        if cur.rowcount: return dict(row)
+    return None
+
+def _wa_finish(job, error=None, permanent=False):
+    ts = datetime.utcnow().isoformat()
+    with db.transaction() as con:
+        if error is None:
+            con.execute(db.SQL_WA_DONE, (ts, job["id"]))
+            con.execute(db.SQL_VISITOR_WA_SENT, (ts, job["visitor_id"]))
+            return
+        attempts = job["attempts"] + 1
+        if permanent or attempts >= WA_MAX_ATTEMPTS:
+            con.execute(db.SQL_WA_RETRY, ("failed", time.time(), error[:500], ts, job["id"]))
+        else:
+            delay = min(WA_BACKOFF_MAX_S, WA_BACKOFF_S * 2**(attempts-1)) * random.uniform(0.8, 1.2)
+            con.execute(db.SQL_WA_RETRY, ("pending", time.time()+delay, error[:500], ts, job["id"]))
+
+def _wa_image(job):
+    # صورة QR فقط (مو الباج) بأصغر صيغة من WA_IMAGE_FORMATS — من كاش الرسم لو موجودة
+    best = None
+    for fmt in WA_IMAGE_FORMATS:
+        key  = render_key("qr", job["visitor_id"], job["name"], fmt)
+        data = render_cache.get(key)
+        if data is None:
+            data = make_qr_png(job["visitor_id"], label_name=job["name"], fmt=fmt).getvalue(); render_cache.put(key, data)
+        if best is None or len(data) < len(best[1]): best = (fmt, data)
+    return best
+
+def _wa_send(job):
+    fmt, data = _wa_image(job)
+    files = {"file": (f"qr.{fmt}", data, FORMAT_MIME[fmt])}
+    data  = {"to": job["dest"], "name": job["name"]}
+    _wa_bucket(job["dest"]).acquire()
+    return _wa_session.post(WA_PROXY_URL, files=files, data=data, timeout=WA_TIMEOUT_S)
+
+def _wa_worker():
+    while True:
+        try:
+            job = _wa_claim()
+            if job is None:
+                _wa_wake.wait(WA_POLL_S); _wa_wake.clear(); continue
+            try:
+                r = _wa_send(job)
+            except Exception as e:
+                _wa_finish(job, f"{type(e).__name__}: {e}"); continue
+            if r.ok: _wa_finish(job)
+            else:
+                permanent = 400 <= r.status_code < 500 and r.status_code not in (408, 429)
+                _wa_finish(job, f"{r.status_code}: {r.text[:200]}", permanent)
+        except Exception:
+            time.sleep(WA_POLL_S)  # مشكلة بالداتابيس مثلاً: نعيد المحاولة بعد شوي
+
+def wa_queue_stats():
+    by = {r["status"]: dict(r) for r in db.rows(db.SQL_WA_STATS)}
+    n  = lambda st: by.get(st, {}).get("n", 0)
+    pending = by.get("pending", {})
+    return dict(
+        enabled=bool(WA_PROXY_URL and requests is not None),
+        depth=n("pending") + n("sending"),
+        pending=n("pending"), sending=n("sending"), sent=n("sent"), failed=n("failed"),
+        retrying=pending.get("retrying") or 0,
+        oldest_due_s=round(max(0.0, time.time() - pending["next_at"]), 3) if pending.get("next_at") else 0.0,
+        recent_errors=[dict(r) for r in db.rows(db.SQL_WA_ERRORS)],
+    )
+
+@app.before_request
+def _start_background():
+    if current_app.config.get("QR_ROLE") != "decode": start_wa_workers()
+
+@app.before_request
+def _metrics_start():
+    if metrics.ENABLED: request.environ["qr.t0"] = time.perf_counter()
+
+@app.after_request
+def _metrics_observe(resp):
+    # للردود الـ streaming هذا زمن أول بايت مو نهاية الـ stream
+    t0 = request.environ.get("qr.t0")
+    if t0 is not None:
+        metrics.observe("qr_http_request_seconds", time.perf_counter()-t0,
+                        route=request.url_rule.rule if request.url_rule else "unmatched",
+                        method=request.method, status=resp.status_code)
+    return resp
+
+# ---------- Admission control ----------
+# كل gate: limit شغّالين + queue منتظرين بحد ADMIT_WAIT_MS، وبعدها Overloaded -> 503. الـ gates تتشارك
+# lane بحجم ADMIT_HEAVY_THREADS (شغّال + منتظر) عشان يبقى ADMIT_RESERVED thread للمسارات الخفيفة.
+# الـ streams تاخذ slot من stream_gate (ومن الـ lane) لين يتسكر الرد؛ الشغل اللي داخلها (فريم بـ
+# scan/stream) ياخذ slot من gate الـ decode بدون lane لأن الـ thread محسوب أصلاً.
+class Overloaded(Exception):
+    def __init__(self, gate, reason, retry_after):
+        super().__init__(f"{gate}: {reason}")
+        self.gate, self.reason, self.retry_after = gate, reason, retry_after
+
+_admit_cond = threading.Condition()
+_admit_lane = dict(cap=ADMIT_HEAVY_THREADS, used=0)
+
+class AdmissionGate:
+    def __init__(self, name, limit, queue=ADMIT_QUEUE, wait_s=ADMIT_WAIT_S):
+        self.name, self.limit, self.wait_s = name, max(1, limit), wait_s
+        # queue=None = كل اللي يبقى بالـ lane بعد الشغّالين؛ أطول منه ما يتطبّق (الزايد ينرفض بـ lane قبل ما يوصله)
+        room = max(0, _admit_lane["cap"] - self.limit)
+        if queue is not None and queue > room:
+            raise ValueError(f"ADMIT_QUEUE={queue} does not fit gate {name!r}: {_admit_lane['cap']} heavy threads - "
+                             f"limit {self.limit} leaves room for {room}; raise GUNICORN_THREADS or lower ADMIT_QUEUE")
+        self.queue = room if queue is None else max(0, queue)
+        self.active = self.waiting = self.admitted = 0
+        self.shed = dict(queue_full=0, timeout=0, lane=0)
+        self.service_s = 0.0   # EWMA زمن الخدمة، لـ Retry-After
+
+    def retry_after(self):
+        return max(1, math.ceil((self.service_s or 1.0) * (self.waiting + 1) / self.limit))
+
+    def _reject(self, reason):
+        self.shed[reason] += 1
+        metrics.inc("qr_admission_shed_total", gate=self.name, reason=reason)
+        raise Overloaded(self.name, reason, self.retry_after())
+
+    def acquire(self, lane=True):
+        # يرجع وقت الدخول (لـ release)؛ يرمي Overloaded. lane=False لشغل داخل stream ماسك الـ lane
+        if not ADMIT_ENABLED: return time.perf_counter()
+        t0, n = time.perf_counter(), int(lane)
+        with _admit_cond:
+            # طابور الـ gate نفسه أول: queue_full يبان كسبب بدل lane لما الـ gate هو المزحوم
+            busy = self.active >= self.limit or self.waiting
+            if busy and self.waiting >= self.queue: self._reject("queue_full")
+            if lane and _admit_lane["used"] >= _admit_lane["cap"]: self._reject("lane")
+            if busy:
+                _admit_lane["used"] += n; self.waiting += 1
+                try:
+                    while self.active >= self.limit:
+                        left = t0 + self.wait_s - time.perf_counter()
+                        if left <= 0:
+                            _admit_lane["used"] -= n; self._reject("timeout")
+                        _admit_cond.wait(left)
+                finally: self.waiting -= 1
+            else:
+                _admit_lane["used"] += n
+            self.active += 1; self.admitted += 1
+        t1 = time.perf_counter()
+        metrics.observe("qr_admission_wait_seconds", t1 - t0, gate=self.name)
+        return t1
+
+    def release(self, t1, lane=True):
+        if not ADMIT_ENABLED: return
+        dt = time.perf_counter() - t1
+        with _admit_cond:
+            self.active -= 1; _admit_lane["used"] -= int(lane)
+            self.service_s = dt if not self.service_s else 0.8 * self.service_s + 0.2 * dt
+            _admit_cond.notify_all()
+
+    @contextmanager
+    def slot(self, lane=True):
+        t1 = self.acquire(lane)
+        try: yield
+        finally: self.release(t1, lane)
+
+    def stats(self):
+        with _admit_cond:
+            return dict(limit=self.limit, queue=self.queue, wait_ms=round(self.wait_s * 1000), active=self.active,
+                        waiting=self.waiting, admitted=self.admitted, shed=dict(self.shed),
+                        service_ms=round(self.service_s * 1000, 1), retry_after=self.retry_after())
+
+decode_gate = AdmissionGate("decode", ADMIT_DECODE)
+render_gate = AdmissionGate("render", ADMIT_RENDER)
+stream_gate = AdmissionGate("stream", ADMIT_STREAM)
+ADMISSION_GATES = (decode_gate, render_gate, stream_gate)
+
+def admitted(gate):
+    def deco(fn):
+        @wraps(fn)
+        def inner(*a, **kw):
+            with gate.slot(): return fn(*a, **kw)
+        return inner
+    return deco
+
+def gated_stream(gen, mimetype):
+    # رد streaming ماسك slot من stream_gate لين الـ server يسكّره (خلص أو العميل قطع)
+    t1 = stream_gate.acquire()
+    resp = Response(stream_with_context(gen), mimetype=mimetype)
+    resp.call_on_close(lambda: stream_gate.release(t1))
+    return resp
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    resp = jsonify(ok=False, error="overloaded", gate=e.gate, reason=e.reason, retry_after=e.retry_after)
+    resp.status_code = 503; resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+@metrics.collector
+def _admission_gauges():
+    for g in ADMISSION_GATES:
+        metrics.set_gauge("qr_admission_active", g.active, gate=g.name)
+        metrics.set_gauge("qr_admission_waiting", g.waiting, gate=g.name)
+
 # ---------- Routes ----------
-@app.route("/")
+@route("/")
 def index():
-    ensure_db()
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) AS c FROM visitors"); total = cur.fetchone()["c"]
-        cur.execute("SELECT COUNT(*) AS c FROM visitors WHERE DATE(substr(created_at,1,10)) = DATE(?)",(date.today().isoformat(),))
-        today = cur.fetchone()["c"]
-        try:
-            cur.execute("SELECT COUNT(*) AS c FROM visitors WHERE wa_sent=1"); wa = cur.fetchone()["c"]
-        except Exception: wa = 0
-        cur.execute("SELECT id,name,company,position,created_at FROM visitors ORDER BY datetime(created_at) DESC LIMIT 12")
-        last = [dict(r) for r in cur.fetchall()]
-    return render_template_string(INDEX_HTML, title=APP_TITLE, kpis=dict(total=total,today=today,wa=wa), last=last)
+    kpis = db.kpis(date.today().isoformat())
+    last = db.visitors_page(12)
+    next_cursor = encode_cursor(last[-1]) if len(last) == 12 else ""
+    return render_template_string(INDEX_HTML, title=APP_TITLE, kpis=kpis, last=last, next_cursor=next_cursor)
+
+@route("/visitors")
+def visitors_json():
+    # ?limit=&cursor= — الترتيب من الأحدث، والـ cursor من next_cursor بالرد السابق
+    try: limit = max(1, min(500, int(request.args.get("limit") or 50)))
+    except ValueError: limit = 50
+    cur = request.args.get("cursor") or ""
+    after = decode_cursor(cur) if cur else None
+    if cur and after is None: return jsonify(ok=False, error="bad_cursor"), 400
+    items = db.visitors_page(limit, after)
+    return jsonify(ok=True, items=items, next_cursor=encode_cursor(items[-1]) if len(items) == limit else None)
 
-@app.route("/ui_logo")
+@route("/ui_logo")
 def ui_logo():
     if not os.path.exists(LOGO_PATH):
         img = Image.new("RGB",(160,40),"white")
@@ -351,7 +2256,7 @@ def ui_logo():
     return send_file(LOGO_PATH, mimetype=(mimetypes.guess_type(LOGO_PATH)[0] or "image/png"))
 
 # --- Logo upload
-@app.route("/logo/form")
+@route("/logo/form")
 def logo_form():
     if LOGO_UPLOAD_KEY and (request.args.get("key") or "") != LOGO_UPLOAD_KEY: return "Forbidden", 403
     return f"""<!doctype html><meta charset="utf-8"/>
@@ -362,15 +2267,16 @@ def logo_form():
 </form>
 <p>Current: <img src="/ui_logo?ts={int(datetime.utcnow().timestamp())}" style="max-height:80px"/></p>"""
 
-@app.route("/logo/upload", methods=["POST"])
+@route("/logo/upload", methods=["POST"])
 def logo_upload():
     if LOGO_UPLOAD_KEY and (request.args.get("key") or "") != LOGO_UPLOAD_KEY: return "Forbidden", 403
     if "file" not in request.files: return "No file", 400
     f = request.files["file"]; _ensure_dir(LOGO_PATH); f.save(LOGO_PATH)
+    render_cache.clear()
     return redirect(url_for("logo_form", key=LOGO_UPLOAD_KEY))
 
 # --- Font upload (يحفظ في BADGE_FONT_PATH)
-@app.route("/font/form")
+@route("/font/form")
 def font_form():
     if FONT_UPLOAD_KEY and (request.args.get("key") or "") != FONT_UPLOAD_KEY: return "Forbidden", 403
     target = BADGE_FONT_PATH or "/app/data/timesbd.ttf"
@@ -382,18 +2288,18 @@ def font_form():
 </form>
 <p>Set env BADGE_FONT_PATH to: {target}</p>"""
 
-@app.route("/font/upload", methods=["POST"])
+@route("/font/upload", methods=["POST"])
 def font_upload():
     if FONT_UPLOAD_KEY and (request.args.get("key") or "") != FONT_UPLOAD_KEY: return "Forbidden", 403
     target = BADGE_FONT_PATH or "/app/data/timesbd.ttf"
     if "file" not in request.files: return "No file", 400
     f = request.files["file"]; _ensure_dir(target); f.save(target)
+    render_cache.clear()
     return f"Saved font to {target}. Set BADGE_FONT_PATH and redeploy."
 
 # --- Simple create
-@app.route("/create", methods=["POST"])
+@route("/create", methods=["POST"])
 def create():
-    ensure_db()
     f = request.form
     name     = (f.get("name") or "").strip()
     company  = (f.get("company") or "").strip()
@@ -401,77 +2307,87 @@ def create():
     email    = (f.get("email") or "").strip().lower()
     phone    = (f.get("phone") or "").strip()
     if not all([name,company,position,email,phone]): return jsonify(ok=False,error="missing_fields"),400
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT * FROM visitors WHERE email=? OR phone=?", (email, phone))
-        row = cur.fetchone()
-        if row:
-            rec = dict(row)
-        else:
-            vid = rand_token(); pin = rand_pin()
-            cur.execute("""INSERT INTO visitors(id,name,company,position,email,phone,pin,created_at)
-                           VALUES(?,?,?,?,?,?,?,?)""",
-                        (vid,name,company,position,email,phone,pin,datetime.utcnow().isoformat()))
-            con.commit()
-            rec = dict(id=vid, name=name, company=company, position=position,
-                       email=email, phone=phone, pin=pin, created_at=datetime.utcnow().isoformat())
-    return jsonify(ok=True, id=rec["id"])
-
-@app.route("/qr/<vid>.png")
-def qr_png(vid):
-    ensure_db()
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT name FROM visitors WHERE id=?", (vid,))
-        row = cur.fetchone()
-        if not row: return "Not found", 404
-    bio = make_qr_png(vid, label_name=row["name"])
-    if (request.args.get("dl") or "").lower() in ("1","true","yes","download"):
-        try: return send_file(bio, mimetype="image/png", as_attachment=True, download_name=f"{vid}.png")
-        except TypeError: return send_file(bio, mimetype="image/png", as_attachment=True, attachment_filename=f"{vid}.png")
-    return send_file(bio, mimetype="image/png")
-
-@app.route("/card/<vid>.png")
-def card_png(vid):
-    ensure_db()
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT name,company,position FROM visitors WHERE id=?", (vid,))
-        row = cur.fetchone()
-        if not row: return "Not found", 404
-    return send_file(make_badge_png(row["name"],row["company"],row["position"],visitor_id=vid,rotate_ccw=False),
-                     mimetype="image/png")
-
-@app.route("/card_landscape/<vid>.png")
-def card_landscape_png(vid):
-    ensure_db()
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT name,company,position FROM visitors WHERE id=?", (vid,))
-        row = cur.fetchone()
-        if not row: return "Not found", 404
-    return send_file(make_badge_png(row["name"],row["company"],row["position"],visitor_id=vid,rotate_ccw=True),
-                     mimetype="image/png")
+    fields = (name, company, position, email, phone)
+    res = register(fields, key=idempotency_key("create", fields, f))
+    return jsonify(ok=True, id=res["id"], created=res["created"], replayed=res["replayed"])
+
+@route("/visitors/import", methods=["POST"])
+def visitors_import():
+    # ملف CSV/JSONL (حقل file) أو body خام؛ ?format=csv|jsonl لو الامتداد ما يكفي.
+    # الـ body الخام يتقرا سطر بسطر من wsgi.input وهو يوصل؛ الـ multipart ينكتب لملف مؤقت أول (werkzeug)
+    if IMPORT_KEY and (request.args.get("key") or request.headers.get("X-Import-Key") or "") != IMPORT_KEY:
+        return "Forbidden", 403
+    files = request_files(IMPORT_MAX_BYTES) if (request.content_type or "").startswith("multipart/") else {}
+    if "file" in files:
+        fs = files["file"]; fh = fs.stream
+        fmt = import_format(fs.filename, fs.mimetype)
+    else:
+        fh = io.BufferedReader(request_stream(IMPORT_MAX_BYTES))
+        fmt = import_format("", request.content_type)
+    fmt = (request.args.get("format") or fmt).lower()
+    if fmt not in ("csv","jsonl"): return jsonify(ok=False, error="bad_format"), 400
+    return jsonify(ok=True, format=fmt, **import_visitors(iter_import_rows(fh, fmt)))
+
+@route("/export/badges")
+def export_badges_route():
+    # ?format=zip|pdf&from=YYYY-MM-DD&to=YYYY-MM-DD&company=...&ids=a,b,c
+    if EXPORT_KEY and (request.args.get("key") or request.headers.get("X-Export-Key") or "") != EXPORT_KEY:
+        return "Forbidden", 403
+    fmt = (request.args.get("format") or "zip").lower()
+    if fmt not in ("zip","pdf"): return jsonify(ok=False, error="bad_format"), 400
+    ids = [x.strip() for x in (request.args.get("ids") or "").split(",") if x.strip()]
+    visitors = db.iter_visitors(request.args.get("from") or "", request.args.get("to") or "",
+                                request.args.get("company") or "", ids)
+    resp = gated_stream(export_stream(fmt, visitors), "application/zip" if fmt == "zip" else "application/pdf")
+    resp.headers["Content-Disposition"] = f'attachment; filename="badges.{fmt}"'
+    return resp
+
+# /qr/<vid>.png يرجع PNG دايماً (وكذا .svg / .webp)؛ الـ URL بدون امتداد (/qr/<vid>) هو اللي يختار الصيغة
+# من ?format= أو Accept (مع Vary: Accept). اسم ملف التحميل (?dl=1) ياخذ امتداد الصيغة الفعلية
+@route("/qr/<vid>.<any(png, svg, webp):ext>")
+@route("/qr/<vid>", defaults={"ext": None})
+def qr_png(vid, ext):
+    rec = registry.get(vid, strict=False)
+    if not rec: return "Not found", 404
+    name = rec["name"]
+    dl = (request.args.get("dl") or "").lower() in ("1","true","yes","download")
+    fmt = negotiate_format(QR_FORMATS, ext)
+    if not fmt: return jsonify(ok=False, error="unsupported_format", formats=list(QR_FORMATS)), 406
+    return cached_image_response(render_key("qr", vid, name, fmt), lambda: make_qr_png(vid, label_name=name, fmt=fmt),
+                                 fmt, download_name=f"{vid}.{fmt}" if dl else None, negotiated=ext is None)
+
+@route("/card/<vid>.<any(png, webp):ext>")   # نفس الشي: الامتداد يثبّت الصيغة، وبدونه webp لو الـ Accept يذكره
+@route("/card/<vid>", defaults={"ext": None})
+def card_png(vid, ext):
+    rec = registry.get(vid, strict=False)
+    if not rec: return "Not found", 404
+    fmt = negotiate_format(CARD_FORMATS, ext)
+    if not fmt: return jsonify(ok=False, error="unsupported_format", formats=list(CARD_FORMATS)), 406
+    return cached_image_response(render_key("card", vid, rec["name"], rec["company"], rec["position"], fmt),
+                                 lambda: make_badge_png(rec["name"],rec["company"],rec["position"],visitor_id=vid,rotate_ccw=False,fmt=fmt),
+                                 fmt, negotiated=ext is None)
+
+@route("/card_landscape/<vid>.<any(png, webp):ext>")
+@route("/card_landscape/<vid>", defaults={"ext": None})
+def card_landscape_png(vid, ext):
+    rec = registry.get(vid, strict=False)
+    if not rec: return "Not found", 404
+    fmt = negotiate_format(CARD_FORMATS, ext)
+    if not fmt: return jsonify(ok=False, error="unsupported_format", formats=list(CARD_FORMATS)), 406
+    return cached_image_response(render_key("card_landscape", vid, rec["name"], rec["company"], rec["position"], fmt),
+                                 lambda: make_badge_png(rec["name"],rec["company"],rec["position"],visitor_id=vid,rotate_ccw=True,fmt=fmt),
+                                 fmt, negotiated=ext is None)
 # --- Lookup visitor by ID (JSON)
-@app.route("/lookup/<vid>.json")
+@route("/lookup/<vid>.json", role="any")
 def lookup_json(vid):
-    ensure_db()
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT id,name,company,position FROM visitors WHERE id=?", (vid,))
-        row = cur.fetchone()
-        if not row:
-            return jsonify(ok=False, error="not_found"), 404
-        rec = dict(row)
+    rec = registry.get(vid)
+    if not rec:
+        return jsonify(ok=False, error="not_found"), 404
+    if wants_checkin(): rec["checkin"] = checkin_log.add(vid, request_gate(), "lookup")
     return jsonify(ok=True, **rec)
 
 # ---------- Google Forms webhook ----------
-@app.route("/forms/google", methods=["POST","OPTIONS"])
+@route("/forms/google", methods=["POST","OPTIONS"])
 def forms_google():
     if request.method == "OPTIONS": return corsify(make_response(("",204)))
 
@@ -482,7 +2398,7 @@ def forms_google():
         return corsify(jsonify(ok=False, error="unauthorized")), 401
 
     if request.is_json:
-        data = request.get_json(silent=True) or {}
+        data = raw = request.get_json(silent=True) or {}
         if isinstance(data.get("namedValues"), dict):
             nv = data["namedValues"]
             def nv_get(k):
@@ -496,60 +2412,23 @@ def forms_google():
                 "phone":    nv_get("Phone")    or nv_get("الهاتف"),
             }
     else:
-        data = request.form.to_dict(flat=True)
+        data = raw = request.form.to_dict(flat=True)
 
-    name     = (pick(data,"name","Name","الاسم","Full Name") or "").strip()
-    company  = (pick(data,"company","Company","الشركة") or "").strip()
-    position = (pick(data,"position","Position","المنصب") or "").strip()
-    email    = (pick(data,"email","Email","البريد") or "").strip().lower()
-    phone    = (pick(data,"phone","Phone","الهاتف") or "").strip()
+    name, company, position, email, phone = registration_fields(data)
 
     if not all([name,company,position,email,phone]):
         return corsify(jsonify(ok=False, error="missing_fields",
                                need=["name","company","position","email","phone"])),400
 
-    ensure_db()
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT * FROM visitors WHERE email=? OR phone=?", (email, phone))
-        row = cur.fetchone()
-        if row:
-            rec = dict(row)
-        else:
-            vid = rand_token(); pin = rand_pin()
-            cur.execute("""INSERT INTO visitors(id,name,company,position,email,phone,pin,created_at)
-                           VALUES(?,?,?,?,?,?,?,?)""",
-                        (vid,name,company,position,email,phone,pin,datetime.utcnow().isoformat()))
-            con.commit()
-            rec = dict(id=vid, name=name, company=company, position=position,
-                       email=email, phone=phone, pin=pin, created_at=datetime.utcnow().isoformat())
-
-    # توليد الصور
-    qr_buf   = make_qr_png(rec["id"], label_name=rec["name"])
-    # card_buf = make_badge_png(...)  # لم نعد نرسله لواتساب
-
-    # إرسال واتساب: QR فقط
-    wa_result = None
-    if WA_PROXY_URL and requests is not None:
-        try:
-            files = {"file": ("qr.png", qr_buf.getvalue(), "image/png")}  # <-- نرسل QR
-            data  = {"to": rec["phone"], "name": rec["name"]}
-            r = requests.post(WA_PROXY_URL, files=files, data=data, timeout=60)
-            if r.ok:
-                wa_result = {"ok": True}
-                with sqlite3.connect(DB_PATH) as con2:
-                    con2.execute("UPDATE visitors SET wa_sent=1, wa_ts=? WHERE id=?",
-                                 (datetime.utcnow().isoformat(), rec["id"]))
-                    con2.commit()
-            else:
-                wa_result = {"ok": False, "code": r.status_code, "text": r.text}
-        except Exception as e:
-            wa_result = {"ok": False, "error": str(e)}
+    # إرسال واتساب (QR فقط) يصير بالخلفية عن طريق الطابور؛ الـ job تنضاف بنفس transaction التسجيل
+    fields = (name, company, position, email, phone)
+    try: rec = register(fields, key=idempotency_key("forms", fields, raw), wa=bool(WA_PROXY_URL and requests is not None))
+    except Overloaded as e: return corsify(overloaded(e))
+    wa_result = rec.get("whatsapp")
 
     base = request.host_url.rstrip("/")
     out = dict(
-        ok=True, id=rec["id"], name=rec["name"],
+        ok=True, id=rec["id"], name=rec["name"], created=rec["created"], replayed=rec["replayed"],
         qr=f"{base}/qr/{rec['id']}.png",
         qr_download=f"{base}/qr/{rec['id']}.png?dl=1",
         card_portrait=f"{base}/card/{rec['id']}.png",
@@ -558,10 +2437,32 @@ def forms_google():
     if wa_result is not None: out["whatsapp"] = {"mode":"proxy", **wa_result}
     return corsify(jsonify(out))
 
+@route("/wa/queue")
+def wa_queue():
+    return jsonify(ok=True, **wa_queue_stats())
+
+@route("/checkins/stats", role="any")
+def checkins_stats():
+    # العدّادات من القاعدة بعد ما نكتب buffer هذا الـ worker (الـ workers الثانيين خلال CHECKIN_FLUSH_MS)
+    checkin_log.flush()
+    day = (request.args.get("day") or datetime.utcnow().date().isoformat()).strip()[:10]
+    return jsonify(ok=True, **db.checkin_counts(day), worker=checkin_log.stats(), registry=registry.stats())
+
+@route("/admission/stats", role="any")
+def admission_stats():
+    with _admit_cond: lane = dict(_admit_lane)
+    return jsonify(ok=True, enabled=ADMIT_ENABLED, reserved=ADMIT_RESERVED, lane=lane,
+                   gates={g.name: g.stats() for g in ADMISSION_GATES})
+
+@route("/metrics", role="any")
+def metrics_endpoint():
+    if not metrics.ENABLED: return Response("metrics disabled\n", 404, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # ---- Decode endpoints تبقى كما هي ----
-@app.route("/decode_badge", methods=["GET"])
-@app.route("/decode_badge/", methods=["GET"])
-@app.route("/decode_badge/<path:_extra>", methods=["GET"])
+@route("/decode_badge", methods=["GET"], role="decode")
+@route("/decode_badge/", methods=["GET"], role="decode")
+@route("/decode_badge/<path:_extra>", methods=["GET"], role="decode")
 def decode_badge_form(_extra=""):
     return """
     <html><body>
@@ -574,55 +2475,215 @@ def decode_badge_form(_extra=""):
     </body></html>
     """, 200
 
-@app.route("/decode_badge", methods=["POST"])
-@app.route("/decode_badge/", methods=["POST"])
-@app.route("/decode_badge/<path:_extra>", methods=["POST"])
+@route("/decode_badge", methods=["POST"], role="decode")
+@route("/decode_badge/", methods=["POST"], role="decode")
+@route("/decode_badge/<path:_extra>", methods=["POST"], role="decode")
+@admitted(decode_gate)
 def decode_badge(_extra=""):
     lt_q = (request.args.get("landscape_trick") or "").lower()
     lt_f = (request.form.get("landscape_trick") or "").lower()
     landscape_trick = not (lt_q in ("0","false","no") or lt_f in ("0","false","no"))
-    img=None
+    plan=request_plan()
+    pyramid,side=request_pyramid()
+    img,f=None,1
     for field in ("image","file","photo","frame","upload"):
         if field in request.files:
-            arr=np.frombuffer(request.files[field].read(),np.uint8)
-            img=cv2.imdecode(arr,cv2.IMREAD_COLOR); break
+            with upload_buffer(request.files[field]) as buf: img,f=imdecode(buf,side)
+            break
     if img is None and request.data and request.content_type and ("image/" in request.content_type or "application/octet-stream" in request.content_type):
-        arr=np.frombuffer(request.data,np.uint8); img=cv2.imdecode(arr,cv2.IMREAD_COLOR)
+        img,f=imdecode(request.data,side)
     if img is None and request.is_json:
-        data=request.get_json(silent=True) or {}; b64=(data.get("image_b64") or data.get("image") or "").strip()
-        if b64:
-            if "," in b64: b64=b64.split(",",1)[-1]
-            try:
-                arr=np.frombuffer(base64.b64decode(b64),np.uint8); img=cv2.imdecode(arr,cv2.IMREAD_COLOR)
-            except Exception: img=None
+        data=request.get_json(silent=True) or {}
+        img,f=b64_image((data.get("image_b64") or data.get("image") or "").strip(),side)
     if img is None: return jsonify(ok=False,error="no_image_supplied"),400
-    vid,_=robust_decode(img)
-    if not vid: return jsonify(ok=False,error="decode_failed"),404
-    with sqlite3.connect(DB_PATH) as con:
-        con.row_factory=sqlite3.Row; cur=con.cursor()
-        cur.execute("SELECT name,company,position FROM visitors WHERE id=?", (vid,))
-        row=cur.fetchone()
+    vid,_,stage=robust_decode_ex(img,f,plan,pyramid)
+    if not vid: return jsonify(ok=False,error="decode_timeout" if plan.timed_out else "decode_failed",**plan.report()),404
+    row=registry.get(vid)
     if not row: return jsonify(ok=False,error="unknown_visitor",vid=vid),404
-    return send_file(make_badge_png(row["name"],row["company"],row["position"],visitor_id=vid,rotate_ccw=landscape_trick),
-                     mimetype="image/png")
+    resp=send_file(make_badge_png(row["name"],row["company"],row["position"],visitor_id=vid,rotate_ccw=landscape_trick),
+                   mimetype="image/png")
+    resp.headers["X-Decode-Stage"]=stage; resp.headers["X-Decode-Tried"]=",".join(plan.tried)
+    if wants_checkin():
+        ci=checkin_log.add(vid, request_gate(), stage)
+        resp.headers["X-Checkin"]="first" if ci["first"] else "reentry"; resp.headers["X-Checkin-Gate"]=ci["gate"]
+    return resp
 
-@app.route("/decode", methods=["POST"])
+@route("/decode", methods=["POST"], role="decode")
+@admitted(decode_gate)
 def decode_json():
-    img=None
+    plan=request_plan()
+    multi=flag_arg("multi")
+    pyramid,side=(False,None) if multi else request_pyramid()   # multi يقرا المستوى العادي بس
+    img,f=None,1
     if "image" in request.files:
-        arr=np.frombuffer(request.files["image"].read(),np.uint8); img=cv2.imdecode(arr,cv2.IMREAD_COLOR)
+        with upload_buffer(request.files["image"]) as buf: img,f=imdecode(buf,side)
     elif request.data and request.content_type and ("image/" in request.content_type or "application/octet-stream" in request.content_type):
-        arr=np.frombuffer(request.data,np.uint8); img=cv2.imdecode(arr,cv2.IMREAD_COLOR)
+        img,f=imdecode(request.data,side)
     elif request.is_json:
-        data=request.get_json(silent=True) or {}; b64=(data.get("image_b64") or "").strip()
-        if "," in b64: b64=b64.split(",",1)[-1]
-        if b64:
-            try: arr=np.frombuffer(base64.b64decode(b64),np.uint8); img=cv2.imdecode(arr,cv2.IMREAD_COLOR)
-            except Exception: img=None
+        data=request.get_json(silent=True) or {}
+        img,f=b64_image((data.get("image_b64") or "").strip(),side)
+    if img is None: return jsonify(ok=False,error="no_image_supplied"),400
+    if multi:
+        codes=decode_multi(img,f,plan)
+        return jsonify(ok=bool(codes), codes=codes, count=len(codes), **plan.report())
+    text,poly,stage=robust_decode_ex(img,f,plan,pyramid)
+    return jsonify(ok=bool(text), text=text or "", poly=poly or [], stage=stage, **plan.report())
+
+@route("/checkin/group", methods=["POST"], role="decode")
+@admitted(decode_gate)
+def checkin_group():
+    # صورة لمجموعة باجات: كل الرموز، الزوار باستعلام واحد، ودخول لكل واحد (?checkin=0 للقراءة بس)
+    plan=request_plan()
+    img,f=request_image()
     if img is None: return jsonify(ok=False,error="no_image_supplied"),400
-    text,poly=robust_decode(img); return jsonify(ok=bool(text), text=text or "", poly=poly or [])
+    # نفس الباج ممكن ينقرا مرتين بمكانين (انعكاس، أو كاشفين بمقاسين): أول قراءة بس لكل ID،
+    # وإلا النسخة الثانية تنكتب دخول ثاني (reentry)؛ decode_multi يرجع أول قراءة بس لكل نص
+    codes=decode_multi(img,f,plan)
+    found=registry.get_many(c["text"] for c in codes)
+    gate, checkin, visitors, unknown = request_gate(), wants_checkin(), [], []
+    for c in codes:
+        rec=found.get(c["text"])
+        if rec is None: unknown.append(c); continue
+        rec.update(poly=c["poly"], stage=c["stage"])
+        if checkin: rec["checkin"]=checkin_log.add(rec["id"], gate, "group_"+c["stage"])
+        visitors.append(rec)
+    return jsonify(ok=bool(visitors), count=len(visitors), visitors=visitors, unknown=unknown, gate=gate, **plan.report())
+
+@route("/decode/stats", role="decode")
+def decode_stats():
+    return jsonify(ok=True, adaptive=DECODE_ADAPTIVE, device_header=DECODE_DEVICE_HEADER, stages=stage_stats.snapshot())
+
+@route("/decode/batch", methods=["POST"], role="decode")
+def decode_batch():
+    # multipart بعدة صور و/أو zip، أو body خام application/zip؛ النتائج NDJSON أول ما تخلص كل صورة.
+    # الحد DECODE_BATCH_MAX_BYTES للطلب و DECODE_BATCH_MAX_IMAGE_BYTES لكل صورة (بدل MAX_CONTENT_LENGTH)
+    ctype, files, raw = request.content_type or "", {}, None
+    if ctype.startswith("multipart/"): files = request_files(DECODE_BATCH_MAX_BYTES)
+    elif "zip" in ctype: raw = spool_request(DECODE_BATCH_MAX_BYTES)
+    if not files and raw is None: return jsonify(ok=False,error="no_image_supplied"),400
+    # slot stream وحد للدفعة كلها؛ الفك نفسه بالـ pool ومحدود بـ DECODE_BATCH_INFLIGHT
+    try: resp = gated_stream(decode_batch_stream(_batch_sources(files, raw)), "application/x-ndjson")
+    except Overloaded:
+        if raw is not None: raw.close()
+        raise
+    if raw is not None: resp.call_on_close(raw.close)
+    return resp
+
+@route("/scan/stream", methods=["POST"], role="decode")
+def scan_stream():
+    # POST طويل (chunked) بفريمات الكاميرا؛ الرد NDJSON يطلع فيه كل ID جديد أول ما ينقرا
+    ndjson = "ndjson" in (request.content_type or "") or "json" in (request.content_type or "")
+    stream = request.environ["wsgi.input"]  # بدون حد MAX_CONTENT_LENGTH: الحد لكل فريم
+    def gen():
+        sess = ScanSession(request_device())
+        for img, f in scan_frames(stream, ndjson=ndjson):
+            if img is None: continue
+            # الـ thread محسوب بالـ lane عن طريق stream_gate؛ هنا slot فك لكل فريم، والفريم اللي ما لقى مكان ينرمى
+            try:
+                with decode_gate.slot(lane=False): ev = sess.feed(img, f=f)
+            except Overloaded as e: ev = dict(event="busy", retry_after=e.retry_after)
+            if ev: yield json.dumps(ev, ensure_ascii=False) + "\n"
+        yield json.dumps(dict(event="end", **sess.stats())) + "\n"
+    return gated_stream(gen(), "application/x-ndjson")
+
+# ---------- Startup ----------
+STARTUP = {"import": time.perf_counter() - BOOT_T0}
+
+def warm(role=None):
+    # يتنادى بالـ master قبل الـ fork (gunicorn.conf.py): الخط واللوغو وقالب الباج لكل الأدوار
+    # (decode_badge يرسم باج كمان)، ومكتبات القراءة لـ decode/all؛ الـ workers يشاركونها copy-on-write
+    role = role or APP_ROLE
+    t0 = time.perf_counter()
+    config_fingerprint(); load_times_bold(FONT_SIZE); badge_template()
+    if role in ("all", "decode"): load_decoders()
+    if REGISTRY_SNAPSHOT: registry.load()   # mmap بالـ master: الـ workers يشاركون نفس الصفحات
+    else:
+        con = db.connect()   # اتصال مؤقت: الـ master ما يخلي اتصال مفتوح يورثه الـ workers
+        try: registry.load(con)
+        finally: con.close()
+    STARTUP["warm"] = time.perf_counter() - t0
+    return dict(STARTUP)
+
+def process_memory():
+    # MB: rss، pss (الصفحات المشتركة مقسومة على اللي يشاركونها)، shared — Linux بس
+    out = {}
+    try:
+        with open("/proc/self/smaps_rollup") as fh:
+            for ln in fh:
+                k, _, v = ln.partition(":")
+                if k in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty"): out[k] = int(v.split()[0]) / 1024.0
+    except (OSError, ValueError): return {}
+    return dict(rss=round(out.get("Rss", 0.0), 1), pss=round(out.get("Pss", 0.0), 1),
+                shared=round(out.get("Shared_Clean", 0.0) + out.get("Shared_Dirty", 0.0), 1))
+
+@metrics.collector
+def _process_gauges():
+    for k, v in process_memory().items(): metrics.set_gauge("qr_process_memory_mb", v, kind=k)
+    for k, v in STARTUP.items(): metrics.set_gauge("qr_startup_seconds", round(v, 4), phase=k)
+
+def create_app(role=None):
+    # gunicorn -c gunicorn.conf.py "qr:create_app()"   (الدور من QR_ROLE أو create_app('decode'))
+    role = (role or APP_ROLE).lower()
+    if role not in APP_ROLES: raise ValueError(f"unknown role {role!r} (expected one of {', '.join(APP_ROLES)})")
+    if role == "all": return app
+    a = Flask(__name__)
+    a.config.update(app.config); a.config["QR_ROLE"] = role
+    for rule, fn, opts, r in _ROUTES:
+        if r in (role, "any"): a.route(rule, **opts)(fn)
+    for f in app.before_request_funcs.get(None, []): a.before_request(f)
+    for f in app.after_request_funcs.get(None, []): a.after_request(f)
+    a.register_error_handler(Overloaded, overloaded)
+    return a
 
 # ---------- Main ----------
+def main(argv=None):
+    ap  = argparse.ArgumentParser(description=APP_TITLE)
+    sub = ap.add_subparsers(dest="cmd")
+    p = sub.add_parser("serve", help="run the dev server (default)")
+    p.add_argument("--host", default="0.0.0.0"); p.add_argument("--port", type=int, default=5001)
+    p.add_argument("--role", choices=APP_ROLES, default=APP_ROLE)
+    p = sub.add_parser("import", help="bulk-import visitors from CSV/JSONL")
+    p.add_argument("file"); p.add_argument("--format", choices=("csv","jsonl"))
+    p = sub.add_parser("export", help="print-run export of badges (ZIP of PNGs or multi-up PDF)")
+    p.add_argument("--format", choices=("zip","pdf"), default="pdf"); p.add_argument("--out", required=True)
+    p.add_argument("--from", dest="start", default=""); p.add_argument("--to", dest="end", default="")
+    p.add_argument("--company", default=""); p.add_argument("--ids", default="", help="comma-separated visitor ids")
+    p = sub.add_parser("snapshot", help="write the read-only visitor registry (base file, then deltas) for REGISTRY_SNAPSHOT nodes")
+    p.add_argument("--out", required=True, help="snapshot directory"); p.add_argument("--full", action="store_true", help="new base file")
+    p.add_argument("--every", type=float, default=0, help="keep running: delta every N seconds")
+    p.add_argument("--rebase", type=int, default=50, help="with --every: new base after this many deltas")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "import":
+        fh = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+        with fh:
+            t0 = time.perf_counter()
+            summary = import_visitors(iter_import_rows(fh, args.format or import_format(args.file)))
+        summary["seconds"] = round(time.perf_counter() - t0, 3)
+        print(json.dumps(summary, ensure_ascii=False))
+        return 0 if not summary["rejected"] else 1
+    if args.cmd == "export":
+        ids = [x.strip() for x in args.ids.split(",") if x.strip()]
+        t0, n = time.perf_counter(), 0
+        with open(args.out, "wb") as fh:
+            for n in export_badges(fh, args.format, db.iter_visitors(args.start, args.end, args.company, ids)): pass
+        print(json.dumps(dict(badges=n, out=args.out, seconds=round(time.perf_counter() - t0, 3))))
+        return 0
+    if args.cmd == "snapshot":
+        fetch = lambda after: [tuple(r) for r in db.rows(db.SQL_VISITOR_SNAPSHOT_AFTER, (after,))]
+        full, deltas = args.full, 0
+        while True:
+            t0 = time.perf_counter()
+            res = snapshot.export(args.out, fetch, full=full or (args.every and deltas >= args.rebase))
+            deltas = 0 if res["kind"] == "base" else deltas + bool(res["visitors"])
+            if res["visitors"] or not args.every:
+                print(json.dumps(dict(res, seconds=round(time.perf_counter() - t0, 3))), flush=True)
+            if not args.every: return 0
+            full = False; time.sleep(args.every)
+    role = getattr(args, "role", APP_ROLE)
+    print(json.dumps(dict(role=role, startup_s={k: round(v, 3) for k,v in warm(role).items()}, memory_mb=process_memory())))
+    create_app(role).run(host=getattr(args, "host", "0.0.0.0"), port=getattr(args, "port", 5001), threaded=True, debug=False)
+    return 0
+
 if __name__ == "__main__":
-    ensure_db()
-    app.run(host="0.0.0.0", port=5001, threaded=True, debug=False)
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# snapshot.py — نسخة قراءة فقط من جدول visitors لعقد القراءة عند البوابات (بدون SQLite مشترك بالشبكة)
+# - registry.snap: الكل مرتب بالـ id. registry.delta.NNNNNN: المسجلين بعد آخر ملف (rowid > watermark)
+# - الملف: header ثابت، index بعرض ثابت (id مبطّن بـ \0 + offset)، وheap فيه name/company/position
+# - القراءة mmap (الصفحات مشتركة بين كل الـ workers بالـ page cache) و bisect على الـ index: O(log n)
+# - الكتابة لملف مؤقت ثم os.replace، فالقارئ يشوف الملف القديم أو الجديد كامل
+#
+#   header <8sHHIQQQ: magic، kind (0 base / 1 delta)، عرض الـ id، العدد، base_id، watermark، بداية الـ heap
+#   index  <{W}sI لكل زائر: الـ id، offset بالـ heap
+#   heap   <HHH أطوال الحقول الثلاثة ثم بايتات UTF-8
+
+import os, re, mmap, time, struct, bisect, threading
+
+MAGIC    = b"QRSNAP01"
+HEADER   = struct.Struct("<8sHHIQQQ")
+FIELDS   = struct.Struct("<HHH")
+BASE     = "registry.snap"
+DELTA_RE = re.compile(r"^registry\.delta\.(\d{6})$")
+CHECK_S  = float(os.environ.get("REGISTRY_SNAPSHOT_CHECK_S", "5"))
+
+# ---------- Write ----------
+def _clip(s, n=0xFFFF):
+    b = (s or "").encode("utf-8")
+    return b if len(b) <= n else b[:n].decode("utf-8", "ignore").encode("utf-8")
+
+def write(path, rows, kind=0, base_id=0, watermark=0):
+    # rows: (id, name, company, position) — تترتب هنا. يرجع العدد
+    rows = sorted(rows, key=lambda r: r[0].encode("utf-8"))
+    width = max([len(r[0].encode("utf-8")) for r in rows] or [1])
+    entry = struct.Struct(f"<{width}sI")
+    heap, offs = bytearray(), []
+    for vid, name, company, position in rows:
+        offs.append(len(heap))
+        f = [_clip(name), _clip(company), _clip(position)]
+        heap += FIELDS.pack(*map(len, f)) + b"".join(f)
+    heap_off = HEADER.size + entry.size * len(rows)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, kind, width, len(rows), base_id or time.time_ns(), watermark, heap_off))
+        for (vid, *_), off in zip(rows, offs): fh.write(entry.pack(vid.encode("utf-8"), off))
+        fh.write(heap)
+        fh.flush(); os.fsync(fh.fileno())
+    os.replace(tmp, path)
+    return len(rows)
+
+def delta_paths(dirpath):
+    try: names = os.listdir(dirpath)
+    except OSError: return []
+    return [os.path.join(dirpath, n) for n in sorted(n for n in names if DELTA_RE.match(n))]
+
+def head(dirpath):
+    # (base_id، أعلى watermark، رقم آخر delta) من الملفات الموجودة؛ None لو ما فيه base
+    try: base = SnapshotFile(os.path.join(dirpath, BASE))
+    except (OSError, ValueError): return None
+    with base:
+        base_id, mark, seq = base.base_id, base.watermark, 0
+    for p in delta_paths(dirpath):
+        try:
+            with SnapshotFile(p) as d:
+                if d.base_id != base_id: continue
+                mark, seq = max(mark, d.watermark), max(seq, int(DELTA_RE.match(os.path.basename(p)).group(1)))
+        except (OSError, ValueError): continue
+    return base_id, mark, seq
+
+def export(dirpath, fetch, full=False):
+    # fetch(after_rowid) -> [(rowid, id, name, company, position)]. base جديد (ويحذف الـ deltas) أو delta بالجديد بس
+    os.makedirs(dirpath, exist_ok=True)
+    h = None if full else head(dirpath)
+    if h is None:
+        rows = fetch(0)
+        mark = max((r[0] for r in rows), default=0)
+        n = write(os.path.join(dirpath, BASE), [r[1:] for r in rows], 0, 0, mark)
+        for p in delta_paths(dirpath):
+            try: os.remove(p)
+            except OSError: pass
+        return dict(kind="base", visitors=n, watermark=mark)
+    base_id, mark, seq = h
+    rows = fetch(mark)
+    if not rows: return dict(kind="delta", visitors=0, watermark=mark)
+    mark = max(r[0] for r in rows)
+    path = os.path.join(dirpath, f"registry.delta.{seq+1:06d}")
+    n = write(path, [r[1:] for r in rows], 1, base_id, mark)
+    return dict(kind="delta", visitors=n, watermark=mark, file=os.path.basename(path))
+
+# ---------- Read ----------
+class _Keys:
+    # تسلسل الـ IDs المبطّنة من الـ index لـ bisect بدون ما ننسخ الـ index
+    def __init__(self, f): self.f = f
+    def __len__(self): return self.f.count
+    def __getitem__(self, i):
+        o = HEADER.size + i * self.f.entry.size
+        return self.f.mm[o:o + self.f.width]
+
+class SnapshotFile:
+    def __init__(self, path):
+        with open(path, "rb") as fh:
+            st = os.fstat(fh.fileno())
+            if st.st_size < HEADER.size: raise ValueError(f"{path}: truncated")
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.kind, self.width, self.count, self.base_id, self.watermark, self.heap_off = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC: self.mm.close(); raise ValueError(f"{path}: not a registry snapshot")
+        self.path, self.stamp = path, (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.entry = struct.Struct(f"<{self.width}sI")
+        self.keys  = _Keys(self)
+
+    def get(self, vid):
+        key = vid.encode("utf-8")
+        if len(key) > self.width: return None
+        key = key.ljust(self.width, b"\0")
+        i = bisect.bisect_left(self.keys, key)
+        if i >= self.count or self.keys[i] != key: return None
+        off = self.heap_off + self.entry.unpack_from(self.mm, HEADER.size + i * self.entry.size)[1]
+        ln = FIELDS.unpack_from(self.mm, off); off += FIELDS.size
+        out = [vid]
+        for n in ln: out.append(self.mm[off:off + n].decode("utf-8")); off += n
+        return dict(zip(("id", "name", "company", "position"), out))
+
+    def close(self): self.mm.close()
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+class Snapshot:
+    # base + deltas نفس الـ base؛ الأحدث أول. يعيد الفتح لو تغيّرت الملفات (فحص كل CHECK_S)
+    def __init__(self, dirpath, check_s=CHECK_S):
+        self.dir, self.check_s = dirpath, check_s
+        self.lock, self.files, self.stamps, self.checked = threading.Lock(), [], None, 0.0
+        self.refresh(force=True)
+
+    def _stamps(self):
+        out = []
+        for p in [os.path.join(self.dir, BASE)] + delta_paths(self.dir):
+            try: st = os.stat(p)
+            except OSError: continue
+            out.append((p, st.st_ino, st.st_mtime_ns, st.st_size))
+        return out
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.checked < self.check_s: return False
+        self.checked = now
+        stamps = self._stamps()
+        if stamps == self.stamps: return False
+        try: base = SnapshotFile(os.path.join(self.dir, BASE))
+        except (OSError, ValueError):
+            if force: raise
+            return False   # الـ base انحذف أو ناقص: نكمّل بالملفات المفتوحة
+        files = [base]
+        for p in delta_paths(self.dir):
+            try: d = SnapshotFile(p)
+            except (OSError, ValueError): continue
+            if d.base_id == base.base_id: files.append(d)
+            else: d.close()
+        with self.lock:
+            # الملفات القديمة ما تتسكر: ممكن thread ثاني بنص bisect عليها؛ الـ mmap ينفك مع الـ GC
+            self.files, self.stamps = files[::-1], stamps
+        return True
+
+    def get(self, vid):
+        self.refresh()
+        for f in self.files:
+            rec = f.get(vid)
+            if rec is not None: return rec
+        return None
+
+    def stats(self):
+        files = self.files
+        return dict(dir=self.dir, files=len(files), visitors=sum(f.count for f in files),
+                    watermark=max((f.watermark for f in files), default=0),
+                    bytes=sum(f.stamp[2] for f in files))
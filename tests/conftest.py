@@ -0,0 +1,6 @@
+# الاختبارات: قاعدة مؤقتة وبدون metrics، وتنضبط قبل ما ينستورد qr (db.init() وقت الاستيراد)
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QR_DB", os.path.join(tempfile.mkdtemp(prefix="qr-tests-"), "visitors.db"))
+os.environ.setdefault("METRICS", "0")
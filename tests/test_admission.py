@@ -0,0 +1,79 @@
+# حد المسارات الثقيلة: طابور محدود، مهلة انتظار، lane مشترك، والرفض 503 + Retry-After
+import threading
+import time
+
+import pytest
+
+import qr
+
+@pytest.fixture
+def lane(monkeypatch):
+    monkeypatch.setattr(qr, "ADMIT_ENABLED", True)
+    def make(cap):
+        monkeypatch.setattr(qr, "_admit_lane", dict(cap=cap, used=0))
+        return qr._admit_lane
+    return make
+
+def reason(gate, **kw):
+    with pytest.raises(qr.Overloaded) as e: gate.acquire(**kw)
+    return e.value.reason
+
+def wait_until(cond, timeout=5):
+    end = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < end
+        time.sleep(0.005)
+
+def test_default_queue_is_what_the_lane_leaves(lane):
+    lane(3)
+    assert qr.AdmissionGate("t", 2, queue=None).queue == 1
+    lane(20)
+    assert qr.AdmissionGate("t", 2, queue=None).queue == 18
+    assert qr.AdmissionGate("t", 2, queue=8).queue == 8
+
+def test_queue_that_cannot_fit_the_lane_is_rejected(lane):
+    lane(3)
+    with pytest.raises(ValueError, match="ADMIT_QUEUE=8"): qr.AdmissionGate("t", 2, queue=8)
+
+def test_queue_full_is_reachable_with_defaults(lane):
+    lane(3)
+    gate = qr.AdmissionGate("t", 2, queue=None, wait_s=5)
+    held = [gate.acquire(), gate.acquire()]
+    waiter = threading.Thread(target=lambda: gate.release(gate.acquire()))
+    waiter.start(); wait_until(lambda: gate.waiting == 1)
+    try: assert reason(gate) == "queue_full"
+    finally:
+        for t1 in held: gate.release(t1)
+        waiter.join()
+    assert gate.shed == dict(queue_full=1, timeout=0, lane=0) and gate.active == 0 and qr._admit_lane["used"] == 0
+
+def test_waiter_times_out_and_frees_lane(lane):
+    used = lane(4)
+    gate = qr.AdmissionGate("t", 1, queue=2, wait_s=0.05)
+    t1 = gate.acquire()
+    assert reason(gate) == "timeout"
+    assert used["used"] == 1 and gate.waiting == 0
+    gate.release(t1)
+    gate.release(gate.acquire())   # بعد ما فضى يدخل مباشرة
+    assert used["used"] == 0
+
+def test_lane_is_shared_between_gates(lane):
+    lane(2)
+    a, b = qr.AdmissionGate("a", 2, queue=0), qr.AdmissionGate("b", 1, queue=0)
+    held = [a.acquire(), a.acquire()]
+    assert reason(b) == "lane"
+    b.release(b.acquire(lane=False), lane=False)   # شغل داخل stream ماسك الـ lane أصلاً
+    for t1 in held: a.release(t1)
+    b.release(b.acquire())
+
+def test_overloaded_route_returns_503_with_retry_after(lane, monkeypatch):
+    lane(3)
+    gate = qr.decode_gate
+    monkeypatch.setattr(gate, "active", gate.limit)
+    monkeypatch.setattr(gate, "queue", 0)
+    monkeypatch.setattr(gate, "service_s", 2.5)
+    monkeypatch.setattr(gate, "shed", dict(queue_full=0, timeout=0, lane=0))
+    resp = qr.app.test_client().post("/decode", data=b"x", content_type="image/jpeg")
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == str(gate.retry_after()) and int(resp.headers["Retry-After"]) >= 2
+    assert resp.get_json() == dict(ok=False, error="overloaded", gate="decode", reason="queue_full", retry_after=gate.retry_after())
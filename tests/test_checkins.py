@@ -0,0 +1,82 @@
+# سجل الدخول: أول دخول ولا رجوع (بالذاكرة ثم القاعدة)، والكتابة المؤجلة بـ group commit
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import db
+import qr
+
+@pytest.fixture
+def log():
+    # flush يدوي بس: الـ thread ما يصحى لحاله خلال الاختبار
+    lg = qr.CheckinLog(batch=10**6, flush_s=3600, max_buffer=1000)
+    yield lg
+    lg.close()
+
+def vid():
+    return "ajz_" + uuid.uuid4().hex[:10]
+
+def rows(v):
+    return [tuple(r) for r in db.rows("SELECT gate,stage,first FROM checkins WHERE visitor_id=? ORDER BY id", (v,))]
+
+def test_first_then_reentry(log):
+    a, b = vid(), vid()
+    assert log.add(a, "north", "plain")["first"]
+    assert not log.add(a, "south", "lookup")["first"]
+    assert log.add(b, "north", "plain")["first"]
+    assert rows(a) == []   # لسه بالـ buffer
+    assert log.flush() == 3
+    assert rows(a) == [("north", "plain", 1), ("south", "lookup", 0)]
+    assert rows(b) == [("north", "plain", 1)]
+
+def test_reentry_seen_by_another_worker_after_flush(log):
+    a = vid()
+    log.add(a, "north", "plain"); log.flush()
+    other = qr.CheckinLog(batch=10**6, flush_s=3600)   # worker ثاني: ذاكرة فاضية، يسأل القاعدة
+    try: assert not other.add(a, "south", "plain")["first"]
+    finally: other.close()
+
+def test_concurrent_scans_of_one_badge_give_one_first(log):
+    a, start, out = vid(), threading.Barrier(16), []
+    def scan():
+        start.wait(); out.append(log.add(a, "north", "plain")["first"])
+    threads = [threading.Thread(target=scan) for _ in range(16)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert out.count(True) == 1
+    log.flush()
+    assert sum(r[2] for r in rows(a)) == 1 and len(rows(a)) == 16
+
+def test_counts_follow_flushed_rows(log):
+    day = datetime.utcnow().date().isoformat()
+    gate = "gate-" + uuid.uuid4().hex[:6]
+    a, b = vid(), vid()
+    for v in (a, a, b): log.add(v, gate, "plain")
+    log.flush()
+    assert db.checkin_counts(day)["gates"][gate] == dict(n=3, first=2)
+
+def test_failed_flush_keeps_rows(log, monkeypatch):
+    a = vid()
+    log.add(a, "north", "plain")
+    @contextmanager
+    def broken():
+        raise sqlite3.OperationalError("database is locked")
+        yield
+    monkeypatch.setattr(db, "transaction", broken)
+    assert log.flush() == 0 and log.stats()["pending"] == 1
+    monkeypatch.undo()
+    assert log.flush() == 1 and rows(a) == [("north", "plain", 1)]
+
+def test_buffer_cap_drops_oldest():
+    lg = qr.CheckinLog(batch=10**6, flush_s=3600, max_buffer=3)
+    try:
+        vids = [vid() for _ in range(5)]
+        for v in vids: lg.add(v, "north", "plain")
+        assert lg.stats()["dropped"] == 2
+        lg.flush()
+        assert [len(rows(v)) for v in vids] == [0, 0, 1, 1, 1]
+    finally: lg.close()
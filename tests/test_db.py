@@ -0,0 +1,34 @@
+# طبقة SQLite: اتصال لكل thread، WAL، الـ schema مرة وحدة لكل process، و transaction يرجع لو فشل
+import threading
+import uuid
+
+import pytest
+
+import db
+import qr
+
+def test_connection_is_per_thread_and_reused():
+    mine, other = db.conn(), []
+    assert db.conn() is mine
+    t = threading.Thread(target=lambda: other.append(db.conn())); t.start(); t.join()
+    assert other[0] is not mine
+
+def test_database_is_in_wal_mode():
+    assert db.row("PRAGMA journal_mode")[0].lower() == "wal"
+
+def test_requests_run_no_schema_ddl():
+    client, seen = qr.app.test_client(), []
+    client.get("/lookup/ajz_aaaaaaaaaa.json")   # أول طلب بهذا الـ thread يفتح الاتصال
+    db.conn().set_trace_callback(seen.append)
+    try:
+        client.get("/lookup/ajz_aaaaaaaaaa.json"); client.get("/visitors")
+    finally: db.conn().set_trace_callback(None)
+    assert seen and not [s for s in seen if s.lstrip().upper().startswith(("CREATE", "ALTER", "PRAGMA JOURNAL_MODE"))]
+
+def test_transaction_rolls_back_on_error():
+    key = uuid.uuid4().hex
+    with pytest.raises(RuntimeError):
+        with db.transaction() as c:
+            c.execute(db.SQL_IDEM_PUT, (key, "v", "{}", 0))
+            raise RuntimeError
+    assert not db.conn().in_transaction and db.row("SELECT 1 FROM idempotency WHERE key=?", (key,)) is None
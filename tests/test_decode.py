@@ -0,0 +1,368 @@
+# القراءة: عدة باجات بصورة وحدة، تحديد المكان والـ fallback، الفك المصغّر للـ JPEG، ترتيب المراحل والـ deadline، تيلات الـ pyramid، فريمات الـ scan stream، والـ batch
+import base64
+import io
+import json
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import qr
+
+def _zbar():
+    try: qr.load_decoders(); return True
+    except ImportError: return False
+
+needs_zbar = pytest.mark.skipif(not _zbar(), reason="zbar shared library not installed")
+
+def badge(vid, side=120, inverted=False):
+    # المعكوس داخل مربع أسود بهامش: بعد مرحلة inverted يصير له quiet zone أبيض مثل العادي.
+    # 120px (~5px للموديول) عشان adaptiveThreshold (block 31) يعبّي الموديولات مو يرسم حدودها بس
+    q = qr.build_qr_image(vid, side)
+    if not inverted: return q
+    box = Image.new("L", (side + 60, side + 60), 0)
+    box.paste(Image.eval(q, lambda v: 255 - v), (30, 30))
+    return box
+
+def group_photo(*codes):
+    # [(vid, inverted)] جنب بعض على خلفية بيضا (أعرض من 800 عشان decode_multi ما يكبّرها)
+    img = Image.new("L", (250 * len(codes) + 200, 800), 255)
+    for i, (vid, inv) in enumerate(codes): img.paste(badge(vid, inverted=inv), (150 + 250 * i - 30 * inv, 300 - 30 * inv))
+    return np.asarray(img)
+
+# ---------- Multi-code ----------
+def test_codes_dedupe_by_text_and_spot():
+    codes = qr._Codes()
+    box = lambda x: [[x, 0], [x + 100, 0], [x + 100, 100], [x, 100]]
+    assert codes.add("ajz_aaaaaaaaaa", box(0), "plain")
+    assert not codes.add("ajz_aaaaaaaaaa", box(900), "rot90")   # نفس النص بمكان ثاني (انعكاس)
+    assert not codes.add("ajz_bbbbbbbbbb", box(10), "adaptive")  # نفس المكان
+    assert codes.add("ajz_bbbbbbbbbb", box(500), "adaptive")
+    assert [c["text"] for c in codes.items] == ["ajz_aaaaaaaaaa", "ajz_bbbbbbbbbb"]
+
+@needs_zbar
+def test_decode_multi_finds_every_badge():
+    vids = ["ajz_aaaaaaaaaa", "ajz_bbbbbbbbbb", "ajz_cccccccccc"]
+    codes = qr.decode_multi(group_photo(*[(v, False) for v in vids]))
+    assert sorted(c["text"] for c in codes) == vids
+
+@needs_zbar
+def test_decode_multi_runs_later_stages_after_a_hit():
+    # الباج المعكوس (أبيض على أسود) ما يطلع إلا بمرحلة inverted، حتى لو plain لقى الباقين
+    codes = qr.decode_multi(group_photo(("ajz_aaaaaaaaaa", False), ("ajz_bbbbbbbbbb", False), ("ajz_cccccccccc", True)))
+    by = {c["text"]: c["stage"] for c in codes}
+    assert set(by) == {"ajz_aaaaaaaaaa", "ajz_bbbbbbbbbb", "ajz_cccccccccc"}
+    assert by["ajz_aaaaaaaaaa"] == "plain"
+
+@needs_zbar
+def test_decode_multi_reports_repeated_badge_once():
+    codes = qr.decode_multi(group_photo(("ajz_aaaaaaaaaa", False), ("ajz_aaaaaaaaaa", False)))
+    assert [c["text"] for c in codes] == ["ajz_aaaaaaaaaa"]
+
+# ---------- Localization ----------
+QUAD = np.float32([[300, 200], [500, 200], [500, 400], [300, 400]])
+
+@pytest.fixture
+def fake_zbar(stats, monkeypatch):
+    # zbar وهمي: يقرا بس القصاصة المفرودة (مربعة) لو hit، والإطار نفسه (1200x900) ما ينقرا
+    def decode(im, hit=False):
+        if hit and im.shape[0] == im.shape[1]: return "ajz_aaaaaaaaaa", [[40, 40], [200, 40], [200, 200], [40, 200]]
+        return "", []
+    monkeypatch.setattr(qr, "DECODE_LOCALIZE", True)
+    monkeypatch.setattr(qr, "DECODE_FULLFRAME_FALLBACK", True)
+    return decode
+
+def frame():
+    return np.full((900, 1200), 200, np.uint8)
+
+def test_localized_roi_is_decoded_and_mapped_back(fake_zbar, monkeypatch):
+    monkeypatch.setattr(qr, "decode_pyzbar", lambda im: fake_zbar(im, hit=True))
+    monkeypatch.setattr(qr, "locate_qr_regions", lambda img: [QUAD])
+    plan = qr.DecodePlan()
+    t, p, stage = qr.robust_decode_ex(frame(), plan=plan)
+    assert (t, stage, plan.tried) == ("ajz_aaaaaaaaaa", "roi_plain", ["plain", "roi_plain"])
+    assert all(290 <= x <= 510 and 190 <= y <= 410 for x, y in p)
+
+def test_found_region_that_fails_skips_full_frame(fake_zbar, monkeypatch):
+    monkeypatch.setattr(qr, "decode_pyzbar", fake_zbar)
+    monkeypatch.setattr(qr, "locate_qr_regions", lambda img: [QUAD])
+    plan = qr.DecodePlan()
+    assert qr.robust_decode_ex(frame(), plan=plan) == ("", [], "")
+    assert plan.tried == ["plain"] + ["roi_" + k for k in qr.DECODE_STAGES]
+
+def test_full_frame_fallback_only_without_regions(fake_zbar, monkeypatch):
+    monkeypatch.setattr(qr, "decode_pyzbar", fake_zbar)
+    monkeypatch.setattr(qr, "locate_qr_regions", lambda img: [])
+    plan = qr.DecodePlan()
+    assert qr.robust_decode_ex(frame(), plan=plan) == ("", [], "")
+    assert plan.tried == list(qr.DECODE_STAGES)
+    monkeypatch.setattr(qr, "DECODE_FULLFRAME_FALLBACK", False)
+    plan = qr.DecodePlan()
+    qr.robust_decode_ex(frame(), plan=plan)
+    assert plan.tried == ["plain"]
+
+# ---------- Ingest ----------
+def jpeg(w, h, **kw):
+    b = io.BytesIO(); Image.new("RGB", (w, h), (200, 200, 200)).save(b, "JPEG", **kw)
+    return b.getvalue()
+
+@pytest.mark.parametrize("kw", [{}, {"progressive": True}, {"exif": b"Exif\x00\x00" + b"\x00" * 64}])
+def test_jpeg_size_reads_sof_header(kw):
+    assert qr.jpeg_size(jpeg(1234, 567, **kw)) == (1234, 567)
+
+def test_jpeg_size_rejects_other_formats():
+    png = io.BytesIO(); Image.new("L", (10, 10)).save(png, "PNG")
+    assert qr.jpeg_size(png.getvalue()) is None
+    assert qr.jpeg_size(b"\xff\xd8") is None
+
+@pytest.mark.parametrize("min_side, f", [(2000, 2), (1000, 4), (500, 8), (5000, 1)])
+def test_imdecode_reduces_large_jpeg(min_side, f):
+    img, got = qr.imdecode(jpeg(4000, 2400), min_side)
+    assert got == f and img.ndim == 2 and img.shape == (2400 // f, 4000 // f)
+
+def test_imdecode_keeps_non_jpeg_full_size():
+    png = io.BytesIO(); Image.new("L", (4000, 100), 128).save(png, "PNG")
+    img, f = qr.imdecode(png.getvalue(), 500)
+    assert f == 1 and img.shape == (100, 4000)
+
+def test_upload_buffer_closes_mmap():
+    data = jpeg(640, 480)
+    with tempfile.TemporaryFile() as fh:
+        fh.write(data); fh.seek(0)
+        with qr.upload_buffer(FileStorage(stream=fh, filename="badge.jpg")) as buf:
+            assert not isinstance(buf, bytes) and buf[:] == data
+            assert qr.imdecode(buf)[0].shape == (480, 640)
+        assert buf.closed
+    with qr.upload_buffer(FileStorage(stream=io.BytesIO(data))) as buf: assert buf == data
+
+def test_upload_buffer_leaves_small_spooled_upload_in_memory():
+    data = jpeg(64, 48)
+    with tempfile.SpooledTemporaryFile(max_size=500 * 1024, mode="rb+") as st:
+        st.write(data); st.seek(0)
+        with qr.upload_buffer(FileStorage(stream=st, filename="badge.jpg")) as buf: assert buf == data
+        assert not st._rolled
+    with tempfile.SpooledTemporaryFile(max_size=16, mode="rb+") as st:
+        st.write(data); st.seek(0)
+        assert st._rolled
+        with qr.upload_buffer(FileStorage(stream=st, filename="badge.jpg")) as buf:
+            assert not isinstance(buf, bytes) and buf[:] == data
+
+# ---------- Adaptive ordering / deadline ----------
+@pytest.fixture
+def stats(monkeypatch):
+    s = qr.StageStats()
+    monkeypatch.setattr(qr, "stage_stats", s)
+    monkeypatch.setattr(qr, "DECODE_ADAPTIVE", True)
+    return s
+
+def feed(stats, device, stage, hits, misses, secs):
+    for i in range(hits + misses): stats.record(device, stage, i < hits, secs)
+
+def test_stage_order_without_data_is_cascade_order(stats):
+    assert list(qr.DecodePlan().stages(qr.DECODE_STAGES)) == list(qr.DECODE_STAGES)
+
+def test_stage_order_prefers_hits_per_second(stats):
+    feed(stats, "", "plain", 0, 50, 0.01)
+    feed(stats, "", "adaptive", 40, 10, 0.02)
+    order = list(qr.DecodePlan().stages(qr.DECODE_STAGES))
+    assert order[0] == "adaptive" and order[-1] == "plain"
+
+def test_device_stats_blend_with_global(stats):
+    feed(stats, "phone-a", "contrast", 60, 0, 0.01)
+    feed(stats, "phone-b", "plain", 50, 50, 0.01)
+    feed(stats, "phone-b", "contrast", 0, 500, 0.01)
+    assert next(qr.DecodePlan("phone-a").stages(qr.DECODE_STAGES)) == "contrast"
+    assert next(qr.DecodePlan("phone-new").stages(qr.DECODE_STAGES)) == "plain"   # الترتيب العام
+
+def test_adaptive_off_keeps_cascade_order(stats, monkeypatch):
+    feed(stats, "", "inverted", 50, 0, 0.001)
+    monkeypatch.setattr(qr, "DECODE_ADAPTIVE", False)
+    assert list(qr.DecodePlan().stages(qr.DECODE_STAGES)) == list(qr.DECODE_STAGES)
+
+def test_deadline_skips_stages_that_cannot_finish(stats):
+    feed(stats, "", "adaptive", 10, 0, 5.0)   # مرحلة ناجحة بس كلفتها 5 ثواني
+    plan = qr.DecodePlan(deadline_ms=1000)
+    order = list(plan.stages(qr.DECODE_STAGES, prefix=""))
+    assert "adaptive" not in order and plan.skipped == ["adaptive"] and not plan.timed_out
+    assert len(order) == len(qr.DECODE_STAGES) - 1
+
+def test_expired_plan_stops(stats):
+    plan = qr.DecodePlan(deadline_ms=1)
+    time.sleep(0.005)
+    assert list(plan.stages(qr.DECODE_STAGES)) == [] and plan.expired() and plan.timed_out
+    report = plan.report()
+    assert report["timed_out"] and report["tried"] == [] and report["elapsed_ms"] >= 1
+
+def test_no_deadline_never_expires(stats):
+    plan = qr.DecodePlan(deadline_ms=0)
+    assert plan.left() is None and not plan.expired()
+
+# ---------- Pyramid tiles ----------
+SHAPE = (3000, 4000)   # h, w
+
+def inner(tile, c, shape=SHAPE, m=qr.DECODE_PYRAMID_TILE // 8):
+    # المنطقة اللي لازم العلامة تكون فيها: ثُمن بعيد عن حافة التيل، إلا الحافة اللي على طرف الصورة
+    x, y, side, _ = tile
+    h, w = shape
+    x0, x1 = (x + m if x > 0 else 0), (x + side - m if x + side < w else w)
+    y0, y1 = (y + m if y > 0 else 0), (y + side - m if y + side < h else h)
+    return x0 <= c[0] < x1 and y0 <= c[1] < y1
+
+def test_tiles_cover_finders_inside_the_image():
+    cands = [(100, 100, 12), (300, 100, 12), (2000, 1500, 12), (2060, 1560, 12), (3990, 2990, 12), (3900, 2990, 12)]
+    tiles = qr.pyramid_tiles(SHAPE, cands)
+    tile = qr.DECODE_PYRAMID_TILE
+    assert {c for t in tiles for c in t[3]} == set(cands)
+    for t in tiles:
+        x, y, side, finders = t
+        assert side == tile and 0 <= x <= SHAPE[1] - tile and 0 <= y <= SHAPE[0] - tile
+        assert len(finders) >= 2 and all(inner(t, c) for c in finders)
+    corner = [t for t in tiles if (3990, 2990, 12) in t[3]]
+    assert corner and corner[0][:2] == (SHAPE[1] - tile, SHAPE[0] - tile)   # ملصوق بطرف الصورة
+
+def test_lone_finder_gets_no_tile():
+    assert qr.pyramid_tiles(SHAPE, [(2000, 1500, 12)]) == []
+    assert qr.pyramid_tiles(SHAPE, []) == []
+
+def test_tiles_are_capped():
+    pairs = [c for i in range(8) for c in ((200 + 900 * (i % 4), 300 + 1200 * (i // 4), 10), (260 + 900 * (i % 4), 300 + 1200 * (i // 4), 10))]
+    assert len(qr.pyramid_tiles(SHAPE, pairs, max_tiles=3)) == 3
+    assert len(qr.pyramid_tiles(SHAPE, pairs, max_tiles=16)) <= 8
+
+def test_tile_on_small_image_starts_at_origin():
+    tiles = qr.pyramid_tiles((600, 900), [(10, 10, 8), (50, 10, 8)])
+    assert [t[:3] for t in tiles] == [(0, 0, qr.DECODE_PYRAMID_TILE)]
+
+def test_finders_from_small_level_map_to_full_resolution(monkeypatch):
+    # العلامات تنلقط على مستوى الـ 2000px وتوصل pyramid_tiles بإحداثيات الصورة الكاملة
+    photo = Image.new("L", (4000, 3000), 200)
+    photo.paste(qr.build_qr_image("ajz_aaaaaaaaaa", 120), (2000, 1000))
+    img, seen = np.asarray(photo), []
+    monkeypatch.setattr(qr, "decode_pyzbar", lambda im: ("", []))
+    monkeypatch.setattr(qr, "pyramid_tiles", lambda shape, cands: seen.append((shape, cands)) or [])
+    qr.robust_decode_ex(img, plan=qr.DecodePlan(), pyramid=True)
+    (shape, cands), = seen
+    full = sorted(qr.finder_candidates(img))
+    assert shape == img.shape and len(cands) == len(full) == 3
+    for (x, y, side), (fx, fy, fside) in zip(sorted(cands), full):
+        assert abs(x - fx) <= 3 and abs(y - fy) <= 3 and abs(side - fside) <= 4
+
+# ---------- Scan stream ----------
+def png(w=40, h=30, v=128):
+    b = io.BytesIO(); Image.new("L", (w, h), v).save(b, "PNG")
+    return b.getvalue()
+
+def framed(*frames):
+    return io.BytesIO(b"".join(len(f).to_bytes(4, "big") + f for f in frames))
+
+def ndjson(*objs):
+    return io.BytesIO(b"".join((o if isinstance(o, bytes) else json.dumps(o).encode()) + b"\n" for o in objs))
+
+def shapes(stream, **kw):
+    return [None if img is None else img.shape for img, f in qr.scan_frames(stream, **kw)]
+
+def test_length_prefixed_frames():
+    assert shapes(framed(png(40, 30), b"junk", png(20, 10))) == [(30, 40), None, (10, 20)]
+    assert shapes(io.BytesIO(framed(png()).getvalue()[:-5])) == []   # فريم ناقص بآخر الـ stream
+
+def test_oversize_length_prefixed_frame_ends_stream(monkeypatch):
+    monkeypatch.setattr(qr, "SCAN_MAX_FRAME_BYTES", 200)
+    assert shapes(framed(png(), png(400, 400, 7) + b"\0" * 300, png())) == [(30, 40)]
+
+def test_ndjson_frames():
+    b64 = lambda b: base64.b64encode(b).decode()
+    s = ndjson({"image_b64": b64(png(40, 30))}, b"", b"{oops", [1, 2], {"image_b64": 5}, {"image_b64": "data:image/png;base64," + b64(png(20, 10))})
+    assert shapes(s, ndjson=True) == [(30, 40), None, None, None, (10, 20)]
+
+def test_oversize_ndjson_line_is_one_bad_frame(monkeypatch):
+    monkeypatch.setattr(qr, "SCAN_MAX_FRAME_BYTES", 200)
+    big = base64.b64encode(png() + b"\0" * 1500).decode()
+    s = ndjson({"image_b64": big}, {"image_b64": base64.b64encode(png()).decode()})
+    assert shapes(s, ndjson=True) == [None, (30, 40)]
+
+@pytest.fixture
+def session(monkeypatch):
+    # القراءة وهمية: كل فريم فيه نفس الباج؛ المهم منطق تخطي الفريمات والـ dedupe
+    poly = [[10, 10], [50, 10], [50, 50], [10, 50]]
+    monkeypatch.setattr(qr, "decode_cascade", lambda *a, **kw: ("", [], ""))
+    monkeypatch.setattr(qr, "robust_decode_ex", lambda img, plan=None: ("ajz_aaaaaaaaaa", poly, "plain"))
+    return qr.ScanSession("gate-1")
+
+def noise(seed):
+    return np.random.default_rng(seed).integers(0, 255, (120, 160), dtype=np.uint8)
+
+def test_scan_session_skips_repeated_frame(session):
+    ev = session.feed(noise(0), now=0, f=2)
+    assert ev == dict(event="id", frame=0, text="ajz_aaaaaaaaaa", poly=[[20, 20], [100, 20], [100, 100], [20, 100]], stage="plain")
+    assert session.feed(noise(0), now=1) is None
+    assert session.stats() == dict(frames=2, skipped=1, decoded=1, ids=1)
+
+def test_scan_session_dedupes_id_within_window(session):
+    assert session.feed(noise(0), now=0)
+    assert session.feed(noise(1), now=qr.SCAN_DEDUPE_S - 1) is None
+    ev = session.feed(noise(2), now=2 * qr.SCAN_DEDUPE_S)   # الـ window يبدأ من آخر مرة انشاف
+    assert ev and ev["frame"] == 2
+    assert session.stats() == dict(frames=3, skipped=0, decoded=3, ids=1)
+
+# ---------- Batch ----------
+real_decode_image_bytes = qr.decode_image_bytes
+
+@pytest.fixture
+def batch_pool(monkeypatch):
+    # threads بدل process pool (spawn بطيء للاختبار)، و "img:<ثواني>:<نص>" قراءة وهمية بتأخير؛ الباقي للحقيقية
+    pool = ThreadPoolExecutor(4)
+    def decode(data):
+        if not data.startswith(b"img:"): return real_decode_image_bytes(data)
+        _, secs, text = data.decode().split(":")
+        time.sleep(float(secs))
+        return dict(ok=True, text=text, poly=[])
+    monkeypatch.setattr(qr, "process_pool", lambda name, workers: pool)
+    monkeypatch.setattr(qr, "decode_image_bytes", decode)
+    yield
+    pool.shutdown()
+
+def lines(body):
+    return [json.loads(l) for l in body.decode().splitlines()]
+
+def test_batch_streams_results_as_they_finish(batch_pool):
+    out = lines(b"".join(l.encode() for l in qr.decode_batch_stream(iter([
+        ("slow.jpg", b"img:0.3:ajz_aaaaaaaaaa"), ("broken.zip", None), ("fast.jpg", b"img:0:ajz_bbbbbbbbbb"),
+        ("big.jpg", "too_large"), ("junk.jpg", b"not an image")]))))
+    assert sorted(r["index"] for r in out) == [0, 1, 2, 3, 4] and out[-1]["name"] == "slow.jpg"
+    by = {r["name"]: r for r in out}
+    assert by["slow.jpg"] == dict(index=0, name="slow.jpg", ok=True, text="ajz_aaaaaaaaaa", poly=[])
+    assert by["fast.jpg"]["text"] == "ajz_bbbbbbbbbb"
+    assert [by[n]["error"] for n in ("broken.zip", "big.jpg", "junk.jpg")] == ["bad_archive_entry", "too_large", "bad_image"]
+
+def zipped(**entries):
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, "w") as zf:
+        zf.writestr("photos/", b"")
+        for name, data in entries.items(): zf.writestr(name, data)
+    return b.getvalue()
+
+def test_batch_route_reads_files_and_zip_entries(batch_pool, monkeypatch):
+    monkeypatch.setattr(qr, "DECODE_BATCH_MAX_IMAGE_BYTES", 64)
+    archive = zipped(**{"photos/a.jpg": b"img:0:ajz_aaaaaaaaaa", "photos/huge.jpg": b"img:0:" + b"x" * 100})
+    with qr.app.test_client().post("/decode/batch", content_type="multipart/form-data", data={
+            "file": [(io.BytesIO(b"img:0:ajz_bbbbbbbbbb"), "b.jpg"), (io.BytesIO(archive), "more.zip")]}) as resp:
+        assert resp.status_code == 200 and resp.mimetype == "application/x-ndjson"
+        by = {r["name"]: r for r in lines(resp.data)}
+    assert set(by) == {"b.jpg", "photos/a.jpg", "photos/huge.jpg"}
+    assert [by["b.jpg"]["index"], by["photos/a.jpg"]["index"], by["photos/huge.jpg"]["index"]] == [0, 1, 2]
+    assert by["photos/a.jpg"]["text"] == "ajz_aaaaaaaaaa" and by["photos/huge.jpg"]["error"] == "too_large"
+
+def test_batch_route_takes_raw_zip_body(batch_pool):
+    # الرد لازم يتسكّر (مثل الـ server) عشان slot الـ stream يرجع
+    client = qr.app.test_client()
+    with client.post("/decode/batch", data=zipped(**{"a.jpg": b"img:0:ajz_aaaaaaaaaa"}), content_type="application/zip") as resp:
+        assert [(r["name"], r["text"]) for r in lines(resp.data)] == [("a.jpg", "ajz_aaaaaaaaaa")]
+    with client.post("/decode/batch", data=b"not a zip", content_type="application/zip") as resp:
+        assert lines(resp.data) == [dict(index=0, name="", ok=False, error="bad_archive_entry", text="", poly=[])]
+    assert qr.stream_gate.active == 0
+    assert client.post("/decode/batch", data=b"", content_type="image/jpeg").status_code == 400
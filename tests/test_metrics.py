@@ -0,0 +1,66 @@
+# تجميع الـ metrics بين الـ workers: الميت تنطوي أرقامه بـ dead.json (العدّاد ما يرجع لورا) والـ gauges حقته تنرمى
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+
+@pytest.fixture
+def mdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    monkeypatch.setattr(metrics, "DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_owned", None)
+    monkeypatch.setattr(metrics, "_data", {"counter": {}, "gauge": {}, "histogram": {}})
+    monkeypatch.setattr(metrics, "_pid", os.getpid())   # بدون thread الـ flush الدوري
+    return tmp_path
+
+def dead_pid():
+    p = subprocess.Popen([sys.executable, "-c", "pass"]); p.wait()
+    return p.pid
+
+def worker_file(d, pid, counter=0, hist=None, gauge=None):
+    h = [0] * (len(metrics.BUCKETS) + 1) + [0.0]
+    if hist: h[0], h[-1] = 1, hist
+    data = {"help": {}, "counter": {"qr_x_total|": counter}, "histogram": {"qr_x_seconds|": h},
+            "gauge": {f"qr_g|pid={pid}": 1} if gauge else {}}
+    (d / f"{pid}.json").write_text(json.dumps(data))
+
+def test_dead_worker_counters_survive(mdir):
+    metrics.inc("qr_x_total", 2); metrics.observe("qr_x_seconds", 0.0001)
+    pid = dead_pid()
+    worker_file(mdir, pid, counter=5, hist=0.0002, gauge=True)
+    merged, _ = metrics.collect()
+    assert merged["counter"]["qr_x_total|"] == 7
+    assert merged["histogram"]["qr_x_seconds|"][0] == 2
+    assert f"qr_g|pid={pid}" not in merged["gauge"]
+    assert not (mdir / f"{pid}.json").exists() and (mdir / metrics.DEAD).exists()
+    metrics.inc("qr_x_total")
+    assert metrics.collect()[0]["counter"]["qr_x_total|"] == 8   # مرة ثانية: ما انطوى مرتين ولا انحذف
+
+def test_dead_workers_accumulate(mdir):
+    for n in (3, 4):
+        worker_file(mdir, dead_pid(), counter=n)
+        metrics.collect()
+    assert json.loads((mdir / metrics.DEAD).read_text())["counter"]["qr_x_total|"] == 7
+
+def test_stale_file_of_reused_pid_is_folded(mdir):
+    # ملف باقي بنفس pid هذا الـ process (من process قبله): أول flush يطويه بدل ما يكتب فوقه
+    worker_file(mdir, os.getpid(), counter=10)
+    metrics.inc("qr_x_total")
+    assert metrics.collect()[0]["counter"]["qr_x_total|"] == 11
+
+def test_render_includes_folded_counters(mdir):
+    worker_file(mdir, dead_pid(), counter=3)
+    assert "qr_x_total 3" in metrics.render().splitlines()
+
+def test_default_dir_is_per_instance():
+    def default_dir(**env):
+        env = {k: v for k, v in os.environ.items() if k not in ("METRICS_DIR", "PORT", "QR_ROLE")} | env
+        out = subprocess.run([sys.executable, "-c", "import metrics; print(metrics.DIR)"], env=env,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True)
+        return out.stdout.strip()
+    web, decode = default_dir(QR_ROLE="web", PORT="10000"), default_dir(QR_ROLE="decode", PORT="10001")
+    assert web and decode and web != decode
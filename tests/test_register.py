@@ -0,0 +1,194 @@
+# التسجيل: idempotency بالمفتاح، upsert بالتواصل، و group commit لطلبات متزامنة
+import io
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+import pytest
+
+import db
+import qr
+
+def fields(name="Sara Ali"):
+    tag = uuid.uuid4().hex[:12]
+    return (name, "Acme", "Engineer", f"{tag}@example.com", "05" + str(int(tag, 16))[:8])
+
+def count(email):
+    return db.row("SELECT COUNT(*) AS n FROM visitors WHERE email=?", (email,))["n"]
+
+def test_replayed_key_returns_first_result_without_new_row():
+    f = fields()
+    key = "create:" + uuid.uuid4().hex
+    first = qr.register(f, key=key)
+    again = qr.register(f, key=key)
+    assert first["created"] and not first["replayed"]
+    assert again["replayed"] and again["id"] == first["id"] and again["created"]
+    assert count(f[3]) == 1
+
+def test_same_contact_without_key_returns_existing_visitor():
+    f = fields()
+    first = qr.register(f)
+    again = qr.register(f[:3] + (f[3], "0000000000"))   # نفس الإيميل، جوال ثاني
+    assert again == dict(id=first["id"], name=first["name"], created=False, replayed=False)
+    assert count(f[3]) == 1
+
+def test_registered_visitor_is_served_by_registry():
+    f = fields()
+    res = qr.register(f)
+    assert qr.registry.get(res["id"]) == dict(id=res["id"], name=f[0], company=f[1], position=f[2])
+
+def test_concurrent_registrations_share_commits(monkeypatch):
+    batcher = qr.RegisterBatcher(batch=64, wait_s=0.05)
+    commits, commit = [], batcher._commit
+    monkeypatch.setattr(batcher, "_commit", lambda batch: (commits.append(len(batch)), commit(batch)))
+    items = [fields(f"Visitor {i}") for i in range(24)]
+    out, start = {}, threading.Barrier(len(items))
+    def run(f):
+        start.wait(); out[f[3]] = batcher.submit(dict(fields=f, key=None, wa=False))
+    threads = [threading.Thread(target=run, args=(f,)) for f in items]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert sum(commits) == len(items) and len(commits) < len(items)
+    assert all(out[f[3]]["created"] for f in items)
+    assert len({r["id"] for r in out.values()}) == len(items)
+    assert all(count(f[3]) == 1 for f in items)
+
+def test_failed_registration_does_not_roll_back_its_batch(monkeypatch):
+    real = qr._register_one
+    def flaky(con, item, now):
+        if item["fields"][0] == "broken": raise sqlite3.IntegrityError("boom")
+        return real(con, item, now)
+    monkeypatch.setattr(qr, "_register_one", flaky)
+    batcher = qr.RegisterBatcher(batch=64, wait_s=0.05)
+    good, bad = fields(), fields("broken")
+    out, start = {}, threading.Barrier(2)
+    def run(f):
+        start.wait()
+        try: out[f[0]] = batcher.submit(dict(fields=f, key=None, wa=False))
+        except sqlite3.Error as e: out[f[0]] = e
+    threads = [threading.Thread(target=run, args=(f,)) for f in (good, bad)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert isinstance(out["broken"], sqlite3.IntegrityError)
+    assert out[good[0]]["created"] and count(good[3]) == 1
+    assert count(bad[3]) == 0
+
+@pytest.fixture
+def locked_db():
+    # اتصال ثاني ماسك قفل الكتابة، وbusy_timeout قصير لاتصال هذا الـ thread (الـ leader يكتب منه)
+    other = db.connect(); other.execute("BEGIN IMMEDIATE")
+    db.conn().execute("PRAGMA busy_timeout=50")
+    try: yield other
+    finally:
+        if other.in_transaction: other.execute("ROLLBACK")
+        other.close()
+        db.conn().execute(f"PRAGMA busy_timeout={db.BUSY_TIMEOUT_MS}")
+
+@pytest.mark.parametrize("path", ["/create", "/forms/google"])
+def test_locked_database_sheds_instead_of_500(locked_db, path):
+    name, company, position, email, phone = fields()
+    form = dict(name=name, company=company, position=position, email=email, phone=phone)
+    client = qr.app.test_client()
+    resp = client.post(path, data=form)
+    assert resp.status_code == 503 and int(resp.headers["Retry-After"]) >= 1
+    assert resp.get_json()["reason"] == "db_locked" and count(email) == 0
+    locked_db.execute("ROLLBACK")
+    resp = client.post(path, data=form)
+    assert resp.status_code == 200 and resp.get_json()["created"] and count(email) == 1
+
+# ---------- Visitor listing ----------
+def test_visitors_cursor_pagination():
+    for i in range(5): qr.register(fields(f"Paged {i}"))
+    client, seen, cursor, pages = qr.app.test_client(), [], None, 0
+    while True:
+        resp = client.get("/visitors", query_string=dict(limit=2, **({"cursor": cursor} if cursor else {}))).get_json()
+        assert resp["ok"] and len(resp["items"]) <= 2
+        seen += resp["items"]; cursor = resp["next_cursor"]; pages += 1
+        if not cursor: break
+        assert len(resp["items"]) == 2
+    keys = [(v["created_at"], v["id"]) for v in seen]
+    assert keys == sorted(keys, reverse=True) and len(set(keys)) == len(keys)
+    assert len(seen) == db.kpis("")["total"] and pages == len(seen) // 2 + 1
+
+@pytest.mark.parametrize("cursor", ["not base64 !", "bnVsbA", "WzFd"])   # خربان، null، [1]
+def test_visitors_bad_cursor_is_400(cursor):
+    resp = qr.app.test_client().get("/visitors", query_string=dict(cursor=cursor))
+    assert resp.status_code == 400 and resp.get_json()["error"] == "bad_cursor"
+
+# ---------- WhatsApp queue ----------
+@pytest.fixture
+def wa_job():
+    db.conn().execute("DELETE FROM wa_jobs")
+    f = fields()
+    res = qr.register(f, wa=True)
+    assert res["whatsapp"]["status"] == "queued"
+    return res["whatsapp"]["job"], res["id"], f
+
+def job_row(job_id):
+    return dict(db.row("SELECT * FROM wa_jobs WHERE id=?", (job_id,)))
+
+def test_wa_enqueue_once_per_visitor(wa_job):
+    job_id, vid, f = wa_job
+    again = qr.register(f, wa=True)
+    assert again["id"] == vid and again["whatsapp"] == dict(ok=True, status="already_queued", job=None)
+    assert db.row("SELECT COUNT(*) AS n FROM wa_jobs WHERE visitor_id=?", (vid,))["n"] == 1
+
+def test_wa_claim_leases_job(wa_job):
+    job_id, vid, _ = wa_job
+    t0 = time.time()
+    job = qr._wa_claim()
+    assert job["id"] == job_id and job["visitor_id"] == vid and job["attempts"] == 0
+    row = job_row(job_id)
+    assert row["status"] == "sending" and row["attempts"] == 1 and row["next_at"] >= t0 + qr.WA_LEASE_S
+    assert qr._wa_claim() is None                       # مأخوذة لين ينتهي الـ lease
+    db.conn().execute("UPDATE wa_jobs SET next_at=0 WHERE id=?", (job_id,))   # worker مات وانتهى الـ lease
+    again = qr._wa_claim()
+    assert again["id"] == job_id and again["attempts"] == 1 and job_row(job_id)["attempts"] == 2
+
+def test_wa_retry_backs_off(wa_job):
+    job_id, _, _ = wa_job
+    job, t0 = qr._wa_claim(), time.time()
+    qr._wa_finish(job, "503: busy")
+    row = job_row(job_id)
+    assert row["status"] == "pending" and row["last_error"] == "503: busy"
+    assert t0 + qr.WA_BACKOFF_S * 0.8 - 1 <= row["next_at"] <= t0 + qr.WA_BACKOFF_S * 1.2 + 1
+    assert qr._wa_claim() is None                       # مو مستحقة قبل الـ backoff
+
+@pytest.mark.parametrize("permanent, attempts", [(True, 0), (False, qr.WA_MAX_ATTEMPTS - 1)])
+def test_wa_gives_up(wa_job, permanent, attempts):
+    job_id, _, _ = wa_job
+    job = dict(qr._wa_claim(), attempts=attempts)
+    qr._wa_finish(job, "400: bad number", permanent)
+    assert job_row(job_id)["status"] == "failed"
+
+def test_wa_sent_marks_visitor(wa_job):
+    job_id, vid, _ = wa_job
+    before = db.kpis("")["wa"]
+    qr._wa_finish(qr._wa_claim())
+    assert job_row(job_id)["status"] == "sent" and job_row(job_id)["last_error"] is None
+    assert db.row("SELECT wa_sent FROM visitors WHERE id=?", (vid,))["wa_sent"] == 1
+    assert db.kpis("")["wa"] == before + 1
+
+# ---------- Bulk import ----------
+def test_import_csv_counts_and_row_errors(monkeypatch):
+    monkeypatch.setattr(qr, "IMPORT_BATCH", 2)   # الدفعات والتكرار عبر حدودها
+    old, a, b = fields("Existing"), fields("New A"), fields("New B")
+    qr.register(old)
+    lines = ["name,company,position,email,phone", ",".join(a), ",".join(old), ",".join(b),
+             ",".join(a[:3] + ("other@example.com", a[4])),   # نفس جوال صف سابق بنفس الملف
+             "Missing,Acme,,x@example.com,0500000000"]
+    out = qr.import_visitors(qr.iter_import_rows(io.BytesIO("\n".join(lines).encode("utf-8-sig")), "csv"))
+    assert out == dict(inserted=2, existing=2, rejected=1, rows=5, errors=[dict(row=5, error="missing_fields")])
+    assert count(a[3]) == count(b[3]) == 1 and count("other@example.com") == 0
+    assert qr.registry.get(db.row("SELECT id FROM visitors WHERE email=?", (a[3],))["id"])["name"] == "New A"
+
+def test_import_jsonl_route():
+    a = fields("Json A")
+    body = "\n".join([json.dumps(dict(zip(("name", "company", "position", "email", "phone"), a))), "not json", "[1, 2]", ""])
+    resp = qr.app.test_client().post("/visitors/import", data=body.encode(), content_type="application/x-ndjson")
+    assert resp.status_code == 200
+    assert resp.get_json() == dict(ok=True, format="jsonl", inserted=1, existing=0, rejected=2, rows=3,
+                                   errors=[dict(row=2, error="bad_row"), dict(row=3, error="bad_row")])
+    assert count(a[3]) == 1
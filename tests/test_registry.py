@@ -0,0 +1,72 @@
+# كاش الزوار لمسارات السكان: فحص الشكل، الـ Bloom filter، نافذة الـ sync بين الـ workers، وإعادة بناء الفلتر بالخلفية
+import threading
+import time
+import uuid
+
+import pytest
+
+import db
+import qr
+
+def new_id():
+    return qr.rand_token()
+
+def insert_elsewhere(vid):
+    # تسجيل من worker ثاني: اتصال مستقل، فالـ registry ما يدري عنه إلا بالـ sync
+    con = db.connect()
+    try:
+        tag = uuid.uuid4().hex[:12]
+        with db.transaction(con) as c:
+            c.execute(db.SQL_VISITOR_INSERT, (vid, "Other", "Acme", "Eng", f"{tag}@example.com", "05" + tag, "0000", "2024-01-01T00:00:00"))
+    finally: con.close()
+
+@pytest.fixture
+def reg():
+    r = qr.VisitorRegistry()
+    r.load()
+    return r
+
+def exact(r, ids=()):
+    # فلتر بنسبة خطأ شبه صفر عشان نتيجة "مو موجود" ما تعتمد على محتوى القاعدة
+    r.bloom = qr.BloomFilter(1024, fp=1e-9)
+    for vid in ids: r.bloom.add(vid)
+
+def test_shape_reject_skips_the_database(reg, monkeypatch):
+    monkeypatch.setattr(db, "row", lambda *a: pytest.fail("queried SQLite"))
+    assert not reg.might_exist("not-a-visitor-id")
+    assert reg.get("ajz_TOO_LONG_0000") is None
+
+def test_might_exist_follows_the_filter(reg):
+    known = new_id()
+    exact(reg, [known])
+    reg.synced = time.monotonic()
+    assert reg.might_exist(known)
+    assert not reg.might_exist(new_id())
+
+def test_other_worker_registration_visible_after_sync_window(reg):
+    exact(reg)
+    vid = new_id()
+    insert_elsewhere(vid)
+    reg.synced = time.monotonic()
+    assert not reg.might_exist(vid)             # داخل نافذة REGISTRY_SYNC_MS: رفض الفلتر يصدق
+    reg.synced -= qr.REGISTRY_SYNC_S
+    assert reg.might_exist(vid)                 # بعدها: PRAGMA data_version تغير ونسحب الجديد
+    assert reg.get(vid)["name"] == "Other"
+
+def test_full_filter_is_rebuilt_off_the_request_path(reg):
+    old, started, release = reg.bloom, threading.Event(), threading.Event()
+    load = reg.load
+    def slow_load(con=None):
+        started.set(); release.wait(5); return load(con)
+    reg.load = slow_load
+    first, during = new_id(), new_id()
+    old.n = old.capacity
+    reg.add_ids([first])                        # يرجع فوراً؛ البناء بـ thread
+    assert started.wait(5)
+    assert reg.bloom is old and reg.might_exist(first)
+    insert_elsewhere(during); reg.add_ids([during])
+    release.set()
+    deadline = time.monotonic() + 5
+    while reg.rebuilding is not None: assert time.monotonic() < deadline; time.sleep(0.005)
+    assert reg.bloom is not old and reg.bloom.n < reg.bloom.capacity
+    assert during in reg.bloom
@@ -0,0 +1,295 @@
+# الرسم لازم يطلع نفس بكسلات الطريقة الأصلية (qrcode box_size=10 ثم NEAREST resize)
+import io
+import os
+import re
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import qrcode
+from PIL import Image
+
+import qr
+
+def baseline_qr(visitor_id, size_px, border=qr.QR_BORDER):
+    q = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=10, border=border)
+    q.add_data(visitor_id); q.make(fit=True)
+    img = q.make_image(fill_color="black", back_color="white").convert("RGB")
+    return img.resize((size_px, size_px), Image.NEAREST)
+
+def pixels(img):
+    return np.asarray(img.convert("RGB"))
+
+@pytest.mark.parametrize("size", [1, 7, 29, 100, 257, 567, 1024, 1299])
+@pytest.mark.parametrize("vid", ["ajz_abcdefghij", "https://example.com/visitor/ajz_0123456789?x=" + "y" * 40])
+def test_qr_raster_matches_baseline(vid, size):
+    assert np.array_equal(pixels(qr.build_qr_image(vid, size)), pixels(baseline_qr(vid, size)))
+
+@pytest.mark.parametrize("border", [0, 4])
+def test_qr_raster_matches_baseline_borders(monkeypatch, border):
+    # الـ border الافتراضي مربوط بـ qr_matrix وقت التعريف، فنمرّره للمصفوفة مباشرة
+    matrix = qr.qr_matrix.__wrapped__
+    monkeypatch.setattr(qr, "qr_matrix", lambda vid: matrix(vid, border))
+    for size in (33, 410, 1024):
+        assert np.array_equal(pixels(qr.build_qr_image("ajz_abcdefghij", size)), pixels(baseline_qr("ajz_abcdefghij", size, border)))
+
+# ---------- Badge template ----------
+def baseline_badge(name, company, position, visitor_id=None, w=qr.BADGE_W, h=qr.BADGE_H):
+    # compose_badge_portrait قبل القالب المحضّر (نفس الكود، يرسم كل شي لكل زائر)
+    img = Image.new("RGB", (w, h), (255, 255, 255))
+    d   = qr.ImageDraw.Draw(img)
+    f   = qr.load_times_bold(qr.FONT_SIZE)
+    px  = qr.cm_to_px
+    y_logo = max(px(0.10), px(qr.HOLE_SAFE_CM) - px(qr.LOGO_SHIFT_UP_CM))
+    after_logo, side = y_logo, px(qr.LOGO_CM)
+    try:
+        logo = Image.open(qr.LOGO_PATH).convert("RGBA")
+        r = max(1e-6, logo.width/float(logo.height))
+        if r >= 1.0: nw, nh = side, int(round(side/r))
+        else:        nh, nw = side, int(round(side*r))
+        logo = logo.resize((nw, nh), Image.LANCZOS)
+        img.paste(logo, ((w-nw)//2, y_logo), logo)
+        after_logo = y_logo + nh
+    except OSError: pass
+    side_pad = px(0.6); gap = px(0.6)
+    lw_max   = max(qr.text_size(d, lbl, f)[0] for lbl in ("Name:", "Company:", "Position:"))
+    value_x  = side_pad + lw_max + gap
+    value_w  = w - 2*side_pad - lw_max - gap
+    line_h   = int(round(qr.LINE_SPACING * qr.FONT_SIZE))
+    y = after_logo + px(qr.TEXT_TOP_GAP_CM)
+    for i, (label, value) in enumerate((("Name:", name), ("Company:", company), ("Position:", position))):
+        d.text((side_pad, y), label, font=f, fill=(10,10,10))
+        lines = qr.wrap_lines(d, value or "", f, value_w)
+        for j, ln in enumerate(lines): d.text((value_x, y+j*line_h), ln, font=f, fill=(10,10,10))
+        y += max(line_h, line_h*len(lines))
+        if i < 2: y += px(0.35)
+    if visitor_id:
+        qr_min  = px(1.8)
+        qr_side = max(qr_min, min(px(qr.QR_CM), min(int(w*0.28), px(4.0))))
+        avail   = h - px(0.8) - (y + px(1.6))
+        qr_side = qr_min if avail < qr_min else min(qr_side, avail)
+        img.paste(baseline_qr(visitor_id, qr_side), ((w-qr_side)//2, h - px(0.8) - qr_side))
+    return img
+
+BADGES = [
+    ("Sara Ali", "Acme", "Engineer", "ajz_abcdefghij"),
+    ("Abdulrahman Mohammed Al-Qahtani bin Saleh", "International Exhibitions and Conferences Company", "Senior Vice President of Strategic Partnerships", "ajz_0123456789"),
+    ("", "", "", None),
+    ("Noura", "A very long company name that certainly wraps onto more than one line", "CTO", None),
+]
+
+@pytest.fixture(params=["no_logo", "wide_logo", "tall_logo"])
+def logo(request, tmp_path, monkeypatch):
+    path = tmp_path / "logo.png"
+    if request.param != "no_logo":
+        size = (300, 120) if request.param == "wide_logo" else (90, 240)
+        im = Image.new("RGBA", size, (0, 90, 160, 255)); im.putpixel((5, 5), (255, 0, 0, 128))
+        im.save(path)
+    monkeypatch.setattr(qr, "LOGO_PATH", str(path))
+    return path
+
+@pytest.mark.parametrize("fields", BADGES)
+def test_badge_template_matches_baseline(logo, fields):
+    assert np.array_equal(pixels(qr.compose_badge_portrait(*fields)), pixels(baseline_badge(*fields)))
+
+def test_badge_template_rebuilds_when_logo_changes(tmp_path, monkeypatch):
+    path = tmp_path / "logo.png"
+    monkeypatch.setattr(qr, "LOGO_PATH", str(path))
+    Image.new("RGBA", (200, 200), (255, 0, 0, 255)).save(path)
+    first = qr.badge_template()
+    Image.new("RGBA", (200, 100), (0, 0, 255, 255)).save(path)
+    assert qr.badge_template() is not first
+    assert np.array_equal(pixels(qr.compose_badge_portrait(*BADGES[0])), pixels(baseline_badge(*BADGES[0])))
+
+# ---------- Formats ----------
+def decoded(buf):
+    return pixels(Image.open(buf))
+
+@pytest.mark.parametrize("fmt", ["png", "webp"])
+@pytest.mark.parametrize("label", [None, "Sara Ali"])
+def test_qr_formats_are_lossless(fmt, label):
+    if fmt not in qr.QR_FORMATS: pytest.skip("Pillow built without WebP")
+    ref = baseline_qr("ajz_abcdefghij", 1024)
+    if label:
+        canvas = Image.new("RGB", (1024, 1184), "white"); canvas.paste(ref, (0, 0))
+        d = qr.ImageDraw.Draw(canvas); f = qr.load_times_bold(qr.FONT_SIZE)
+        tw, th = qr.text_size(d, label, f)
+        d.text(((1024-tw)//2, 1024+(160-th)//2), label, font=f, fill=(15,15,15))
+        ref = canvas
+    assert np.array_equal(decoded(qr.make_qr_png("ajz_abcdefghij", label_name=label, fmt=fmt)), pixels(ref))
+
+@pytest.mark.parametrize("fmt", ["png", "webp"])
+def test_badge_formats_are_lossless(logo, fmt):
+    if fmt not in qr.CARD_FORMATS: pytest.skip("Pillow built without WebP")
+    for fields in BADGES[:2]:
+        assert np.array_equal(decoded(qr.make_badge_png(*fields, fmt=fmt)), pixels(baseline_badge(*fields)))
+
+@pytest.mark.parametrize("mode", ["1", "L", "P", "RGB"])
+def test_compact_png_keeps_pixels(mode):
+    rng = np.random.default_rng(7)
+    if mode == "1":   a = np.repeat(rng.integers(0, 2, (40, 40, 1)) * 255, 3, 2)
+    elif mode == "L": a = np.repeat(rng.integers(0, 256, (40, 40, 1)), 3, 2)
+    elif mode == "P": a = rng.choice(np.array([[10,10,10],[200,30,40],[255,255,255]]), (40, 40))
+    else:             a = rng.integers(0, 256, (40, 40, 3))
+    img = Image.fromarray(a.astype(np.uint8), "RGB")
+    assert qr.compact_image(img).mode == mode
+    assert np.array_equal(decoded(qr.encode_image(img, "png", "test")), a)
+
+def test_qr_svg_path_covers_matrix():
+    m = qr.qr_matrix("ajz_abcdefghij")
+    svg = qr.qr_svg("ajz_abcdefghij")
+    got = np.zeros_like(m)
+    for x, y, n in re.findall(r"M(\d+) (\d+)h(\d+)v1h-\d+z", svg):
+        x, y, n = int(x), int(y), int(n)
+        assert not got[y, x:x+n].any()
+        got[y, x:x+n] = True
+    assert np.array_equal(got, m)
+
+BROWSER_IMG_ACCEPT = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+
+@pytest.mark.parametrize("accept, formats, want", [
+    (BROWSER_IMG_ACCEPT, "QR_FORMATS", "svg"),
+    (BROWSER_IMG_ACCEPT, "CARD_FORMATS", "webp"),
+    ("image/*,*/*;q=0.8", "QR_FORMATS", "png"),
+])
+def test_accept_picks_smallest_listed_format(accept, formats, want):
+    formats = getattr(qr, formats)
+    if want not in formats: pytest.skip("Pillow built without WebP")
+    with qr.app.test_request_context("/", headers={"Accept": accept}):
+        assert qr.negotiate_format(formats) == want
+
+def test_qr_format_order_is_smallest_first():
+    # /qr يرسم مع اسم الزائر دايماً
+    sizes = [len(qr.make_qr_png("ajz_abcdefghij", label_name="Sara Ali", fmt=f).getvalue()) for f in qr.QR_FORMATS]
+    assert sizes == sorted(sizes)
+
+# ---------- Render cache ----------
+def visitor():
+    tag = uuid.uuid4().hex[:12]
+    return qr.register(("Sara Ali", "Acme", "Engineer", f"{tag}@example.com", "05" + str(int(tag, 16))[:8]))["id"]
+
+def test_render_etag_and_304():
+    client, vid = qr.app.test_client(), visitor()
+    first = client.get(f"/qr/{vid}", headers={"Accept": "image/png"})
+    assert first.status_code == 200 and first.mimetype == "image/png" and first.headers["ETag"]
+    assert "Accept" in first.headers["Vary"]
+    again = client.get(f"/qr/{vid}", headers={"Accept": "image/png", "If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and not again.data and again.headers["ETag"] == first.headers["ETag"]
+    assert "Accept" in again.headers["Vary"]
+    other = client.get(f"/qr/{vid}", headers={"Accept": "image/svg+xml"})
+    assert other.mimetype == "image/svg+xml" and other.headers["ETag"] != first.headers["ETag"]
+
+@pytest.mark.parametrize("path, want", [("/qr/{}.png", "png"), ("/qr/{}.svg", "svg"), ("/card/{}.png", "png"),
+                                        ("/card_landscape/{}.png", "png"), ("/card/{}.webp", "webp")])
+def test_extension_fixes_format(path, want):
+    if want not in qr.CARD_FORMATS + qr.QR_FORMATS: pytest.skip("Pillow built without WebP")
+    client, vid = qr.app.test_client(), visitor()
+    for q in ("", "?format=svg"):
+        r = client.get(path.format(vid) + q, headers={"Accept": BROWSER_IMG_ACCEPT})
+        assert r.status_code == 200 and r.mimetype == qr.FORMAT_MIME[want] and "Accept" not in r.vary
+
+def test_unsupported_extension_is_not_served():
+    client, vid = qr.app.test_client(), visitor()
+    assert client.get(f"/card/{vid}.svg").status_code == 404
+    assert client.get(f"/card/{vid}?format=svg").status_code == 406
+
+def test_render_key_changes_after_logo_upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(qr, "LOGO_PATH", str(tmp_path / "logo.png"))
+    client, vid = qr.app.test_client(), visitor()
+    before = client.get(f"/card/{vid}.png")
+    logo = io.BytesIO(); Image.new("RGBA", (300, 120), (0, 90, 160, 255)).save(logo, "PNG"); logo.seek(0)
+    assert client.post("/logo/upload", data={"file": (logo, "logo.png")}, content_type="multipart/form-data").status_code == 302
+    after = client.get(f"/card/{vid}.png", headers={"If-None-Match": before.headers["ETag"]})
+    assert after.status_code == 200 and after.headers["ETag"] != before.headers["ETag"]
+    assert not np.array_equal(decoded(io.BytesIO(after.data)), decoded(io.BytesIO(before.data)))
+
+def test_disk_cache_evicts_oldest_over_budget(tmp_path):
+    cache = qr.RenderCache(0, str(tmp_path), disk_max_bytes=10_000)   # بدون ذاكرة: كل get من الديسك
+    keys = [uuid.uuid4().hex for _ in range(4)]
+    for i, k in enumerate(keys[:3]):
+        cache.put(k, bytes([i]) * 3000)
+        os.utime(cache._disk_path(k), (1000 + i, 1000 + i))
+    assert cache.get(keys[0]) is not None   # الـ hit يجدد mtime فيصير الأحدث
+    cache.put(keys[3], b"x" * 3000)          # 12000 > 10000: ينحذف الأقدم لين 9000
+    assert [k for k in keys if cache.get(k) is not None] == [keys[0], keys[2], keys[3]]
+    assert cache.disk_size == 9000 and cache.disk_evicted == 1
+
+# ---------- Print-run export ----------
+@pytest.fixture
+def export_pool(monkeypatch):
+    # نفس ordered_map بس بـ threads بدل process pool (spawn بطيء للاختبار)
+    pool = ThreadPoolExecutor(4)
+    monkeypatch.setattr(qr, "process_pool", lambda name, workers: pool)
+    yield
+    pool.shutdown()
+
+@pytest.fixture(scope="module")
+def company():
+    # شركة خاصة بالاختبار فالفلتر يرجع زوارها بس
+    name = "Export " + uuid.uuid4().hex[:8]
+    vids = []
+    for i in range(3):
+        tag = uuid.uuid4().hex[:12]
+        vids.append(qr.register((f"Visitor {i}", name, "Engineer", f"{tag}@example.com", "05" + str(int(tag, 16))[:8]))["id"])
+    return name, vids
+
+def export(fmt, **filters):
+    visitors = qr.db.iter_visitors(filters.get("start", ""), "", filters.get("company", ""), filters.get("ids"))
+    return b"".join(qr.export_stream(fmt, visitors))
+
+def pdf_objects(pdf):
+    # يتأكد من جدول الـ xref (كل إزاحة تبدأ بـ "<n> 0 obj") ويرجع {رقم: نص الكائن}
+    assert pdf.startswith(b"%PDF-1.4\n") and pdf.rstrip().endswith(b"%%EOF")
+    xref = int(re.search(rb"startxref\n(\d+)\n%%EOF", pdf).group(1))
+    assert pdf[xref:xref+5] == b"xref\n"
+    head, *entries = pdf[xref+5:].split(b"trailer")[0].decode().strip().splitlines()
+    start, n = map(int, head.split())
+    assert start == 0 and len(entries) == n and entries[0].startswith("0000000000 65535 f")
+    size = int(re.search(rb"/Size (\d+)", pdf[xref:]).group(1))
+    assert size == n
+    objs = {}
+    for num, e in enumerate(entries[1:], 1):
+        off, _, kind = e.split()
+        if kind != "n": continue
+        off = int(off)
+        assert pdf[off:].startswith(f"{num} 0 obj\n".encode())
+        objs[num] = pdf[off:pdf.index(b"endobj", off)]
+    return objs
+
+def test_export_zip_has_one_png_per_visitor(export_pool, company):
+    name, vids = company
+    zf = zipfile.ZipFile(io.BytesIO(export("zip", company=name)))
+    assert zf.namelist() == [f"{v}.png" for v in vids]
+    for v in vids:
+        assert Image.open(io.BytesIO(zf.read(f"{v}.png"))).size == (qr.BADGE_W, qr.BADGE_H)
+    only = zipfile.ZipFile(io.BytesIO(export("zip", ids=[vids[1], "ajz_missing000"])))
+    assert only.namelist() == [f"{vids[1]}.png"]
+
+def test_export_zip_empty(export_pool):
+    assert zipfile.ZipFile(io.BytesIO(export("zip", company="no such company " + uuid.uuid4().hex))).namelist() == []
+
+def test_export_pdf_structure(export_pool, company):
+    name, vids = company
+    objs = pdf_objects(export("pdf", company=name))
+    pages = re.search(rb"/Type /Pages /Kids \[([^\]]*)\] /Count (\d+)", objs[2])
+    assert b"/Type /Catalog /Pages 2 0 R" in objs[1]
+    images = [o for o in objs.values() if b"/Subtype /Image" in o]
+    assert len(images) == len(vids) and all(b"/Width %d /Height %d" % (qr.BADGE_W, qr.BADGE_H) in o for o in images)
+    page_objs = [o for o in objs.values() if b"/Type /Page " in o]
+    assert int(pages.group(2)) == len(page_objs) == 1   # 3 باجات 2x3 إنش بصفحة A4 وحدة
+    assert len(re.findall(rb"/I\d+ \d+ 0 R", page_objs[0])) == len(vids)
+
+def test_export_pdf_paginates():
+    out = io.BytesIO()
+    pdf = qr.PdfSheetWriter(out)
+    for _ in range(10): pdf.add(qr.BADGE_W, qr.BADGE_H, zlib.compress(b"\xff" * 3))
+    pdf.close()
+    objs = pdf_objects(out.getvalue())
+    assert b"/Count 2" in objs[2]   # 9 بالصفحة (3x3 على A4) + 1
+
+def test_export_pdf_empty(export_pool):
+    objs = pdf_objects(export("pdf", company="no such company " + uuid.uuid4().hex))
+    assert b"/Kids [] /Count 0" in objs[2]
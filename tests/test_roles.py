@@ -0,0 +1,44 @@
+# تقسيم الأدوار (QR_ROLE): كل دور ياخذ الـ routes حقته بس + المشتركة، والـ web ما يحمّل مكتبات القراءة
+import os
+import subprocess
+import sys
+
+import pytest
+
+import qr
+
+SHARED = {"/lookup/<vid>.json", "/checkins/stats", "/admission/stats", "/metrics"}
+
+def rules(role):
+    return {r.rule for r in qr.create_app(role).url_map.iter_rules()} - {"/static/<path:filename>"}
+
+def test_web_role_serves_dashboard_and_images_only():
+    web = rules("web")
+    assert SHARED <= web
+    assert {"/", "/visitors", "/create", "/forms/google", "/qr/<vid>", "/card/<vid>", "/export/badges"} <= web
+    assert not {r for r in web if r.startswith(("/decode", "/scan", "/checkin/"))}
+
+def test_decode_role_serves_scanners_only():
+    dec = rules("decode")
+    assert SHARED <= dec
+    assert {"/decode", "/decode_badge", "/decode/batch", "/scan/stream", "/checkin/group"} <= dec
+    assert not {r for r in dec if r.startswith(("/qr", "/card", "/visitors", "/create", "/forms", "/export"))} and "/" not in dec
+
+def test_every_route_is_in_some_role():
+    assert rules("web") | rules("decode") == {r.rule for r in qr.app.url_map.iter_rules()} - {"/static/<path:filename>"}
+    assert qr.create_app("all") is qr.app
+    with pytest.raises(ValueError): qr.create_app("scanner")
+
+def test_role_app_keeps_overload_handler(monkeypatch):
+    monkeypatch.setattr(qr, "ADMIT_ENABLED", True)
+    monkeypatch.setattr(qr.decode_gate, "active", qr.decode_gate.limit)
+    monkeypatch.setattr(qr.decode_gate, "queue", 0)
+    monkeypatch.setattr(qr.decode_gate, "shed", dict(queue_full=0, timeout=0, lane=0))
+    resp = qr.create_app("decode").test_client().post("/decode", data=b"x", content_type="image/jpeg")
+    assert resp.status_code == 503 and resp.headers["Retry-After"]
+
+def test_web_role_does_not_import_decoders():
+    code = "import sys, qr; qr.create_app(); print('cv2' in sys.modules, 'pyzbar' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], env=dict(os.environ, QR_ROLE="web"), capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True).stdout
+    assert out.split() == ["False", "False"]
@@ -0,0 +1,66 @@
+# نسخة الزوار للقراءة: bisect على الـ index، والـ deltas، وإعادة الفتح بعد ما ينكتب الملف من جديد
+import os
+
+import pytest
+
+import snapshot
+
+def visitors(n, start=1):
+    # (rowid, id, name, company, position) بـ IDs مو مرتبة عشان write يرتّبها
+    return [(i, f"ajz_{(i * 7919) % 10**10:010d}", f"Visitor {i}", f"شركة {i % 13}", "Engineer" if i % 2 else "")
+            for i in range(start, start + n)]
+
+def rec(row):
+    return dict(zip(("id", "name", "company", "position"), row[1:]))
+
+def test_snapshot_file_bisect_lookup(tmp_path):
+    rows = visitors(500) + [(501, "x", "Short Id", "", ""), (502, "ajz_zzzzzzzzzzzz", "Long Id", "", "")]
+    path = str(tmp_path / snapshot.BASE)
+    assert snapshot.write(path, [r[1:] for r in rows], watermark=502) == len(rows)
+    with snapshot.SnapshotFile(path) as f:
+        assert f.count == len(rows) and f.watermark == 502
+        for r in rows: assert f.get(r[1]) == rec(r)
+        for missing in ("", "ajz_", "ajz_0000000000", "ajz_zzzzzzzzzzzzz", "zzz"): assert f.get(missing) is None
+
+def test_snapshot_file_rejects_other_files(tmp_path):
+    path = tmp_path / snapshot.BASE
+    path.write_bytes(b"not a snapshot" * 10)
+    with pytest.raises(ValueError): snapshot.SnapshotFile(str(path))
+
+def test_export_writes_deltas_then_rebases(tmp_path):
+    table = visitors(100)
+    fetch = lambda after: [r for r in table if r[0] > after]
+    d = str(tmp_path)
+    assert snapshot.export(d, fetch) == dict(kind="base", visitors=100, watermark=100)
+    assert snapshot.export(d, fetch)["visitors"] == 0
+    table += visitors(5, start=101)
+    assert snapshot.export(d, fetch)["file"] == "registry.delta.000001"
+    assert snapshot.head(d)[1:] == (105, 1)
+    assert snapshot.export(d, fetch, full=True)["kind"] == "base"
+    assert snapshot.delta_paths(d) == []
+
+def test_snapshot_sees_deltas_and_rewrites(tmp_path):
+    table = visitors(50)
+    fetch = lambda after: [r for r in table if r[0] > after]
+    d = str(tmp_path)
+    snapshot.export(d, fetch)
+    snap = snapshot.Snapshot(d, check_s=0)
+    assert snap.get(table[0][1]) == rec(table[0])
+    new = visitors(3, start=51)
+    assert snap.get(new[0][1]) is None
+    table += new; snapshot.export(d, fetch)
+    assert [snap.get(r[1]) for r in new] == [rec(r) for r in new]
+    # base جديد مكان القديم (os.replace) والـ deltas تنحذف: القارئ يفتح الملف الجديد
+    table[:] = visitors(10, start=1000)
+    snapshot.export(d, fetch, full=True)
+    assert snap.get(table[0][1]) == rec(table[0])
+    assert snap.get(new[0][1]) is None
+    assert snap.stats()["files"] == 1 and snap.stats()["visitors"] == 10
+
+def test_snapshot_ignores_deltas_of_another_base(tmp_path):
+    d = str(tmp_path)
+    snapshot.export(d, lambda after: visitors(10) if after == 0 else [])
+    stray = visitors(1, start=99)
+    snapshot.write(os.path.join(d, "registry.delta.000001"), [r[1:] for r in stray], 1, base_id=1, watermark=99)
+    snap = snapshot.Snapshot(d, check_s=0)
+    assert snap.get(stray[0][1]) is None and snap.stats()["files"] == 1